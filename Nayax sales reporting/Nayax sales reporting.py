@@ -1,5 +1,6 @@
 ## standard libraries
 import re
+import sys
 import time
 import queue
 import threading
@@ -9,7 +10,15 @@ from tkinter import ttk, font, messagebox, filedialog
 import datetime
 import os
 import copy
-from multiprocessing.pool import ThreadPool
+import asyncio
+import hashlib
+import codecs
+import random
+import sqlite3
+import decimal
+import bisect
+import xml.parsers.expat
+import importlib
 
 ## function to install modules from pip
 def install(package):
@@ -19,6 +28,16 @@ def install(package):
         from pip._internal import main as pipmain
     pipmain(['install', package])
 
+## function to import a module from pip the first time it is needed,
+## installing it if it is missing
+def import_optional(module):
+    try:
+        return importlib.import_module(module)
+    except ImportError:
+        print('It looks like you are missing the ' + module + ' module. Installing it now. Please wait...')
+        install(module)
+        return importlib.import_module(module)
+
 ## non-standard libraries
 try:
     import requests
@@ -32,21 +51,647 @@ except:
     print('It looks like you are missing the Python imaging library. Installing it now. Please wait...')
     install('Pillow')
     from PIL import Image, ImageTk
+## only needed by the asyncio engine and the columnar store, so they are
+## imported when those are first used
+aiohttp = None
+numpy = None
+
+## address of the Nayax DCS website. Can be overridden with the
+## NAYAX_BASE_URL environment variable (e.g. to use a local stand-in)
+base_URL = os.environ.get('NAYAX_BASE_URL', 'https://my.nayax.com/DCS/')
 
-## number of workers for multithreaded requests
+## number of workers for multithreaded requests. The adaptive limiter starts
+## here and then moves between the minimum and maximum depending on how
+## quickly Nayax is responding
 worker_count = 20
+worker_count_min = 2
+worker_count_max = 100
+## requests whose response time depends on how much they return (e.g. a big
+## sales summary), so they don't count towards the limiter's latency signal
+limiter_unmeasured_actions = ['SalesSummary_Report']
+
+## use the asyncio engine instead of worker threads for bulk operations, and
+## the maximum number of requests it will have in flight at once
+use_async_engine = False
+async_concurrency = 200
+
+## add up sales, active DTUs and signal strength for operators from columns
+## of machine values laid out in tree order, instead of machine by machine
+use_columnar_store = True
+
+## on-disk cache for sales summaries and machine histories. Sales for periods
+## that have ended never expire, periods that include today are kept for a
+## short time. The least recently used responses go once the size is reached
+use_response_cache = True
+cache_path = 'cache'
+cache_max_bytes = 500 * 1024 * 1024
+cache_open_period_ttl = 15 * 60
+cache_history_ttl = 12 * 60 * 60
+
+## on-disk store of the fleet, sales, machine histories and product maps, so
+## that a new session can reuse what is already known. Sales and histories
+## are reused for as long as they would be cached
+use_fleet_store = True
+fleet_store_path = 'nayax.db'
+
+## stream sales summaries in chunks and apply each machine row as it arrives,
+## instead of holding the whole response in memory
+stream_sales_data = True
+stream_chunk_size = 64 * 1024
+
+## apply each operator's sales to the machines (and update the tree rows) as
+## soon as they arrive, while the rest are still downloading, instead of
+## waiting for every download to finish
+pipeline_sales_data = True
+
+## parse the machine list XML as it downloads (falling back to the old
+## regular expressions if it isn't well formed)
+stream_machine_list = True
+
+## seconds to wait for Nayax to accept a connection, and for each read once
+## connected. Failed, timed out and server error (5xx) requests are retried
+## with exponential backoff (plus jitter) up to retry_count attempts
+connect_timeout = 10
+read_timeout = 120
+retry_count = 5
+retry_backoff_base = 1
+retry_backoff_max = 30
+
+## identical read requests that are in flight at the same time share one
+## request. The results of the read actions listed here are also remembered
+## for a while (up to a number of responses), until a write action for the
+## same machine makes them out of date
+request_memo_ttl = 10 * 60
+request_memo_max = 10000
+request_memo_actions = ['InventoryStatus_Search', 'MachineHistory.Get']
+request_write_actions = ['InventoryStatus.RemoveProducts', 'InventoryStatus.UpdateMachineProduct']
+
+## steady rate (requests per second) and burst size allowed for all requests
+## to Nayax from this process, for reads and for writes (the actions in
+## request_write_actions). Requests over the rate queue in the order they
+## arrived. None for no limit. Nayax doesn't publish a limit, so reads are
+## left to the adaptive limiter, and only bulk product map changes are held
+## back to a cautious rate
+read_rate_limit = None
+read_burst = 50
+write_rate_limit = 10
+write_burst = 10
+
+## seconds a bulk job (e.g. loading sales data) may take in total before the
+## remaining work is abandoned. None for no limit
+job_deadline = 60 * 60
+
+## sales requests are planned from an estimate of how long each one will take.
+## Until some real requests have been timed, a request is taken to cost a
+## fixed number of seconds plus some seconds per machine under the actor
+sales_request_overhead = 0.5
+sales_request_per_machine = 0.002
+## requests are split until they cover no more than this many machines where
+## the tree allows, however cheap the estimate makes bigger ones look
+sales_request_max_machines = 2000
+
+## long date ranges can be fetched as calendar 'month' or 'week' windows in
+## parallel and merged, instead of one big request per operator (None).
+## Windows that have closed are kept by the cache and store for later reports
+sales_window = None
 
 ## global variables
 machine_list = []
 operator_list = []
+## token buckets shared by every Nayax object (made when first needed, and
+## made again if the rate limits are changed)
+read_bucket = None
+write_bucket = None
+bucket_lock = threading.Lock()
+
+## Index of the operator/machine tree, so that lookups don't have to scan the
+## whole machine and operator lists
+class ActorIndex():
+    ## Initialise the (empty) index
+    def __init__(self):
+        ## id -> operator and id -> machine. If an id turns up twice, the
+        ## first one in the list wins
+        self.operators = {}
+        self.machines = {}
+        ## parent id -> [operators, machines] directly under it
+        self.children_of = {}
+        ## every actor in the tree, depth first with each operator before
+        ## the things under it (nested set order). Everything under an
+        ## operator is order[operator.entry + 1:operator.exit]
+        self.order = []
+        ## list sizes the index was built from
+        self.size = None
+        ## sales version the active machine counts were made at
+        self.activity_version = None
+        ## operator id -> {'cash': [count, amount], 'card': [count, amount]}
+        ## for all of the machines under it, and the sales version they were
+        ## added up for. Changing any machine's sales bumps the version
+        self.rollups = {}
+        self.rollups_version = None
+        self.sales_version = 0
+        self.sales_lock = threading.Lock()
+        ## [version, machines] for each version since everything last
+        ## changed, when only some machines' sales changed, and how many
+        ## machines that adds up to
+        self.sales_log = []
+        self.logged_machines = 0
+        ## machines whose sales have been set but not published yet
+        self.sales_pending = set()
+    
+    ## Build the index from the global machine and operator lists
+    def build(self):
+        global machine_list, operator_list
+        operators = {}
+        machines = {}
+        children_of = {}
+        for operator in operator_list:
+            operators.setdefault(operator.id, operator)
+            children_of.setdefault(operator.parent, [[], []])[0].append(operator)
+        for machine in machine_list:
+            machines.setdefault(machine.id, machine)
+            children_of.setdefault(machine.parent, [[], []])[1].append(machine)
+        
+        self.operators = operators
+        self.machines = machines
+        self.children_of = children_of
+        self.order = self.number_tree()
+        self.size = (len(operator_list), len(machine_list))
+        self.activity_version = None
+        
+        ## the tree has changed, so the sales totals have to be redone
+        self.sales_changed()
+    
+    ## Walk the tree depth first, giving each actor its entry index and each
+    ## operator its exit index and the number of machines and operators
+    ## under it. Returns the actors in the order they were numbered
+    def number_tree(self):
+        global machine_list, operator_list
+        for actor in operator_list:
+            actor.entry = None
+        for actor in machine_list:
+            actor.entry = None
+        
+        order = []
+        machine_total = 0
+        ## [actor, None] on the way down, [operator, machines before it] to
+        ## close an operator off on the way back up
+        stack = []
+        for operator in reversed(list(self.operators.values())):
+            if operator.parent not in self.operators:
+                stack.append([operator, None])
+        while len(stack) > 0:
+            actor, machines_before = stack.pop()
+            if machines_before != None:
+                actor.exit = len(order)
+                actor.subtree_machines = machine_total - machines_before
+                actor.subtree_operators = actor.exit - actor.entry - 1 - actor.subtree_machines
+                continue
+            ## don't go round in circles if the parents loop
+            if actor.entry != None:
+                continue
+            
+            actor.entry = len(order)
+            order.append(actor)
+            if actor.type == 'machine':
+                machine_total += 1
+                continue
+            
+            stack.append([actor, machine_total])
+            ## machines go after the operators, like get_children
+            children = self.children_of.get(actor.id, [[], []])
+            for machine in reversed(children[1]):
+                stack.append([machine, None])
+            for child in reversed(children[0]):
+                stack.append([child, None])
+        
+        return order
+    
+    ## Rebuild the index if the lists have changed since it was built
+    def check(self):
+        global machine_list, operator_list
+        if self.size != (len(operator_list), len(machine_list)):
+            self.build()
+    
+    ## Operators directly under a parent id
+    def child_operators(self, parent):
+        self.check()
+        return self.children_of.get(parent, [[], []])[0]
+    
+    ## Machines directly under a parent id
+    def child_machines(self, parent):
+        self.check()
+        return self.children_of.get(parent, [[], []])[1]
+    
+    ## Convert an id (which may be text, e.g. from the GUI) to the integer
+    ## ids the index uses. None if it isn't an id
+    def key(self, id):
+        try:
+            return int(id)
+        except (TypeError, ValueError):
+            return None
+    
+    ## Get the operator with an id, or None
+    def operator(self, id):
+        self.check()
+        return self.operators.get(self.key(id))
+    
+    ## Get the machine with an id, or None
+    def machine(self, id):
+        self.check()
+        return self.machines.get(self.key(id))
+    
+    ## Get the operator or machine with an id (operators first), or None
+    def find(self, id):
+        actor = self.operator(id)
+        if actor == None:
+            actor = self.machine(id)
+        return actor
+    
+    ## Everything under an operator (at any depth), in the same order as
+    ## get_children. Optionally only 'operator' or 'machine' types. None if
+    ## the operator isn't in the tree
+    def subtree(self, operator, type = 'all'):
+        self.check()
+        if operator.entry == None:
+            return None
+        actors = self.order[operator.entry + 1:operator.exit]
+        if type != 'all':
+            actors = [actor for actor in actors if actor.type == type]
+        return actors
+    
+    ## Returns true if an actor is somewhere under an operator
+    def is_under(self, actor, operator):
+        self.check()
+        if actor.entry == None or operator.entry == None:
+            return False
+        return operator.entry < actor.entry < operator.exit
+    
+    ## Count the active and inactive machines under every operator, if the
+    ## activity of any machine has changed since they were last counted
+    def count_activity(self):
+        self.check()
+        version = self.sales_version
+        if self.activity_version == version:
+            return
+        
+        ## running totals of active and inactive machines before each actor
+        ## in the tree order
+        active_before = [0]
+        inactive_before = [0]
+        for actor in self.order:
+            active = inactive = 0
+            if actor.type == 'machine':
+                if actor.active == True:
+                    active = 1
+                ## inactive for the period, or not known and not active now
+                if (actor.active == None and actor.active_now == False) or actor.active == False:
+                    inactive = 1
+            active_before.append(active_before[-1] + active)
+            inactive_before.append(inactive_before[-1] + inactive)
+        
+        for actor in self.order:
+            if actor.type == 'operator':
+                actor.subtree_active = active_before[actor.exit] - active_before[actor.entry]
+                actor.subtree_inactive = inactive_before[actor.exit] - inactive_before[actor.entry]
+        
+        self.activity_version = version
+    
+    ## Note that the sales of some machines have changed, or of everything
+    ## (e.g. the tree or the activity of the machines) if none are given
+    def sales_changed(self, machines = None):
+        with self.sales_lock:
+            self.sales_version += 1
+            if machines == None:
+                self.sales_log = []
+                self.logged_machines = 0
+                self.sales_pending = set()
+                return
+            
+            self.sales_log.append([self.sales_version, list(machines)])
+            self.logged_machines += len(machines)
+            ## once the log covers as many machines as the fleet, starting
+            ## again is just as quick
+            while self.logged_machines > len(self.machines) and len(self.sales_log) > 0:
+                self.logged_machines -= len(self.sales_log.pop(0)[1])
+    
+    ## Note that the sales of a machine have been set. Nothing reading the
+    ## totals sees it until publish_sales is called, so that a batch of rows
+    ## only bumps the sales version once
+    def machine_sales_set(self, machine):
+        with self.sales_lock:
+            self.sales_pending.add(machine)
+    
+    ## Publish the sales that have been set since the last time
+    def publish_sales(self):
+        with self.sales_lock:
+            machines = self.sales_pending
+            self.sales_pending = set()
+        if len(machines) > 0:
+            self.sales_changed(machines)
+    
+    ## The sales version, and the machines whose sales have changed since an
+    ## earlier version. The machines are None if that isn't known (e.g.
+    ## everything has changed since)
+    def sales_changes(self, version):
+        with self.sales_lock:
+            current = self.sales_version
+            if version == current:
+                return current, []
+            if version == None or len(self.sales_log) == 0 or self.sales_log[0][0] > version + 1:
+                return current, None
+            
+            machines = []
+            for logged, changed in self.sales_log:
+                if logged > version:
+                    machines.extend(changed)
+            return current, machines
+    
+    ## Add up the sales under every operator in one pass, children before
+    ## parents
+    def build_rollups(self):
+        self.check()
+        version = self.sales_version
+        
+        ## operators top down, so that walking it backwards visits children
+        ## first
+        order = []
+        stack = []
+        for operator in self.operators.values():
+            if operator.parent not in self.operators:
+                stack.append(operator)
+        while len(stack) > 0:
+            operator = stack.pop()
+            order.append(operator)
+            stack.extend(self.children_of.get(operator.id, [[], []])[0])
+        
+        rollups = {}
+        for operator in reversed(order):
+            ## [count, amount, has data] for each source
+            totals = {'cash': [0, 0, False], 'card': [0, 0, False]}
+            for machine in self.children_of.get(operator.id, [[], []])[1]:
+                for source in totals:
+                    count, amount = machine.get_sales(source)
+                    if count != None:
+                        totals[source][0] += count
+                        totals[source][1] += amount
+                        totals[source][2] = True
+            for child in self.children_of.get(operator.id, [[], []])[0]:
+                child_totals = rollups.get(child.id)
+                if child_totals == None:
+                    continue
+                for source in totals:
+                    if child_totals[source][2] == True:
+                        totals[source][0] += child_totals[source][0]
+                        totals[source][1] += child_totals[source][1]
+                        totals[source][2] = True
+            rollups[operator.id] = totals
+        
+        self.rollups = rollups
+        self.rollups_version = version
+    
+    ## Sales count, amount for everything under an operator. Source is
+    ## 'cash' or 'card'. None, None if none of the machines have sales data
+    def sales_rollup(self, operator, source):
+        self.check()
+        if self.rollups_version != self.sales_version:
+            self.build_rollups()
+        
+        totals = self.rollups.get(operator.id)
+        if totals == None or totals[source][2] == False:
+            return None, None
+        return totals[source][0], totals[source][1]
+    
+    ## Find the root (highest) operator, which is the first one whose parent
+    ## isn't a known operator. None if there isn't one
+    def root_operator(self):
+        global operator_list
+        self.check()
+        for operator in operator_list:
+            if operator.parent not in self.operators:
+                return operator
+        return None
+
+actor_index = ActorIndex()
+
+## Machine values held in numpy columns, with a row for every actor in the
+## index's depth-first (Euler tour) order, so that everything under an
+## operator is one contiguous slice of each column. Operator rows are empty
+class SalesColumns():
+    ## Initialise the store
+    def __init__(self, index):
+        self.index = index
+        ## the rows that hold machines, and the machines in them
+        self.rows = None
+        self.machines = []
+        ## the index tree order the layout was made from, and the sales
+        ## version the columns were filled at
+        self.layout_of = None
+        self.version = None
+        self.size = 0
+        self.lock = threading.Lock()
+        
+        ## the columns are made with the first layout
+        self.cash_count = None
+        self.cash_amount = None
+        self.cash_known = None
+        self.card_count = None
+        self.card_amount = None
+        self.card_known = None
+        self.active = None
+        self.rssi = None
+    
+    ## Find the rows of the tree order that hold machines
+    def build_layout(self):
+        global numpy
+        if numpy == None:
+            numpy = import_optional('numpy')
+        
+        order = self.index.order
+        rows = []
+        for row, actor in enumerate(order):
+            if actor.type == 'machine':
+                rows.append(row)
+        
+        self.rows = numpy.array(rows, dtype = numpy.int64)
+        self.machines = [order[row] for row in rows]
+        self.size = len(order)
+        self.layout_of = order
+    
+    ## Make a column with a value for each machine, leaving the operator
+    ## rows as the empty value
+    def column(self, values, dtype, empty):
+        column = numpy.full(self.size, empty, dtype = dtype)
+        column[self.rows] = numpy.fromiter(values, dtype = dtype, count = len(self.machines))
+        return column
+    
+    ## Fill the columns from the machines
+    def fill(self):
+        machines = self.machines
+        
+        self.cash_count = self.column((machine.cash_count or 0 for machine in machines), numpy.int64, 0)
+        self.cash_amount = self.column((machine.cash_amount or 0 for machine in machines), float, 0)
+        self.cash_known = self.column((machine.cash_count != None for machine in machines), bool, False)
+        self.card_count = self.column((machine.card_count or 0 for machine in machines), numpy.int64, 0)
+        self.card_amount = self.column((machine.card_amount or 0 for machine in machines), float, 0)
+        self.card_known = self.column((machine.card_count != None for machine in machines), bool, False)
+        self.active = self.column((machine.active == True for machine in machines), bool, False)
+        ## unknown signal strength is NaN so it drops out of averages
+        self.rssi = self.column((self.to_number(machine.rssi) for machine in machines), float, numpy.nan)
+    
+    ## Write the values of some machines into their rows, leaving the rest of
+    ## the columns alone
+    def fill_machines(self, machines):
+        for machine in set(machines):
+            row = machine.entry
+            if row == None or row >= self.size or self.index.order[row] is not machine:
+                continue
+            
+            self.cash_count[row] = machine.cash_count or 0
+            self.cash_amount[row] = machine.cash_amount or 0
+            self.cash_known[row] = machine.cash_count != None
+            self.card_count[row] = machine.card_count or 0
+            self.card_amount[row] = machine.card_amount or 0
+            self.card_known[row] = machine.card_count != None
+            self.active[row] = machine.active == True
+            self.rssi[row] = self.to_number(machine.rssi)
+    
+    ## Signal strength as a number, or NaN if it isn't known
+    def to_number(self, value):
+        try:
+            return float(value)
+        except (TypeError, ValueError):
+            return numpy.nan
+    
+    ## Bring the layout and columns up to date with the index. Only the rows
+    ## of machines whose sales have changed are written if those are known
+    def check(self):
+        self.index.check()
+        with self.lock:
+            if self.layout_of is not self.index.order:
+                self.build_layout()
+                self.version = None
+            if self.version != self.index.sales_version:
+                version, machines = self.index.sales_changes(self.version)
+                if machines == None:
+                    self.fill()
+                else:
+                    self.fill_machines(machines)
+                self.version = version
+    
+    ## The [start, end) slice of the columns for an operator, or None if it
+    ## isn't in the tree
+    def span(self, operator):
+        self.check()
+        if operator.entry == None:
+            return None
+        return operator.entry, operator.exit
+    
+    ## Sales count, amount for everything under an operator. Source is
+    ## 'cash' or 'card'. None, None if none of the machines have sales data
+    def sales(self, operator, source):
+        span = self.span(operator)
+        if span == None:
+            return None, None
+        start, end = span
+        
+        if source == 'cash':
+            count, amount, known = self.cash_count, self.cash_amount, self.cash_known
+        else:
+            count, amount, known = self.card_count, self.card_amount, self.card_known
+        if known[start:end].any() == False:
+            return None, None
+        return int(count[start:end].sum()), float(amount[start:end].sum())
+    
+    ## Number of machines under an operator, optionally only the active ones
+    def machine_count(self, operator, active_only = False):
+        span = self.span(operator)
+        if span == None:
+            return None
+        start, end = span
+        
+        if active_only == True:
+            return int(numpy.count_nonzero(self.active[start:end]))
+        else:
+            return operator.subtree_machines
+    
+    ## Average signal strength of the machines under an operator that have
+    ## reported one. None if none of them have
+    def average_rssi(self, operator):
+        span = self.span(operator)
+        if span == None:
+            return None
+        values = self.rssi[span[0]:span[1]]
+        values = values[~numpy.isnan(values)]
+        if len(values) == 0:
+            return None
+        return float(values.mean())
+
+sales_columns = SalesColumns(actor_index)
+
+## Returns the shared copy of a string, so that values repeated across lots
+## of machines (e.g. firmware versions) are only held once
+def intern_text(value):
+    if type(value) is str:
+        return sys.intern(value)
+    else:
+        return value
+
+## Text for a number of seconds, e.g. 1m 05s
+def format_duration(seconds):
+    seconds = int(round(seconds))
+    if seconds < 60:
+        return str(seconds) + 's'
+    else:
+        return str(seconds // 60) + 'm ' + '{:02d}'.format(seconds % 60) + 's'
+
+## Things common to machines and operators. Uses slots (and integer ids) to
+## keep memory down with large fleets
+class Actor():
+    __slots__ = ('id', 'parent', 'name', 'active_now', 'active', 'fees', 'entry')
+    
+    ## Initialise the actor
+    def __init__(self, id, parent, name):
+        self.id = int(id)
+        self.parent = int(parent)
+        self.name = name
+        ## set to true if the actor indicates that it is currently active
+        ## (used later to figure out active ranges)
+        self.active_now = False
+        self.active = None
+        ## actors share an empty tuple until they get a fee
+        self.fees = ()
+        ## position in the tree order (set by the index)
+        self.entry = None
+    
+    ## Add a fee to this actor
+    def add_fee(self, fee):
+        if len(self.fees) == 0:
+            self.fees = [fee]
+        else:
+            self.fees.append(fee)
+    
+    ## Remove a fee from this actor
+    def remove_fee(self, fee):
+        fees = list(self.fees)
+        fees.remove(fee)
+        if len(fees) == 0:
+            self.fees = ()
+        else:
+            self.fees = fees
+    
+    ## Remove all fees from this actor
+    def clear_fees(self):
+        self.fees = ()
 
 ## Machine object for storing machine information
-class Machine():
+class Machine(Actor):
+    __slots__ = ('dtu', 'vpos', 'sim', 'rssi', 'fw_dtu', 'fw_vpos', 'cash_count', 'cash_amount', 'card_count', 'card_amount')
+    ## shared by all machines rather than stored on each one
+    type = 'machine'
+    
     ## Initialise the machine object
     def __init__(self, id, parent, name):
-        self.id = id
-        self.parent = parent        
-        self.name = name
+        Actor.__init__(self, id, parent, name)
         
         self.dtu = None
         self.vpos = None
@@ -54,15 +699,12 @@ class Machine():
         self.rssi = None
         self.fw_dtu = None
         self.fw_vpos = None
-        self.type = 'machine'
         
-        ## set to true if the machine indicates that it is currently active
-        ## (used later to figure out active ranges)
-        self.active_now = False
-        self.active = None
-        self.fees = []
-        ## sales are 'source': [count, value]
-        self.sales = {'cash': [None,None], 'card': [None,None]}
+        ## sales count and value for each source (None if not known)
+        self.cash_count = None
+        self.cash_amount = None
+        self.card_count = None
+        self.card_amount = None
     
     ## Returns true if the machine has a VPOS touch, false otherwise
     def is_vpos_touch(self):
@@ -73,19 +715,32 @@ class Machine():
     
     ## Returns cash sale count, amount
     def get_cash_sales(self):
-        return self.sales['cash'][0], self.sales['cash'][1]
+        return self.cash_count, self.cash_amount
         
     ## Returns card sale count, amount
     def get_card_sales(self):
-        return self.sales['card'][0], self.sales['card'][1]
+        return self.card_count, self.card_amount
+    
+    ## Returns sale count, amount for a source ('cash' or 'card')
+    def get_sales(self, source):
+        if source == 'cash':
+            return self.cash_count, self.cash_amount
+        else:
+            return self.card_count, self.card_amount
+    
+    ## Set the sale count, amount for a source ('cash' or 'card')
+    def set_sales(self, source, count, amount):
+        if source == 'cash':
+            self.cash_count = count
+            self.cash_amount = amount
+        else:
+            self.card_count = count
+            self.card_amount = amount
+        actor_index.machine_sales_set(self)
 
     ## get the parent of this operator
     def get_parent(self):    
-        for operator in operator_list:
-            if operator.id == self.parent:
-                return operator
-                
-        return None        
+        return actor_index.operator(self.parent)
     
 ## Fee object
 class Fee():
@@ -150,7 +805,7 @@ class Fee():
             ## Fixed fee
             if actor.type == 'operator':
                 ## for ops, get the number of active actors
-                dtus = len(actor.get_machines(recursive = True, active_only = True))
+                dtus = actor.count_machines(active_only = True)
             else:
                 ## machines dont have get_actors, so the number will be one
                 dtus = 1
@@ -195,164 +850,2041 @@ class Fee():
                 value = self.amount * (revenue / 100)
         
             else:
-                raise ValueError('Unknown fee application: ' + str(self.applied))
+                raise ValueError('Unknown fee application: ' + str(self.applied))
+        
+        return value
+                        
+## Operator object for storing operator information
+class Operator(Actor):
+    __slots__ = ('exit', 'subtree_machines', 'subtree_operators', 'subtree_active', 'subtree_inactive')
+    ## shared by all operators rather than stored on each one
+    type = 'operator'
+    
+    ## Initialise the operator object
+    def __init__(self, id, parent, name):
+        Actor.__init__(self, id, parent, name)
+        
+        ## lie for operators. this just fixes some display stuff
+        self.active = True
+        
+        ## end of this operator's part of the tree order, and how many of
+        ## each thing are under it (set by the index)
+        self.exit = None
+        self.subtree_machines = 0
+        self.subtree_operators = 0
+        self.subtree_active = 0
+        self.subtree_inactive = 0
+        
+    ## Find all machines and operators under this one
+    def get_children(self, parent = None, type = 'all', recursive = False, active_only = False):
+        global actor_index
+        ## if no ID was passed, we are looking for nodes with this one as a parent
+        if parent == None:
+            parent = self.id
+        
+        ## everything under this one is already in order in the index
+        if recursive == True and parent == self.id:
+            children = actor_index.subtree(self, type = type)
+            if children != None:
+                if active_only == True:
+                    children = [actor for actor in children if actor.type == 'operator' or actor.active == True]
+                return children
+        
+        children = []
+        
+        ## go through the operators under this one
+        for operator in actor_index.child_operators(parent):
+            ## only add the operator if we are looking for ops too, 
+            ## otherwise just do children
+            if type == 'all' or type == 'operator':
+                children.append(operator)
+            
+            ## if we are are recursive, go deeper
+            if recursive == True:
+                children.extend(self.get_children(parent = operator.id, type = type, recursive = True, active_only = active_only))
+                    
+        ## if we are looking for all or machines..
+        if type == 'all' or type == 'machine':
+            ## go through the machines under this one
+            for machine in actor_index.child_machines(parent):
+                ## exclude inactive machines if specified
+                if (active_only == True and machine.active == True) or active_only == False:
+                    children.append(machine)
+                    
+        return children
+
+    ## convinience function - get all machines under this one
+    def get_machines(self, parent = None, recursive = False, active_only = False):
+        return self.get_children(parent = parent, type = 'machine', recursive = recursive, active_only = active_only)
+        
+    ## convinience function - get all operators under this one
+    def get_operators(self, parent = None, recursive = False):
+        return self.get_children(parent = parent, type = 'operator', recursive = recursive)
+    
+    ## Actor id to ask Nayax for the sales of this operator
+    def request_actor(self):
+        return self.id
+    
+    ## Number of machines in the response when this operator's sales are
+    ## requested
+    def request_machines(self):
+        return self.count_machines()
+
+    ## Number of machines under this one (at any depth), optionally only
+    ## the active ones
+    def count_machines(self, active_only = False):
+        global use_columnar_store
+        if use_columnar_store == True:
+            count = sales_columns.machine_count(self, active_only = active_only)
+            if count != None:
+                return count
+        
+        actor_index.check()
+        if self.entry == None:
+            return len(self.get_machines(recursive = True, active_only = active_only))
+        elif active_only == True:
+            actor_index.count_activity()
+            return self.subtree_active
+        else:
+            return self.subtree_machines
+    
+    ## Number of operators under this one (at any depth)
+    def count_operators(self):
+        actor_index.check()
+        if self.entry == None:
+            return len(self.get_operators(recursive = True))
+        return self.subtree_operators
+    
+    ## Number of machines under this one that were inactive for the period,
+    ## or if that isn't known, aren't active now
+    def count_inactive_machines(self):
+        actor_index.check()
+        if self.entry == None:
+            inactive = 0
+            for machine in self.get_machines(recursive = True):
+                if (machine.active == None and machine.active_now == False) or machine.active == False:
+                    inactive += 1
+            return inactive
+        actor_index.count_activity()
+        return self.subtree_inactive
+
+    ## get the parent of this operator
+    def get_parent(self):    
+        return actor_index.operator(self.parent)
+    
+    ## Returns sale count, amount for a source ('cash' or 'card') for all
+    ## machines under this one (None if none of them have sales data)
+    def get_sales(self, source):
+        global use_columnar_store
+        if use_columnar_store == True and sales_columns.span(self) != None:
+            return sales_columns.sales(self, source)
+        ## otherwise the totals are added up once for the whole tree and kept
+        ## until sales or the tree change
+        return actor_index.sales_rollup(self, source)
+        
+    ## Returns cash sale count, amount for all machines under this one
+    def get_cash_sales(self):
+        return self.get_sales('cash')
+        
+    ## Returns card sale count, amount for all machines under this one
+    def get_card_sales(self):
+        return self.get_sales('card')
+                   
+## On-disk cache of Nayax responses. Each response is a file named after a
+## hash of its key, starting with a line of JSON saying when it expires.
+## Files are touched when read so the oldest modified file is the least
+## recently used
+class ResponseCache():
+    ## Initialise the cache, creating the folder if needed
+    def __init__(self, path = None, max_bytes = None):
+        global cache_path, cache_max_bytes
+        if path == None:
+            path = cache_path
+        if max_bytes == None:
+            max_bytes = cache_max_bytes
+        
+        self.path = path
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        os.makedirs(self.path, exist_ok = True)
+        
+        ## work out how much is cached already
+        self.size = 0
+        for entry in os.scandir(self.path):
+            if entry.name.endswith('.cache'):
+                self.size += entry.stat().st_size
+    
+    ## File name for a key
+    def key_path(self, key):
+        return os.path.join(self.path, hashlib.sha1(key.encode('utf-8')).hexdigest() + '.cache')
+    
+    ## Open the cached text for a key to read it a bit at a time. Returns the
+    ## open file, or None if it isn't cached or has expired
+    def open(self, key):
+        file_path = self.key_path(key)
+        try:
+            file_socket = open(file_path, 'r', encoding = 'utf-8')
+        except OSError:
+            return None
+        
+        try:
+            header = json.loads(file_socket.readline())
+            ## a different key with the same hash
+            if header['key'] != key:
+                file_socket.close()
+                return None
+            expires = header['expires']
+        except (ValueError, KeyError):
+            file_socket.close()
+            return None
+            
+        if expires != None and expires < time.time():
+            file_socket.close()
+            self.remove(file_path)
+            return None
+        
+        ## mark as recently used
+        try:
+            os.utime(file_path)
+        except OSError:
+            pass
+        
+        return file_socket
+    
+    ## Get the cached text for a key, or None if it isn't cached or has expired
+    def get(self, key):
+        file_socket = self.open(key)
+        if file_socket == None:
+            return None
+            
+        with file_socket:
+            return file_socket.read()
+    
+    ## Start writing the text for a key a bit at a time. A ttl of None means
+    ## it never expires
+    def writer(self, key, ttl = None):
+        return CacheWriter(self, key, ttl)
+    
+    ## Cache the text for a key. A ttl of None means it never expires
+    def put(self, key, text, ttl = None):
+        writer = self.writer(key, ttl = ttl)
+        writer.write(text)
+        writer.commit()
+    
+    ## Move a finished temporary file in to place
+    def commit(self, key, temp_path):
+        file_path = self.key_path(key)
+        try:
+            with self.lock:
+                if os.path.exists(file_path):
+                    self.size -= os.path.getsize(file_path)
+                os.replace(temp_path, file_path)
+                self.size += os.path.getsize(file_path)
+        except OSError as e:
+            print('Could not cache ' + key + ': ' + str(e))
+            return
+        
+        if self.size > self.max_bytes:
+            self.evict()
+    
+    ## Remove a cached file
+    def remove(self, file_path):
+        with self.lock:
+            try:
+                size = os.path.getsize(file_path)
+                os.remove(file_path)
+                self.size -= size
+            except OSError:
+                pass
+    
+    ## Remove the least recently used files until we are back under 90% of
+    ## the maximum size
+    def evict(self):
+        entries = []
+        for entry in os.scandir(self.path):
+            if entry.name.endswith('.cache'):
+                stat = entry.stat()
+                entries.append([stat.st_mtime, entry.path])
+        
+        for mtime, file_path in sorted(entries):
+            if self.size <= self.max_bytes * 0.9:
+                break
+            self.remove(file_path)
+    
+## Writes a response to a temporary file, which only becomes part of the
+## cache once it is committed
+class CacheWriter():
+    ## Initialise the writer and open the temporary file
+    def __init__(self, cache, key, ttl = None):
+        self.cache = cache
+        self.key = key
+        self.temp_path = cache.key_path(key) + '.' + str(threading.get_ident()) + '.tmp'
+        
+        if ttl == None:
+            expires = None
+        else:
+            expires = time.time() + ttl
+        
+        try:
+            self.file_socket = open(self.temp_path, 'w', encoding = 'utf-8')
+            self.file_socket.write(json.dumps({'key': key, 'expires': expires}) + '\n')
+        except OSError as e:
+            print('Could not cache ' + key + ': ' + str(e))
+            self.file_socket = None
+    
+    ## Add some text
+    def write(self, text):
+        if self.file_socket != None:
+            self.file_socket.write(text)
+    
+    ## Finish writing and add it to the cache
+    def commit(self):
+        if self.file_socket != None:
+            self.file_socket.close()
+            self.file_socket = None
+            self.cache.commit(self.key, self.temp_path)
+    
+    ## Throw away what has been written
+    def abort(self):
+        if self.file_socket != None:
+            self.file_socket.close()
+            self.file_socket = None
+            try:
+                os.remove(self.temp_path)
+            except OSError:
+                pass
+
+## SQLite store of everything known about the fleet. Uses write-ahead logging
+## so reads aren't blocked by writes, and is written a job at a time in one
+## transaction. One connection is shared by all threads
+class FleetStore():
+    ## tables and indexes
+    schema = [
+        'CREATE TABLE IF NOT EXISTS operators (id INTEGER PRIMARY KEY, parent INTEGER NOT NULL, name TEXT, active_now INTEGER, listed REAL)',
+        'CREATE INDEX IF NOT EXISTS operators_parent ON operators (parent)',
+        'CREATE TABLE IF NOT EXISTS machines (id INTEGER PRIMARY KEY, parent INTEGER NOT NULL, name TEXT, active_now INTEGER, dtu TEXT, vpos TEXT, sim TEXT, rssi, fw_dtu TEXT, fw_vpos TEXT, listed REAL)',
+        'CREATE INDEX IF NOT EXISTS machines_parent ON machines (parent)',
+        ## sales per machine and source ('cash' or 'card') for a period, and
+        ## the operators whose sales have been stored for the period
+        'CREATE TABLE IF NOT EXISTS sales (period_start TEXT, period_end TEXT, machine_id INTEGER, source TEXT, count INTEGER, amount REAL, PRIMARY KEY (period_start, period_end, machine_id, source)) WITHOUT ROWID',
+        'CREATE INDEX IF NOT EXISTS sales_machine ON sales (machine_id)',
+        'CREATE TABLE IF NOT EXISTS sales_periods (period_start TEXT, period_end TEXT, actor_id INTEGER, fetched REAL, expires REAL, PRIMARY KEY (period_start, period_end, actor_id)) WITHOUT ROWID',
+        ## machine status changes from the machine history, and when each
+        ## history was last checked for newer ones
+        'CREATE TABLE IF NOT EXISTS history_events (machine_id INTEGER, updated_at TEXT, changed_to TEXT)',
+        'CREATE INDEX IF NOT EXISTS history_events_machine ON history_events (machine_id, updated_at)',
+        'CREATE TABLE IF NOT EXISTS histories (machine_id INTEGER PRIMARY KEY, fetched REAL, expires REAL)',
+        'CREATE TABLE IF NOT EXISTS product_maps (machine_id INTEGER PRIMARY KEY, fetched REAL, json TEXT)',
+        ## the last timed sales request for each actor and payment method
+        'CREATE TABLE IF NOT EXISTS request_costs (actor_id INTEGER, payment_method INTEGER, machines INTEGER, rows INTEGER, size INTEGER, seconds REAL, recorded REAL, PRIMARY KEY (actor_id, payment_method))',
+    ]
+    
+    ## Open (or create) the store
+    def __init__(self, path = None):
+        global fleet_store_path
+        if path == None:
+            path = fleet_store_path
+        
+        self.path = path
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread = False)
+        with self.lock:
+            self.connection.execute('PRAGMA journal_mode = WAL')
+            self.connection.execute('PRAGMA synchronous = NORMAL')
+            with self.connection:
+                for statement in self.schema:
+                    self.connection.execute(statement)
+    
+    ## Close the store
+    def close(self):
+        with self.lock:
+            self.connection.close()
+    
+    ## Expiry time for something that can be kept for ttl seconds (None for
+    ## forever)
+    def expiry(self, ttl):
+        if ttl == None:
+            return None
+        else:
+            return time.time() + ttl
+    
+    ## Save the machine and operator lists, replacing the old ones. Machine
+    ## details (serials, firmware etc.) are kept
+    def save_fleet(self, operators, machines):
+        now = time.time()
+        with self.lock, self.connection:
+            self.connection.executemany('INSERT INTO operators (id, parent, name, active_now, listed) VALUES (?, ?, ?, ?, ?) ON CONFLICT (id) DO UPDATE SET parent = excluded.parent, name = excluded.name, active_now = excluded.active_now, listed = excluded.listed', [(operator.id, operator.parent, operator.name, operator.active_now, now) for operator in operators])
+            self.connection.executemany('INSERT INTO machines (id, parent, name, active_now, listed) VALUES (?, ?, ?, ?, ?) ON CONFLICT (id) DO UPDATE SET parent = excluded.parent, name = excluded.name, active_now = excluded.active_now, listed = excluded.listed', [(machine.id, machine.parent, machine.name, machine.active_now, now) for machine in machines])
+            ## anything that wasn't listed this time has gone
+            self.connection.execute('DELETE FROM operators WHERE listed < ?', (now, ))
+            self.connection.execute('DELETE FROM machines WHERE listed < ?', (now, ))
+    
+    ## Fill in the details of machines that aren't known yet from the store
+    def load_machine_details(self, machines):
+        with self.lock:
+            rows = self.connection.execute('SELECT id, dtu, vpos, sim, rssi, fw_dtu, fw_vpos FROM machines WHERE dtu IS NOT NULL OR vpos IS NOT NULL').fetchall()
+        
+        details = {}
+        for row in rows:
+            details[row[0]] = row
+        for machine in machines:
+            row = details.get(machine.id)
+            if row == None or machine.dtu != None:
+                continue
+            machine.dtu, machine.vpos, machine.sim, machine.rssi = row[1], row[2], row[3], row[4]
+            machine.fw_dtu = intern_text(row[5])
+            machine.fw_vpos = intern_text(row[6])
+    
+    ## Save the sales for a period. Rows are [machine id, source, count,
+    ## amount], details are [machine id, dtu, vpos, sim, rssi, dtu firmware,
+    ## vpos firmware] and actor_ids are the operators whose sales are all
+    ## there. ttl is how long they can be reused for (None for forever)
+    def save_sales(self, start, end, rows, details, actor_ids, ttl = None):
+        now = time.time()
+        expires = self.expiry(ttl)
+        with self.lock, self.connection:
+            self.connection.executemany('INSERT OR REPLACE INTO sales (period_start, period_end, machine_id, source, count, amount) VALUES (?, ?, ?, ?, ?, ?)', [(start, end, machine_id, source, count, amount) for machine_id, source, count, amount in rows])
+            self.connection.executemany('UPDATE machines SET dtu = ?, vpos = ?, sim = ?, rssi = ?, fw_dtu = ?, fw_vpos = ? WHERE id = ?', [(dtu, vpos, sim, rssi, fw_dtu, fw_vpos, machine_id) for machine_id, dtu, vpos, sim, rssi, fw_dtu, fw_vpos in details])
+            self.connection.executemany('INSERT OR REPLACE INTO sales_periods (period_start, period_end, actor_id, fetched, expires) VALUES (?, ?, ?, ?, ?)', [(start, end, actor_id, now, expires) for actor_id in actor_ids])
+    
+    ## The operators (of those given) whose sales for a period are stored and
+    ## haven't expired
+    def stored_sales_operators(self, start, end, actor_ids):
+        with self.lock:
+            rows = self.connection.execute('SELECT actor_id FROM sales_periods WHERE period_start = ? AND period_end = ? AND (expires IS NULL OR expires > ?)', (start, end, time.time())).fetchall()
+        
+        wanted = set(actor_ids)
+        stored = set()
+        for row in rows:
+            if row[0] in wanted:
+                stored.add(row[0])
+        return stored
+    
+    ## The stored sales for a period, as [machine id, source, count, amount]
+    def load_sales(self, start, end):
+        with self.lock:
+            return self.connection.execute('SELECT machine_id, source, count, amount FROM sales WHERE period_start = ? AND period_end = ?', (start, end)).fetchall()
+    
+    ## Save the status events that are new since the machine histories were
+    ## last checked. Histories is machine id -> [fetched, expires, list of
+    ## [time, status]], with an empty list if nothing has changed
+    def save_histories(self, histories):
+        with self.lock, self.connection:
+            for machine_id, (fetched, expires, events) in histories.items():
+                self.connection.executemany('INSERT INTO history_events (machine_id, updated_at, changed_to) VALUES (?, ?, ?)', [(machine_id, stamp.strftime('%Y-%m-%dT%H:%M:%S'), event) for stamp, event in events])
+            self.connection.executemany('INSERT OR REPLACE INTO histories (machine_id, fetched, expires) VALUES (?, ?, ?)', [(machine_id, fetched, expires) for machine_id, (fetched, expires, events) in histories.items()])
+    
+    ## The stored status events of every machine, as [machine id, time,
+    ## status] in machine and time order, and the histories they came from,
+    ## as [machine id, fetched, expires]
+    def load_histories(self):
+        with self.lock:
+            events = self.connection.execute('SELECT machine_id, updated_at, changed_to FROM history_events ORDER BY machine_id, updated_at').fetchall()
+            histories = self.connection.execute('SELECT machine_id, fetched, expires FROM histories').fetchall()
+        return events, histories
+    
+    ## Save product map JSON (as returned by get_product_map_json)
+    def save_product_maps(self, json_data):
+        now = time.time()
+        rows = []
+        for data in json_data:
+            try:
+                rows.append((int(data['data'][0]['machine_id']), now, json.dumps(data)))
+            ## maps with nothing in them don't say which machine they are for
+            except (KeyError, IndexError, TypeError, ValueError):
+                continue
+        
+        with self.lock, self.connection:
+            self.connection.executemany('INSERT OR REPLACE INTO product_maps (machine_id, fetched, json) VALUES (?, ?, ?)', rows)
+    
+    ## Forget the product map of a machine (e.g. because it has been changed)
+    def forget_product_map(self, machine_id):
+        with self.lock, self.connection:
+            self.connection.execute('DELETE FROM product_maps WHERE machine_id = ?', (machine_id, ))
+    
+    ## Save timed sales requests, as [actor id, payment method, machines,
+    ## rows, size, seconds]
+    def save_request_costs(self, costs):
+        now = time.time()
+        with self.lock, self.connection:
+            self.connection.executemany('INSERT OR REPLACE INTO request_costs (actor_id, payment_method, machines, rows, size, seconds, recorded) VALUES (?, ?, ?, ?, ?, ?, ?)', [tuple(cost) + (now, ) for cost in costs])
+    
+    ## The timed sales requests, as [actor id, payment method, machines,
+    ## rows, size, seconds]
+    def load_request_costs(self):
+        with self.lock:
+            return self.connection.execute('SELECT actor_id, payment_method, machines, rows, size, seconds FROM request_costs').fetchall()
+
+## Incremental parser for SalesSummary_Report responses. Text is fed in as it
+## arrives and the machine rows (data[1]) come back as soon as each one is
+## complete, so the whole response never has to be held in memory
+class SalesRowParser():
+    ## the start of the data list
+    regexp_data = re.compile(r'"data"\s*:\s*\[')
+    
+    ## Initialise the parser
+    def __init__(self):
+        self.decoder = json.JSONDecoder()
+        self.buffer = ''
+        ## key -> first -> after_first -> rows_open -> row <-> after_row -> done
+        self.state = 'key'
+    
+    ## Add some text, returning the list of rows completed by it
+    def feed(self, text):
+        buffer = self.buffer + text
+        position = 0
+        rows = []
+        
+        while True:
+            ## look for the data list, keeping the end of the buffer in case
+            ## it is split across chunks
+            if self.state == 'key':
+                match = self.regexp_data.search(buffer, position)
+                if match:
+                    position = match.end()
+                    self.state = 'first'
+                    continue
+                else:
+                    position = max(position, len(buffer) - 64)
+                    break
+            
+            ## skip whitespace, then stop if we need more text
+            while position < len(buffer) and buffer[position] in ' \t\r\n':
+                position += 1
+            if position >= len(buffer) or self.state == 'done':
+                position = len(buffer)
+                break
+            
+            character = buffer[position]
+            
+            ## a value (the summary or a row), or the end of the list
+            if self.state == 'first' or self.state == 'row':
+                if character == ']':
+                    position += 1
+                    self.state = 'done'
+                    continue
+                    
+                try:
+                    value, position = self.decoder.raw_decode(buffer, position)
+                ## incomplete, so wait for more
+                except ValueError:
+                    break
+                
+                if self.state == 'row':
+                    rows.append(value)
+                    self.state = 'after_row'
+                else:
+                    self.state = 'after_first'
+            ## after the summary comes the list of rows
+            elif self.state == 'after_first':
+                position += 1
+                if character == ',':
+                    self.state = 'rows_open'
+                elif character == ']':
+                    self.state = 'done'
+                else:
+                    raise ValueError('Unexpected ' + character + ' after the sales summary')
+            elif self.state == 'rows_open':
+                position += 1
+                if character == '[':
+                    self.state = 'row'
+                else:
+                    raise ValueError('Expected the list of sales rows but got ' + character)
+            ## rows are separated by commas
+            elif self.state == 'after_row':
+                position += 1
+                if character == ',':
+                    self.state = 'row'
+                elif character == ']':
+                    self.state = 'done'
+                else:
+                    raise ValueError('Unexpected ' + character + ' between sales rows')
+        
+        ## only keep what hasn't been parsed yet
+        self.buffer = buffer[position:]
+        return rows
+    
+    ## Check that the whole list of rows was read
+    def close(self):
+        if self.state != 'done':
+            raise ValueError('Sales summary ended before all of the rows were read')
+
+## Parser for the Machines_Search XML that makes machines and operators as
+## chunks of the response are fed to it, whatever order the attributes are in.
+## No document tree is kept, so memory use doesn't grow with the size of the
+## response
+class MachineListParser():
+    ## machine activity colours, and whether they mean active now
+    colours = {'color_green': True, 'color_red': True, 'color_gray': False}
+    ## characters that are removed from names
+    regexp_name = re.compile(r'[^\w\s\-\.\&\'\/\(\)]')
+    ## the old regular expressions, which need the attributes in a fixed order
+    regexp_machine = re.compile(r'parent_id=\"(\d+)\" title=\"([^<>"]+)\" machine_id=\"(\d+)\"[^<>]+activity_color=\"color_((green)|(red)|(gray))\"')
+    regexp_operator = re.compile(r'id=\"(\d+)\" parent_id=\"(\d+)\" title=\"([^<>"]+)\" actor_type_id=\"\d+\"(\sdisabled=\"(1)\")?')
+    
+    ## Initialise the parser
+    def __init__(self):
+        self.parser = xml.parsers.expat.ParserCreate()
+        self.parser.buffer_text = True
+        self.parser.StartElementHandler = self.start_element
+        ## actors completed since the last feed
+        self.actors = []
+    
+    ## Clean foreign characters from a name. Entities have already been
+    ## decoded by the XML parser
+    def clean_name(self, name):
+        return self.regexp_name.sub('', name)
+    
+    ## Make a machine or operator from the attributes of an element. None if
+    ## it is neither
+    def make_actor(self, attributes):
+        title = attributes.get('title')
+        if title == None or title == '' or attributes.get('parent_id') == None:
+            return None
+        
+        try:
+            if 'machine_id' in attributes:
+                active_now = self.colours.get(attributes.get('activity_color'))
+                if active_now == None:
+                    return None
+                actor = Machine(attributes['machine_id'], attributes['parent_id'], self.clean_name(title))
+                actor.active_now = active_now
+            elif 'id' in attributes and 'actor_type_id' in attributes:
+                actor = Operator(attributes['id'], attributes['parent_id'], self.clean_name(title))
+                if attributes.get('disabled') == '1':
+                    actor.active_now = False
+                else:
+                    actor.active_now = True
+            else:
+                return None
+        ## ids that aren't numbers
+        except ValueError:
+            return None
+        
+        return actor
+    
+    ## Called by the XML parser for each element
+    def start_element(self, name, attributes):
+        actor = self.make_actor(attributes)
+        if actor != None:
+            self.actors.append(actor)
+    
+    ## Add some of the response (bytes), returning the machines and operators
+    ## completed by it. Raises xml.parsers.expat.ExpatError if it isn't XML
+    def feed(self, data, final = False):
+        self.parser.Parse(data, final)
+        actors = self.actors
+        self.actors = []
+        return actors
+    
+    ## Finish parsing, returning anything left
+    def close(self):
+        return self.feed(b'', final = True)
+    
+    ## Get the machines and operators from the whole response text with the
+    ## old regular expressions. Used when the response isn't well formed XML
+    def parse_text(self, text):
+        actors = []
+        
+        ## find machines
+        for match in self.regexp_machine.finditer(text):
+            machine = Machine(match.group(3), match.group(1), self.clean_name(match.group(2).replace('&amp;', '&')))
+            ## work out if the machine is currently active
+            if match.group(4) == 'green' or match.group(4) == 'red':
+                machine.active_now = True
+            else:
+                machine.active_now = False
+            actors.append(machine)
+        
+        ## find operators
+        for match in self.regexp_operator.finditer(text):
+            operator = Operator(match.group(1), match.group(2), self.clean_name(match.group(3).replace('&amp;', '&')))
+            if match.group(5) == '1':
+                operator.active_now = False
+            else:
+                operator.active_now = True
+            actors.append(operator)
+        
+        return actors
+    
+## AIMD (additive increase, multiplicative decrease) concurrency limiter for
+## requests. The limit creeps up while response times stay flat, and is
+## halved on connection errors, server errors or latency spikes
+class AdaptiveLimiter():
+    ## Initialise the limiter. Limits default to the global worker counts
+    def __init__(self, initial = None, minimum = None, maximum = None):
+        global worker_count, worker_count_min, worker_count_max
+        if initial == None:
+            initial = worker_count
+        if minimum == None:
+            minimum = worker_count_min
+        if maximum == None:
+            maximum = worker_count_max
+        
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.in_flight = 0
+        self.condition = threading.Condition()
+        
+        ## a response this many times slower than normal is a spike
+        self.spike_factor = 3
+        ## normal (smoothed) response time for each kind of request
+        self.baseline = {}
+        ## when we last backed off, so one bad moment only halves once
+        self.last_decrease = 0
+        ## [loop, future] for asyncio requests waiting for room
+        self.async_waiters = []
+    
+    ## Current limit as a whole number of requests
+    def current_limit(self):
+        return int(self.limit)
+    
+    ## Text to add to progress messages
+    def describe(self):
+        return ' (concurrency ' + str(self.current_limit()) + ')'
+    
+    ## Wait until there is room for another request
+    def acquire(self):
+        with self.condition:
+            while self.in_flight >= self.current_limit():
+                self.condition.wait()
+            self.in_flight += 1
+    
+    ## Wait until there is room for another request, from a coroutine on an
+    ## asyncio loop (without blocking the loop)
+    async def acquire_async(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            with self.condition:
+                if self.in_flight < self.current_limit():
+                    self.in_flight += 1
+                    return
+                waiter = loop.create_future()
+                self.async_waiters.append([loop, waiter])
+            await waiter
+    
+    ## Wake as many waiting coroutines as there is room for. Called with the
+    ## condition held
+    def wake_async_waiters(self):
+        room = self.current_limit() - self.in_flight
+        while room > 0 and len(self.async_waiters) > 0:
+            loop, waiter = self.async_waiters.pop(0)
+            loop.call_soon_threadsafe(self.wake_waiter, waiter)
+            room -= 1
+    
+    ## Let a waiting coroutine try again (on its own loop). If it has been
+    ## cancelled, someone else gets the chance instead
+    def wake_waiter(self, waiter):
+        if waiter.done() == False:
+            waiter.set_result(None)
+        else:
+            with self.condition:
+                self.wake_async_waiters()
+    
+    ## Finish a request, adjusting the limit based on how it went. The limit
+    ## only goes up if it was reached, since going well with room to spare
+    ## says nothing about whether more would
+    def release(self, kind, latency = None, failed = False):
+        global limiter_unmeasured_actions
+        with self.condition:
+            self.in_flight -= 1
+            reached = self.in_flight + 1 >= self.current_limit()
+            
+            if failed == True:
+                self.decrease()
+            elif latency != None and kind not in limiter_unmeasured_actions:
+                baseline = self.baseline.get(kind)
+                if baseline == None:
+                    self.baseline[kind] = latency
+                elif latency > baseline * self.spike_factor:
+                    self.decrease()
+                else:
+                    ## latency is flat, so try one more request per round
+                    self.baseline[kind] = baseline * 0.9 + latency * 0.1
+                    if reached == True:
+                        self.increase()
+            ## it worked, but its time doesn't say anything about the load
+            elif reached == True:
+                self.increase()
+            
+            self.condition.notify_all()
+            self.wake_async_waiters()
+    
+    ## Give a slot back without having made the request, leaving the limit
+    ## as it is
+    def give_back(self):
+        with self.condition:
+            self.in_flight -= 1
+            self.condition.notify_all()
+            self.wake_async_waiters()
+    
+    ## Try one more request per round
+    def increase(self):
+        self.limit = min(self.maximum, self.limit + 1 / self.limit)
+    
+    ## Halve the limit, at most once per second
+    def decrease(self):
+        now = time.time()
+        if now - self.last_decrease < 1:
+            return
+        self.last_decrease = now
+        self.limit = max(self.minimum, self.limit / 2)
+    
+## Token bucket rate limiter (GCRA). Each request reserves the next slot
+## in turn, so requests wait their turn in order rather than failing or
+## racing each other for tokens
+class TokenBucket():
+    ## Initialise the bucket. Rate is in requests per second (None for no
+    ## limit) and burst is how many can go at once after a quiet spell
+    def __init__(self, rate = None, burst = 1):
+        self.rate = rate
+        self.burst = max(1, burst)
+        self.lock = threading.Lock()
+        ## theoretical arrival time of the next request
+        self.next_time = 0
+    
+    ## Reserve a slot for a request. Returns the seconds to wait before
+    ## sending it
+    def reserve(self):
+        if self.rate == None:
+            return 0
+        
+        interval = 1 / self.rate
+        with self.lock:
+            now = time.monotonic()
+            arrival = max(self.next_time, now)
+            self.next_time = arrival + interval
+            return max(0, arrival - interval * (self.burst - 1) - now)
+    
+    ## Wait for a slot
+    def acquire(self):
+        delay = self.reserve()
+        if delay > 0:
+            time.sleep(delay)
+    
+## A read request that is in flight. Other threads wanting the same thing
+## wait for it instead of making their own request
+class RequestFlight():
+    ## Initialise the flight
+    def __init__(self):
+        self.event = threading.Event()
+        self.response = None
+        self.error = None
+    
+    ## Pass the outcome on to anyone waiting
+    def finish(self, response = None, error = None):
+        self.response = response
+        self.error = error
+        self.event.set()
+    
+    ## Wait for the request to finish and return its response (or raise its
+    ## error)
+    def wait(self):
+        self.event.wait()
+        if self.error != None:
+            raise self.error
+        return self.response
+    
+## Status changes of every machine whose history has been checked, held as
+## sorted event times so that whether a machine was active in any period can
+## be answered with a binary search instead of downloading its history again
+class ActivityIndex():
+    ## Initialise the index with any histories in the store
+    def __init__(self, store = None):
+        ## machine id -> [event times, statuses] (oldest first), and machine
+        ## id -> [fetched, expires] for when its history was last checked
+        self.events = {}
+        self.checked = {}
+        self.lock = threading.Lock()
+        if store != None:
+            events, histories = store.load_histories()
+            for machine_id, fetched, expires in histories:
+                self.events[machine_id] = [[], []]
+                self.checked[machine_id] = [fetched, expires]
+            for machine_id, updated_at, changed_to in events:
+                times, statuses = self.events.setdefault(machine_id, [[], []])
+                times.append(datetime.datetime.fromisoformat(updated_at))
+                statuses.append(changed_to)
+    
+    ## Add the status events ([time, status]) from a history that has just
+    ## been checked. Only the events that aren't older than the ones already
+    ## known, and aren't known already, are added. ttl is how long the
+    ## history is up to date for. Returns the new events
+    def add(self, machine_id, events, ttl = None):
+        now = time.time()
+        expires = None
+        if ttl != None:
+            expires = now + ttl
+        
+        added = []
+        with self.lock:
+            times, statuses = self.events.setdefault(machine_id, [[], []])
+            latest = None
+            known = set()
+            if len(times) > 0:
+                latest = times[-1]
+                ## events at the same time as the latest one can still be new
+                first = bisect.bisect_left(times, latest)
+                known = set(zip(times[first:], statuses[first:]))
+            for stamp, status in sorted(events):
+                if (latest != None and stamp < latest) or (stamp, status) in known:
+                    continue
+                known.add((stamp, status))
+                times.append(stamp)
+                statuses.append(status)
+                added.append([stamp, status])
+            self.checked[machine_id] = [now, expires]
+        return added
+    
+    ## Returns true if the history of a machine is known well enough to
+    ## answer for a period that finishes at period_end (a datetime). That is
+    ## when it was checked after the period finished, or hasn't expired
+    def is_current(self, machine_id, period_end):
+        checked = self.checked.get(machine_id)
+        if checked == None:
+            return False
+        fetched, expires = checked
+        if expires == None or expires > time.time():
+            return True
+        return datetime.datetime.fromtimestamp(fetched) >= period_end
+    
+    ## Finds out if a machine was active between start and end (datetimes).
+    ## Nayax histories are often missing events, so a status change in the
+    ## period, a change to active before it or a change to not active after
+    ## it all mean it was active. Machines without any events are taken to
+    ## have had their current status all along. None if the history isn't
+    ## known
+    def was_active(self, machine_id, start, end, active_now = None):
+        ## the times and statuses are added to one after the other, so they
+        ## are only read together with the lock held
+        with self.lock:
+            entry = self.events.get(machine_id)
+            if entry == None:
+                return None
+            times, statuses = entry
+            if len(times) == 0:
+                return active_now == True
+            
+            first = bisect.bisect_left(times, start)
+            after = bisect.bisect_right(times, end)
+            if after > first:
+                return True
+            elif first > 0 and statuses[first - 1] == 'Active':
+                return True
+            elif after < len(times) and statuses[after] == 'Not Active':
+                return True
+            return False
+    
+## The machines directly under an operator, as a piece of a sales plan when
+## the operators under it are requested on their own. Nayax can only be asked
+## for everything under the operator, so only the rows for these machines are
+## applied from the response. The id is the operator's id negated, so that
+## the store doesn't take the whole operator as done
+class DirectMachines():
+    type = 'direct'
+    
+    ## Initialise with the operator the machines are under
+    def __init__(self, operator):
+        self.operator = operator
+        self.id = -operator.id
+        self.parent = operator.id
+        self.name = str(operator.name) + ' (own machines)'
+        self.entry = operator.entry
+    
+    ## The machines directly under the operator
+    def get_machines(self, recursive = False, active_only = False):
+        global actor_index
+        machines = actor_index.child_machines(self.operator.id)
+        if active_only == True:
+            machines = [machine for machine in machines if machine.active == True]
+        return machines
+    
+    ## Number of machines directly under the operator
+    def count_machines(self, active_only = False):
+        return len(self.get_machines(active_only = active_only))
+    
+    ## Actor id to ask Nayax for the sales of these machines
+    def request_actor(self):
+        return self.operator.id
+    
+    ## Number of machines in the response, which is everything under the
+    ## operator
+    def request_machines(self):
+        return self.operator.count_machines()
+
+## Estimates how long sales requests will take, from the number of machines
+## under the actor and the sizes and times of past requests, and uses that to
+## choose which actors to request
+class SalesPlanner():
+    ## Initialise the planner with any timed requests from the store
+    def __init__(self, store = None):
+        ## (actor id, payment method) -> [machines, rows, size, seconds]
+        self.costs = {}
+        self.lock = threading.Lock()
+        if store != None:
+            for actor_id, payment_method, machines, rows, size, seconds in store.load_request_costs():
+                self.costs[(actor_id, payment_method)] = [machines, rows, size, seconds]
+        self.fit()
+    
+    ## Note how a sales request went
+    def record(self, actor_id, payment_method, machines, rows, size, seconds):
+        with self.lock:
+            self.costs[(actor_id, payment_method)] = [machines, rows, size, seconds]
+    
+    ## Work out the seconds per request, seconds per machine and size per
+    ## machine from the timed requests (a least squares line through the
+    ## times). Falls back to the defaults without enough to go on
+    def fit(self):
+        global sales_request_overhead, sales_request_per_machine
+        with self.lock:
+            costs = list(self.costs.values())
+        
+        self.overhead = sales_request_overhead
+        self.per_machine = sales_request_per_machine
+        self.size_per_machine = None
+        
+        machines = [cost[0] for cost in costs]
+        if sum(machines) > 0:
+            self.size_per_machine = sum(cost[2] for cost in costs) / sum(machines)
+        if len(costs) < 2:
+            return
+        
+        count = len(costs)
+        mean_machines = sum(machines) / count
+        mean_seconds = sum(cost[3] for cost in costs) / count
+        spread = sum((cost[0] - mean_machines) ** 2 for cost in costs)
+        if spread == 0:
+            return
+        slope = sum((cost[0] - mean_machines) * (cost[3] - mean_seconds) for cost in costs) / spread
+        ## times only go up with more machines, and every request costs
+        ## something
+        self.per_machine = max(slope, 0)
+        self.overhead = max(mean_seconds - self.per_machine * mean_machines, 0.01)
+    
+    ## Estimated seconds for one request (cash or card) for an operator. An
+    ## operator that has been timed before is scaled from its own time
+    def estimate_method(self, operator, payment_method, machines = None):
+        ## the machines directly under an operator cost a request for it
+        if operator.type == 'direct':
+            operator = operator.operator
+            machines = None
+        if machines == None:
+            machines = operator.count_machines()
+        
+        cost = self.costs.get((operator.id, payment_method))
+        if cost != None and cost[0] > 0 and machines > 0:
+            return max(cost[3] * machines / cost[0], self.overhead)
+        elif cost != None and cost[0] == machines:
+            return cost[3]
+        else:
+            return self.overhead + self.per_machine * machines
+    
+    ## Estimated seconds for the cash and card requests of an operator
+    def estimate(self, operator, machines = None):
+        if operator.type == 'direct':
+            operator = operator.operator
+            machines = None
+        if machines == None:
+            machines = operator.count_machines()
+        return self.estimate_method(operator, 3, machines) + self.estimate_method(operator, 1, machines)
+    
+    ## Estimated size of the cash and card responses of an operator, or None
+    ## if no responses have been measured
+    def estimate_size(self, operator, machines = None):
+        if self.size_per_machine == None:
+            return None
+        if operator.type == 'direct':
+            operator = operator.operator
+            machines = None
+        if machines == None:
+            machines = operator.count_machines()
+        return 2 * self.size_per_machine * machines
+    
+    ## Returns true if an operator can be requested as its child operators
+    ## instead (plus a request for the machines directly under it, if there
+    ## are any)
+    def can_split(self, operator):
+        global actor_index
+        return operator.type == 'operator' and len(actor_index.child_operators(operator.id)) > 0
+    
+    ## The pieces an operator is requested as when it is split: its child
+    ## operators that have machines, and the machines directly under it
+    def split_pieces(self, operator):
+        global actor_index
+        pieces = [child for child in actor_index.child_operators(operator.id) if child.count_machines() > 0]
+        if len(actor_index.child_machines(operator.id)) > 0:
+            pieces.append(DirectMachines(operator))
+        return pieces
+    
+    ## Number of date shards a piece is requested in. A piece that can't be
+    ## split any further but has more than sales_request_max_machines
+    ## machines in its response is split up by date instead
+    def shards(self, piece):
+        global sales_request_max_machines
+        if self.can_split(piece) == True:
+            return 1
+        return max(-(-piece.request_machines() // sales_request_max_machines), 1)
+    
+    ## Estimated seconds of each request for the pieces (piece -> estimated
+    ## seconds), with the date shards of a piece sharing its time
+    def piece_seconds(self, pieces):
+        seconds = []
+        for piece, estimate in pieces.items():
+            shards = self.shards(piece)
+            seconds.extend([estimate / shards] * shards)
+        return seconds
+    
+    ## Make a plan for requesting everything under an operator with a number
+    ## of requests running at once. Starting from the operator itself, the
+    ## most expensive request that can be split is split into its children
+    ## for as long as that brings the estimated finish time down
+    def plan(self, root, workers):
+        global actor_index, sales_request_max_machines
+        self.fit()
+        workers = max(int(workers), 1)
+        
+        ## operator -> estimated seconds
+        pieces = {root: self.estimate(root)}
+        finished = set()
+        makespan = SalesPlan.estimate_makespan(self.piece_seconds(pieces), workers)
+        while True:
+            candidates = [operator for operator in pieces if operator not in finished and self.can_split(operator)]
+            if len(candidates) == 0:
+                break
+            operator = max(candidates, key = lambda candidate: pieces[candidate])
+            ## too big to request in one go, whatever it costs to split
+            oversized = [candidate for candidate in candidates if candidate.count_machines() > sales_request_max_machines]
+            if len(oversized) > 0:
+                operator = max(oversized, key = lambda candidate: candidate.count_machines())
+            
+            children = self.split_pieces(operator)
+            split = dict(pieces)
+            del split[operator]
+            for child in children:
+                split[child] = self.estimate(child)
+            
+            ## an operator with only one child is the same request, and the
+            ## child may be worth splitting
+            split_makespan = SalesPlan.estimate_makespan(self.piece_seconds(split), workers)
+            if len(children) == 1 or len(oversized) > 0 or (len(children) > 1 and split_makespan < makespan):
+                pieces = split
+                makespan = split_makespan
+            else:
+                finished.add(operator)
+        
+        entries = []
+        for operator, seconds in pieces.items():
+            entries.append([operator, operator.count_machines(), seconds, self.estimate_size(operator), self.shards(operator)])
+        ## in tree order, like the old plans
+        entries.sort(key = lambda entry: entry[0].entry if entry[0].entry != None else -1)
+        return SalesPlan(root, entries, workers, self)
+
+## A plan for getting the sales under an operator: the operators to request,
+## with the number of machines, the estimated seconds and size, and the
+## number of date shards of each
+class SalesPlan():
+    ## Initialise the plan
+    def __init__(self, root, entries, workers, planner):
+        self.root = root
+        self.entries = entries
+        self.workers = workers
+        self.planner = planner
+        self.overhead = planner.overhead
+        self.per_machine = planner.per_machine
+    
+    ## Estimated time to finish requests taking the given seconds with a
+    ## number running at once, longest first
+    @staticmethod
+    def estimate_makespan(seconds, workers):
+        finish_times = [0] * min(workers, max(len(seconds), 1))
+        for cost in sorted(seconds, reverse = True):
+            finish_times.sort()
+            finish_times[0] += cost
+        return max(finish_times)
+    
+    ## The operators to request
+    def operators(self):
+        return [entry[0] for entry in self.entries]
+    
+    ## Number of machines covered by the plan
+    def machine_count(self):
+        return sum(entry[1] for entry in self.entries)
+    
+    ## Returns true if every machine under the root is covered exactly once
+    def is_exact(self):
+        machine_ids = set()
+        for entry in self.entries:
+            for machine in entry[0].get_machines(recursive = True):
+                if machine.id in machine_ids:
+                    return False
+                machine_ids.add(machine.id)
+        return len(machine_ids) == self.root.count_machines()
+    
+    ## Estimated total seconds of the requests
+    def total_seconds(self):
+        return sum(entry[2] for entry in self.entries)
+    
+    ## Estimated seconds to finish the requests
+    def makespan(self):
+        return self.estimate_makespan([task[2] for task in self.tasks()], self.workers)
+    
+    ## Split a window ((start, end) dates) into a number of date shards of
+    ## whole days, as even as they can be
+    @staticmethod
+    def shard_window(window, shards):
+        start = datetime.datetime.strptime(window[0], '%Y-%m-%d').date()
+        days = (datetime.datetime.strptime(window[1], '%Y-%m-%d').date() - start).days + 1
+        shards = min(shards, days)
+        windows = []
+        for shard in range(shards):
+            shard_start = start + datetime.timedelta(days = days * shard // shards)
+            shard_end = start + datetime.timedelta(days = days * (shard + 1) // shards - 1)
+            windows.append((shard_start.strftime('%Y-%m-%d'), shard_end.strftime('%Y-%m-%d')))
+        return windows
+    
+    ## The tasks for the workers, longest first, as [operator, payment
+    ## methods, estimated seconds, window]. Only the given operators are
+    ## included if there are any. With date windows ([start, end] pairs)
+    ## there is a task for each window, estimated by its share of the days,
+    ## and operators with date shards have a task for each shard of it.
+    ## The cash and card requests for an operator are separate tasks if
+    ## together they would take more than a fair share of the time, or if
+    ## there are workers to spare
+    def tasks(self, operators = None, windows = None):
+        global sales_request_max_machines
+        entries = [entry for entry in self.entries if operators == None or entry[0] in operators]
+        fair_share = sum(entry[2] for entry in entries) / self.workers
+        
+        if windows == None:
+            windows = [None]
+        days = []
+        for window in windows:
+            if window == None:
+                days.append(1)
+            else:
+                days.append((datetime.datetime.strptime(window[1], '%Y-%m-%d') - datetime.datetime.strptime(window[0], '%Y-%m-%d')).days + 1)
+        
+        tasks = []
+        for window, window_days in zip(windows, days):
+            share = window_days / sum(days)
+            for operator, machines, seconds, size, shards in entries:
+                if window == None:
+                    shard_windows = [None] * shards
+                else:
+                    shard_windows = self.shard_window(window, shards)
+                    if len(shard_windows) < shards:
+                        print('WARNING: ' + str(operator.name) + ' has ' + str(operator.request_machines()) + ' machines in each request, over the ' + str(sales_request_max_machines) + ' machine limit, but ' + window[0] + ' to ' + window[1] + ' can only be split into ' + str(len(shard_windows)) + ' days')
+                shard_share = share / len(shard_windows)
+                for shard_window in shard_windows:
+                    if seconds * shard_share > fair_share or len(entries) * len(windows) < self.workers:
+                        for payment_method in [3, 1]:
+                            tasks.append([operator, [payment_method], max(self.planner.estimate_method(operator, payment_method, machines) * shard_share, self.overhead), shard_window])
+                    else:
+                        tasks.append([operator, [3, 1], max(seconds * shard_share, 2 * self.overhead), shard_window])
+        
+        tasks.sort(key = lambda task: task[2], reverse = True)
+        return tasks
+    
+    ## Describe the plan, one line per request
+    def describe(self):
+        lines = ['Sales plan for ' + str(self.root.name) + ': ' + str(len(self.entries)) + ' requests covering ' + str(self.machine_count()) + ' of ' + str(self.root.count_machines()) + ' machines, about ' + '{:.1f}'.format(self.makespan()) + 's with ' + str(self.workers) + ' at once (' + '{:.2f}'.format(self.overhead) + 's per request + ' + '{:.4f}'.format(self.per_machine) + 's per machine)']
+        for operator, machines, seconds, size, shards in sorted(self.entries, key = lambda entry: entry[2], reverse = True):
+            line = '  ' + str(operator.request_actor()) + ' ' + str(operator.name) + ': ' + str(machines) + ' machines, ~' + '{:.2f}'.format(seconds) + 's'
+            if size != None:
+                line += ', ~' + '{:,.0f}'.format(size) + ' bytes'
+            if shards > 1:
+                line += ', in ' + str(shards) + ' date shards'
+            lines.append(line)
+        return '\n'.join(lines)
+
+## Keeps track of the sales tasks being worked on, to estimate how long is
+## left. The estimates are scaled by how long finished tasks really took
+## compared to their estimates
+class SalesProgress():
+    ## Initialise with the tasks from a sales plan
+    def __init__(self, tasks = [], workers = 1):
+        self.workers = max(int(workers), 1)
+        self.lock = threading.Lock()
+        ## task -> estimated seconds, for tasks that haven't finished
+        self.estimates = {}
+        for task in tasks:
+            self.estimates[id(task)] = task[2]
+        ## task -> time it started
+        self.started = {}
+        self.done_estimate = 0
+        self.done_actual = 0
+    
+    ## Note that a task has started
+    def start(self, task):
+        with self.lock:
+            self.started[id(task)] = time.time()
+    
+    ## Note that a task has finished (or failed)
+    def finish(self, task):
+        with self.lock:
+            started = self.started.pop(id(task), None)
+            estimate = self.estimates.pop(id(task), None)
+            if started != None and estimate != None:
+                self.done_estimate += estimate
+                self.done_actual += time.time() - started
+    
+    ## Number of tasks that haven't finished
+    def unfinished(self):
+        with self.lock:
+            return len(self.estimates)
+    
+    ## Estimated seconds until all of the tasks are finished
+    def remaining(self):
+        with self.lock:
+            if self.done_estimate > 0:
+                scale = self.done_actual / self.done_estimate
+            else:
+                scale = 1
+            
+            now = time.time()
+            seconds = []
+            for task, estimate in self.estimates.items():
+                if task in self.started:
+                    seconds.append(max(estimate * scale - (now - self.started[task]), 0))
+                else:
+                    seconds.append(estimate * scale)
+        
+        if len(seconds) == 0:
+            return 0
+        return SalesPlan.estimate_makespan(seconds, self.workers)
+    
+    ## Text to add to progress messages
+    def describe(self):
+        return ', about ' + format_duration(self.remaining()) + ' left'
+
+## A bulk job for the job runner. The function is called with each item on
+## the worker threads, and the results come back on the job's own queue (as
+## [item, result]) so that jobs running at the same time don't get each
+## other's results
+class Job():
+    ## Initialise the job. Label gives the name of an item for messages
+    def __init__(self, function, items, description = 'Working', deadline = None, label = None):
+        self.function = function
+        self.description = description
+        self.deadline = deadline
+        if label == None:
+            label = str
+        self.label = label
+        self.total = len(items)
+        self.completed = 0
+        self.failed = 0
+        self.dropped = 0
+        self.cancelled = False
+        self.started = time.time()
+        self.results = queue.Queue()
+        self.lock = threading.Lock()
+        self.finished = threading.Event()
+        if self.total == 0:
+            self.finished.set()
+    
+    ## Note the end of a task, as 'completed', 'failed' or 'dropped' (not
+    ## started because the job was cancelled)
+    def task_done(self, outcome):
+        with self.lock:
+            if outcome == 'completed':
+                self.completed += 1
+            elif outcome == 'failed':
+                self.failed += 1
+            else:
+                self.dropped += 1
+            
+            if self.completed + self.failed + self.dropped == self.total:
+                self.finished.set()
+    
+    ## Stop the job. Tasks that haven't started are dropped, and tasks in
+    ## progress are left to finish
+    def cancel(self):
+        self.cancelled = True
+    
+    ## Returns true if tasks shouldn't be started any more
+    def is_cancelled(self):
+        return self.cancelled == True or (self.deadline != None and time.time() > self.deadline)
+    
+    ## Returns true once every task has finished or been dropped
+    def is_done(self):
+        return self.finished.is_set()
+    
+    ## Wait up to a number of seconds for the job to finish. Returns true if
+    ## it has
+    def wait(self, timeout = None):
+        return self.finished.wait(timeout)
+    
+    ## Number of tasks that haven't finished
+    def remaining(self):
+        with self.lock:
+            return self.total - self.completed - self.failed - self.dropped
+    
+    ## Tasks finished per second so far
+    def rate(self):
+        elapsed = time.time() - self.started
+        if elapsed <= 0:
+            return 0
+        return (self.completed + self.failed) / elapsed
+    
+    ## The counts and rate of the job
+    def progress(self):
+        with self.lock:
+            counts = {'total': self.total, 'completed': self.completed, 'failed': self.failed, 'dropped': self.dropped}
+        counts['remaining'] = counts['total'] - counts['completed'] - counts['failed'] - counts['dropped']
+        counts['rate'] = self.rate()
+        return counts
+    
+    ## Text for progress messages
+    def describe(self):
+        counts = self.progress()
+        return str(counts['remaining']) + ' remaining (' + str(counts['completed'] + counts['failed']) + '/' + str(counts['total']) + ' done, ' + '{:.1f}'.format(counts['rate']) + '/s)'
+    
+    ## Take the results that have come in so far, as [item, result]
+    def get_results(self):
+        results = []
+        while True:
+            try:
+                results.append(self.results.get_nowait())
+            except queue.Empty:
+                break
+        return results
+
+## Long-lived pool of worker threads that runs bulk jobs. The tasks of every
+## job share the pool, in the order they were submitted
+class JobRunner():
+    ## Initialise the runner. before_task is called with the job on the
+    ## worker thread before each task, and on_failure with the job, item and
+    ## exception when a task fails
+    def __init__(self, workers, before_task = None, on_failure = None):
+        self.workers = workers
+        self.before_task = before_task
+        self.on_failure = on_failure
+        self.tasks = queue.Queue()
+        self.threads = []
+        self.jobs = []
+        self.lock = threading.Lock()
+        self.stopped = False
+    
+    ## Start the worker threads if they aren't running yet
+    def start(self):
+        with self.lock:
+            if self.stopped == True:
+                raise RuntimeError('The job runner has been shut down')
+            while len(self.threads) < self.workers:
+                thread = threading.Thread(target = self.worker, daemon = True)
+                thread.start()
+                self.threads.append(thread)
+    
+    ## Start a job that calls a function with each of the items. Returns the
+    ## job
+    def submit(self, function, items, description = 'Working', deadline = None, label = None):
+        items = list(items)
+        job = Job(function, items, description = description, deadline = deadline, label = label)
+        if len(items) > 0:
+            self.start()
+        with self.lock:
+            self.jobs = [other for other in self.jobs if other.is_done() == False]
+            self.jobs.append(job)
+        for item in items:
+            self.tasks.put([job, item])
+        return job
+    
+    ## Worker thread. Runs tasks until it gets None
+    def worker(self):
+        while True:
+            task = self.tasks.get()
+            if task == None:
+                break
+            
+            job, item = task
+            if job.is_cancelled() == True:
+                job.task_done('dropped')
+                continue
+            
+            try:
+                if self.before_task != None:
+                    self.before_task(job)
+                result = job.function(item)
+            ## One task failing shouldn't stop the rest
+            except Exception as e:
+                print('[JOB] Failed to ' + job.description + ' for ' + str(job.label(item)) + ': ' + str(e))
+                if self.on_failure != None:
+                    self.on_failure(job, item, e)
+                job.task_done('failed')
+                continue
+            
+            job.results.put([item, result])
+            job.task_done('completed')
+    
+    ## Cancel every job that hasn't finished
+    def cancel_all(self):
+        with self.lock:
+            jobs = list(self.jobs)
+        for job in jobs:
+            job.cancel()
+    
+    ## Stop the worker threads once they have finished the tasks they are on.
+    ## Tasks that haven't started are dropped. Returns the number of threads
+    ## that didn't stop within the timeout
+    def shutdown(self, timeout = None):
+        with self.lock:
+            self.stopped = True
+            threads = self.threads
+            self.threads = []
+        
+        while True:
+            try:
+                task = self.tasks.get_nowait()
+            except queue.Empty:
+                break
+            if task != None:
+                task[0].task_done('dropped')
+        
+        for thread in threads:
+            self.tasks.put(None)
+        
+        if timeout != None:
+            wait_until = time.time() + timeout
+        stuck = 0
+        for thread in threads:
+            if timeout == None:
+                thread.join()
+            else:
+                thread.join(max(0, wait_until - time.time()))
+            if thread.is_alive() == True:
+                stuck += 1
+        return stuck
+
+## Class for Nayax functions        
+class Nayax():
+    ## Class initialisation. Set up variables and do the initial login. The
+    ## base URL defaults to the global base_URL
+    def __init__(self, username, password, base_URL = None):
+        if base_URL == None:
+            base_URL = globals()['base_URL']
+        self.base_URL = base_URL
+        self.cookies = {}
+        self.headers = {}
+        self.logged_in = False
+        ## kept so that we can log in again if the session expires. Only one
+        ## thread logs in again, the rest wait for auth_ready
+        self.username = username
+        self.password = password
+        self.login_count = 0
+        self.login_lock = threading.Lock()
+        self.auth_ready = threading.Event()
+        self.auth_ready.set()
+        ## pool of keep-alive sessions shared by all of the worker threads
+        self.session_pool = queue.LifoQueue(maxsize = worker_count_max)
+        ## adaptive limit on the number of requests in flight
+        self.limiter = AdaptiveLimiter()
+        self.session_generation = 0
+        ## per-thread state (the deadline of the job the thread is working on)
+        self.local = threading.local()
+        ## retries and failed tasks for the job currently running
+        self.retries = 0
+        self.failures = 0
+        self.stats_lock = threading.Lock()
+        ## read requests in flight and remembered responses, by path. Writes
+        ## are counted per machine so that a read which was in flight during
+        ## a write isn't remembered
+        self.flights = {}
+        self.memo = {}
+        self.memo_paths = {}
+        self.machine_writes = {}
+        self.memo_lock = threading.Lock()
+        ## asyncio engine and worker threads for bulk operations (created
+        ## when first needed)
+        self.async_engine = None
+        self.job_runner = None
+        ## set when the user cancels the bulk job that is running
+        self.cancelled = False
+        ## on-disk response cache
+        if use_response_cache == True:
+            self.cache = ResponseCache()
+        else:
+            self.cache = None
+        ## on-disk fleet store, and what the current job has found out that
+        ## will be saved to it at the end of the job
+        if use_fleet_store == True:
+            self.store = FleetStore()
+        else:
+            self.store = None
+        self.sales_rows = []
+        self.sales_details = []
+        self.sales_done = []
+        self.history_events = {}
+        ## status changes of the machines, from their histories
+        self.activity = ActivityIndex(self.store)
+        ## plans sales requests from their past costs. The last plan is kept
+        ## so it can be looked at
+        self.sales_planner = SalesPlanner(self.store)
+        self.sales_costs = []
+        self.sales_plan = None
+        ## (operator id, window) -> payment methods still to be downloaded,
+        ## operator id -> windows still to be downloaded, and the progress of
+        ## the current sales tasks
+        self.sales_pending = {}
+        self.sales_pending_windows = {}
+        self.sales_lock = threading.Lock()
+        self.sales_progress = SalesProgress()
+        ## when the period is fetched in windows: the windows, (machine id,
+        ## source) -> window -> [count, amount], the window that each
+        ## machine's details came from, and window -> operators done
+        self.sales_windows = []
+        self.window_sales = {}
+        self.window_details = {}
+        self.window_done = {}
+        ## requested actor id -> the machine ids to apply from its sales,
+        ## for requests that only cover the machines directly under it
+        self.sales_filters = {}
         
-        return value
-                        
-## Operator object for storing operator information
-class Operator():
-    ## Initialise the operator object
-    def __init__(self, id, parent, name):
-        self.id = id
-        self.parent = parent
-        self.name = name
-        self.type = 'operator'
-        self.active_now = False
+        self.login(username, password)
+    
+    ## Set the cookies and/or headers used for requests. Pooled sessions made
+    ## with the old values are replaced the next time they are checked out
+    def set_session_auth(self, cookies = None, headers = None):
+        if cookies != None:
+            self.cookies = cookies
+        if headers != None:
+            self.headers = headers
+        self.session_generation += 1
+    
+    ## Create a new keep-alive session with the current cookies and headers
+    def create_session(self):
+        global worker_count_max
+        session = requests.Session()
+        ## size the connection pool so that every worker can keep a connection
+        ## open to Nayax without having to handshake again
+        adapter = requests.adapters.HTTPAdapter(pool_connections = 1, pool_maxsize = worker_count_max)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        ## attach the cookies and validation headers once for the session
+        session.headers.update(self.headers)
+        session.cookies.update(self.cookies)
+        session.generation = self.session_generation
+        return session
+    
+    ## Check out a session from the pool, creating a new one if none are free
+    def get_session(self):
+        try:
+            session = self.session_pool.get_nowait()
+        except queue.Empty:
+            return self.create_session()
         
-        ## lie for operators. this just fixes some display stuff
-        self.active = True
-        self.fees = []
+        ## Sessions made before the cookies/headers last changed are replaced
+        if session.generation != self.session_generation:
+            session.close()
+            return self.create_session()
         
-    ## Find all machines and operators under this one
-    def get_children(self, parent = None, type = 'all', recursive = False, active_only = False):
-        global machine_list, operator_list
-        ## if no ID was passed, we are looking for nodes with this one as a parent
-        if parent == None:
-            parent = self.id
+        return session
+    
+    ## Return a session to the pool. If the pool is already full, close it
+    def release_session(self, session):
+        try:
+            self.session_pool.put_nowait(session)
+        except queue.Full:
+            session.close()
+    
+    ## Works out which endpoint a request path is for
+    def request_kind(self, path):
+        regexp_action = re.search(r'action=([\w\.]+)', path)
+        if regexp_action:
+            return regexp_action.group(1)
+        else:
+            return path.split('?')[0]
+    
+    ## Start a new bulk job. Resets the retry and failure counts and returns
+    ## the time the job has to be finished by (None if there is no deadline)
+    def start_job(self):
+        global job_deadline
+        with self.stats_lock:
+            self.retries = 0
+            self.failures = 0
+        self.cancelled = False
+        
+        if job_deadline == None:
+            return None
+        else:
+            return time.time() + job_deadline
+    
+    ## Cancel the bulk job that is running. Tasks that haven't started are
+    ## dropped (including those of any later steps of the job), and tasks in
+    ## progress are left to finish
+    def cancel_jobs(self):
+        self.cancelled = True
+        if self.job_runner != None:
+            self.job_runner.cancel_all()
+    
+    ## Set the deadline for requests made by the current thread
+    def set_deadline(self, deadline):
+        self.local.deadline = deadline
+    
+    ## Returns true if the deadline has passed
+    def deadline_passed(self, deadline):
+        return deadline != None and time.time() > deadline
+    
+    ## Seconds to wait before retry number 'attempt' (starting from 1).
+    ## Doubles each time up to the maximum, with jitter so that workers that
+    ## failed together don't all come back together
+    def retry_delay(self, attempt, deadline = None):
+        global retry_backoff_base, retry_backoff_max
+        delay = min(retry_backoff_max, retry_backoff_base * 2 ** (attempt - 1))
+        delay = random.uniform(delay / 2, delay)
+        
+        ## never sleep past the deadline
+        if deadline != None:
+            delay = max(0, min(delay, deadline - time.time()))
+        return delay
+    
+    ## Count a retried request
+    def count_retry(self):
+        with self.stats_lock:
+            self.retries += 1
+    
+    ## Count a task that failed even after retrying
+    def count_failure(self):
+        with self.stats_lock:
+            self.failures += 1
+    
+    ## Text to add to progress messages. Shows the current concurrency (the
+    ## limiter's unless one is given) and how many retries and failures there
+    ## have been so far
+    def progress_info(self, concurrency = None):
+        if concurrency == None:
+            concurrency = self.limiter.current_limit()
+        
+        info = ' (concurrency ' + str(concurrency) + ', retries ' + str(self.retries)
+        if self.failures > 0:
+            info += ', failed ' + str(self.failures)
+        return info + ')'
+    
+    ## Report the end of a job, mentioning anything that failed
+    def finish_job(self, message, callback = None):
+        if callback == None:
+            callback = print
         
-        children = []
+        if self.failures > 0:
+            callback(message + ', but ' + str(self.failures) + ' tasks failed (see the log)')
+        else:
+            callback(message)
+    
+    ## Get the rate limit bucket for a kind of request. A bucket that
+    ## doesn't have the configured rate and burst any more is replaced
+    def request_bucket(self, kind):
+        global request_write_actions, read_bucket, write_bucket, bucket_lock
+        global read_rate_limit, read_burst, write_rate_limit, write_burst
+        with bucket_lock:
+            if kind in request_write_actions:
+                if write_bucket == None or write_bucket.rate != write_rate_limit or write_bucket.burst != max(1, write_burst):
+                    write_bucket = TokenBucket(write_rate_limit, write_burst)
+                return write_bucket
+            else:
+                if read_bucket == None or read_bucket.rate != read_rate_limit or read_bucket.burst != max(1, read_burst):
+                    read_bucket = TokenBucket(read_rate_limit, read_burst)
+                return read_bucket
+    
+    ## Returns true if a request only reads data, so it can share a request
+    ## that is already in flight
+    def is_read_request(self, kind, post = {}, json = {}):
+        global request_write_actions
+        if kind in request_write_actions:
+            return False
+        return (post == {} or post == None) and (json == {} or json == None)
+    
+    ## Works out which machine a request path is for (None if it isn't for
+    ## a single machine)
+    def request_machine(self, path):
+        regexp_machine = re.search(r'machine_id=(\d+)', path)
+        if regexp_machine:
+            return regexp_machine.group(1)
+        else:
+            return None
+    
+    ## Get a remembered response for a path, or None if there isn't one (or
+    ## it is too old)
+    def memo_get(self, path):
+        with self.memo_lock:
+            entry = self.memo.get(path)
+            if entry == None:
+                return None
+            
+            response, expires, machine = entry
+            if time.time() > expires:
+                self.memo_forget(path)
+                return None
+            return response
+    
+    ## Remember the text of a response for a path (for responses that
+    ## didn't come from requests, e.g. the asyncio engine)
+    def memo_put_text(self, path, text, writes):
+        global request_memo_actions
+        if self.request_kind(path) not in request_memo_actions:
+            return
         
-        ## go through the operator list and add matching operators
-        for operator in operator_list:
-            ## if the operator has this one as a parent, add it to the list
-            if operator.parent == parent:
-                ## only add the operator if we are looking for ops too, 
-                ## otherwise just do children
-                if type == 'all' or type == 'operator':
-                    children.append(operator)
-                
-                ## if we are are recursive, go deeper
-                if recursive == True:
-                    children.extend(self.get_children(parent = operator.id, type = type, recursive = True, active_only = active_only))
-                    
-        ## if we are looking for all or machines..
-        if type == 'all' or type == 'machine':
-            ## go through the machine list and add matching machines
-            for machine in machine_list:
-                ## if the machine has this one as a parent, add it to the list
-                if machine.parent == parent:
-                    ## exclude inactive machines if specified
-                    if (active_only == True and machine.active == True) or active_only == False:
-                        children.append(machine)
-                    
-        return children
-
-    ## convinience function - get all machines under this one
-    def get_machines(self, parent = None, recursive = False, active_only = False):
-        return self.get_children(parent = parent, type = 'machine', recursive = recursive, active_only = active_only)
+        response = requests.models.Response()
+        response.status_code = 200
+        response.url = self.base_URL + path
+        response.encoding = 'utf-8'
+        response._content = text.encode('utf-8')
         
-    ## convinience function - get all operators under this one
-    def get_operators(self, parent = None, recursive = False):
-        return self.get_children(parent = parent, type = 'operator', recursive = recursive)
-
-    ## get the parent of this operator
-    def get_parent(self):    
-        for operator in operator_list:
-            if operator.id == self.parent:
-                return operator
-                
-        return None
+        machine = self.request_machine(path)
+        with self.memo_lock:
+            if self.write_count(machine) == writes:
+                self.memo_put(path, response, machine)
+    
+    ## Remember a response for a path. Call with memo_lock held
+    def memo_put(self, path, response, machine):
+        global request_memo_ttl, request_memo_max
+        self.memo_forget(path)
         
-    ## Returns cash sale count, amount
-    def get_cash_sales(self):
-        sales_count = 0
-        sales_amount = 0
-        null_sales = True
-        ## add up the sales for all children
-        for actor in self.get_machines(recursive = True):
-            count, amount = actor.get_cash_sales()
-            if count != None:
-                null_sales = False
-                sales_count += count
-                sales_amount += amount
+        ## forget the oldest once we have enough (dicts keep insertion order)
+        while len(self.memo) >= request_memo_max:
+            self.memo_forget(next(iter(self.memo)))
         
-        ## if there is no sales data for any child, return None
-        if null_sales == True:
-            return None, None
-        else:
-            return sales_count, sales_amount
+        self.memo[path] = [response, time.time() + request_memo_ttl, machine]
+        self.memo_paths.setdefault(machine, set()).add(path)
+    
+    ## Forget the response for a path. Call with memo_lock held
+    def memo_forget(self, path):
+        entry = self.memo.pop(path, None)
+        if entry != None:
+            paths = self.memo_paths.get(entry[2])
+            if paths != None:
+                paths.discard(path)
+                if len(paths) == 0:
+                    del self.memo_paths[entry[2]]
+    
+    ## Forget everything remembered about the machine a write request is for
+    def memo_invalidate(self, path):
+        machine = self.request_machine(path)
+        with self.memo_lock:
+            self.machine_writes[machine] = self.machine_writes.get(machine, 0) + 1
             
+            ## if we don't know which machine it changed, forget everything
+            if machine == None:
+                self.memo = {}
+                self.memo_paths = {}
+            else:
+                for memo_path in list(self.memo_paths.get(machine, [])):
+                    self.memo_forget(memo_path)
         
-    ## Returns card sale count, amount
-    def get_card_sales(self):
-        sales_count = 0
-        sales_amount = 0
-        null_sales = True
-        ## Add up the sales for all children
-        for actor in self.get_machines(recursive = True):
-            count, amount = actor.get_card_sales()
-            if count != None:
-                null_sales = False
-                sales_count += count
-                sales_amount += amount
+        ## the stored product map is out of date too
+        if self.store != None and machine != None:
+            self.store.forget_product_map(int(machine))
+    
+    ## Count of writes that could have changed what a machine's reads return
+    ## (writes for unknown machines count for every machine). Call with
+    ## memo_lock held
+    def write_count(self, machine):
+        return self.machine_writes.get(machine, 0) + self.machine_writes.get(None, 0)
+    
+    ## Makes requests to the Nayax website for data. Identical read requests
+    ## share one request while it is in flight, and the responses of some
+    ## are remembered for a while (see request_memo_actions). Writes make
+    ## what was remembered for their machine out of date
+    def make_request(self, path, post = {}, json = {}, login_required = True, stream = False):
+        global request_memo_actions, request_write_actions
+        kind = self.request_kind(path)
+        
+        ## Forget what we knew about the machine before and after a write, so
+        ## that reads made in the meantime aren't remembered either
+        if kind in request_write_actions:
+            self.memo_invalidate(path)
+            try:
+                return self.send_request(path, post = post, json = json, login_required = login_required, stream = stream)
+            finally:
+                self.memo_invalidate(path)
+        
+        ## Streams can't be shared, and neither can the login requests
+        if stream == True or login_required == False or self.is_read_request(kind, post, json) == False:
+            return self.send_request(path, post = post, json = json, login_required = login_required, stream = stream)
+        
+        response = self.memo_get(path)
+        if response != None:
+            return response
+        
+        ## Join the request if someone is already making it
+        machine = self.request_machine(path)
+        with self.memo_lock:
+            flight = self.flights.get(path)
+            if flight != None:
+                leader = False
+            else:
+                leader = True
+                flight = RequestFlight()
+                self.flights[path] = flight
+                writes = self.write_count(machine)
         
-        ## If there is no sales data for any child, return None
-        if null_sales == True:
-            return None, None
-        else:    
-            return sales_count, sales_amount
-                   
-## Class for Nayax functions        
-class Nayax():
-    ## Class initialisation. Set up variables and do the initial login
-    def __init__(self, username, password):
-        self.base_URL = 'https://my.nayax.com/DCS/'
-        self.cookies = {}
-        self.headers = {}
-        self.logged_in = False
-        self.sales_data_queue_in = queue.Queue()
-        self.sales_data_queue_out = queue.Queue()
-        self.product_map_queue_in = queue.Queue()
-        self.product_map_queue_out = queue.Queue()
-        self.request_queue_in = queue.Queue()
-        self.request_queue_out = queue.Queue()
+        if leader == False:
+            return flight.wait()
         
-        self.login(username, password)
+        try:
+            response = self.send_request(path, post = post, json = json, login_required = login_required)
+        except Exception as e:
+            with self.memo_lock:
+                del self.flights[path]
+            flight.finish(error = e)
+            raise
+        
+        with self.memo_lock:
+            del self.flights[path]
+            ## only remember good responses that no write has overtaken
+            if kind in request_memo_actions and response.status_code == 200 and self.write_count(machine) == writes:
+                self.memo_put(path, response, machine)
+        flight.finish(response = response)
+        
+        return response
+    
+    ## Returns true if a response is the login page, which is what Nayax
+    ## sends back instead once the session has expired
+    def is_login_page(self, url, text):
+        if 'LoginPage.aspx' in str(url):
+            return True
+        return re.search(r'var token = \'(.+)\'\;', text) != None
     
-    ## Makes requests to the Nayax website for data
-    def make_request(self, path, post = {}, json = {}, login_required = True):
+    ## Log in again after the session has expired. Only one thread logs in,
+    ## the others wait for it. login_count is the count from when the
+    ## request that found the session expired was sent, so that threads that
+    ## find out after someone else has logged in again don't do it again
+    ## (None if it isn't known, which always logs in)
+    def relogin(self, login_count):
+        with self.login_lock:
+            if login_count != None and self.login_count != login_count:
+                return
+            
+            print('[' + str(time.time()) + '] Login: Session has expired. Logging in again...')
+            self.auth_ready.clear()
+            try:
+                self.login(self.username, self.password)
+            finally:
+                self.auth_ready.set()
+    
+    ## Sends a request to the Nayax website. Connection errors, timeouts and
+    ## server errors are retried with backoff. If the session has expired, we
+    ## log in again and resend it. Raises RuntimeError if every attempt fails
+    ## or the job deadline passes
+    def send_request(self, path, post = {}, json = {}, login_required = True, stream = False):
+        global connect_timeout, read_timeout, retry_count
         ## Figure out the URL to request
         url = self.base_URL + path
         request = None
+        problem = None
         
-        ## Error if we are not logged in, unless login_required is false       
+        ## Error if we are not logged in, unless login_required is false
         if login_required == True and self.logged_in == False:
             raise RuntimeError('Tried to make request for ' + path + ' but we are not logged in')
             return
         
-        ## Wrap in a for loop so that we can do retries
-        for i in range(3):
-            ## Wrap in a try to catch connection issues        
-            try:                
-                ## If we have POST or JSON data, it's a POST request
-                if post != {} or json != {}:
-                    print('\n[NYX_REQUEST:POST/JSON] Requesting ' + str(url))
-                    request = requests.post(url, cookies = self.cookies, headers = self.headers, data = post, json = json)
-                ## If we don't have any, it's a GET request
+        ## Deadline of the job this thread is working on (if any)
+        deadline = getattr(self.local, 'deadline', None)
+        
+        ## Borrow a keep-alive session from the pool
+        session = self.get_session()
+        
+        ## Requests are timed per endpoint so that slow reports aren't
+        ## mistaken for latency spikes on quick lookups
+        kind = self.request_kind(path)
+        
+        ## Loop so that we can do retries. Logging in again after the session
+        ## expired doesn't count as a failed attempt, but is limited too. The
+        ## login count is taken as each request is sent
+        attempt = 0
+        relogins = 0
+        login_count = None
+        try:
+            while True:
+                ## Log in again if the session expired
+                if problem == 'session expired':
+                    relogins += 1
+                    if relogins > retry_count:
+                        break
+                    self.relogin(login_count)
+                ## Wait a bit longer after each failure
+                elif problem != None:
+                    attempt += 1
+                    if attempt >= retry_count:
+                        break
+                    self.count_retry()
+                    delay = self.retry_delay(attempt, deadline)
+                    print('Request for ' + url + ' failed (' + problem + '). Retrying in ' + '{:.1f}'.format(delay) + 's (' + str(attempt) + '/' + str(retry_count - 1) + ')...')
+                    time.sleep(delay)
+                
+                ## Don't start anything new once the job has run out of time
+                if self.deadline_passed(deadline) == True:
+                    problem = 'job deadline passed'
+                    break
+                
+                ## Wait for our turn under the rate limit. Logging in uses up a
+                ## slot but doesn't queue, since everyone else is waiting on it
+                if login_required == True:
+                    self.request_bucket(kind).acquire()
                 else:
-                    print('\n[NYX_REQUEST:GET] Requesting ' + str(url))
-                    request = requests.get(url, cookies = self.cookies, headers = self.headers)
+                    self.request_bucket(kind).reserve()
                 
-                print('\n[NYX_REQUEST] Got ' + str(url))
-            ## If there was a connection error, wait 1 second and then retry
-            except requests.exceptions.ConnectionError:
-                print('Request for ' + url + ' failed. Retrying (' + str(i+1) + '/3)...')
-                time.sleep(1)
-                continue
-            ## If it worked, break the retry loop
-            else:
-                break
+                ## Hold off while someone else is logging in again, then make
+                ## sure we have a session with the latest cookies
+                if login_required == True:
+                    self.auth_ready.wait()
+                login_count = self.login_count
+                if session.generation != self.session_generation:
+                    self.release_session(session)
+                    session = self.get_session()
+                
+                ## Wait until the limiter lets another request through
+                self.limiter.acquire()
+                started = time.time()
+                ## Wrap in a try to catch connection issues
+                try:
+                    ## If we have POST or JSON data, it's a POST request
+                    if post != {} or json != {}:
+                        print('\n[NYX_REQUEST:POST/JSON] Requesting ' + str(url))
+                        request = session.post(url, data = post, json = json, stream = stream, timeout = (connect_timeout, read_timeout))
+                    ## If we don't have any, it's a GET request
+                    else:
+                        print('\n[NYX_REQUEST:GET] Requesting ' + str(url))
+                        request = session.get(url, stream = stream, timeout = (connect_timeout, read_timeout))
+                    
+                    print('\n[NYX_REQUEST] Got ' + str(url))
+                ## Connection errors and timeouts are retried
+                except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                    self.limiter.release(kind, failed = True)
+                    problem = type(e).__name__
+                    continue
+                ## Anything else still has to give its slot back
+                except:
+                    self.limiter.release(kind, failed = True)
+                    raise
+                
+                ## Server errors mean Nayax is struggling, so back off and retry
+                if request.status_code >= 500:
+                    self.limiter.release(kind, failed = True)
+                    problem = 'HTTP ' + str(request.status_code)
+                    request.close()
+                    request = None
+                    continue
+                
+                self.limiter.release(kind, latency = time.time() - started)
                 
+                ## An expired session gets the login page back (only HTML is
+                ## read to check, so that streamed data stays streamed)
+                if login_required == True and ('html' in request.headers.get('Content-Type', '') or 'LoginPage.aspx' in request.url):
+                    if self.is_login_page(request.url, request.text) == True:
+                        problem = 'session expired'
+                        request.close()
+                        request = None
+                        continue
+                
+                ## If it worked, break the retry loop
+                break
+        finally:
+            ## Give the session back for the next request
+            self.release_session(session)
+        
+        if request == None:
+            raise RuntimeError('Request for ' + url + ' failed (' + str(problem) + ')')
+        
         ## Return the request object
         return request
     
@@ -372,225 +2904,412 @@ class Nayax():
         
         print('[' + str(time.time()) + '] Login: Logging in...')        
         ## Do the login using the given login token to get the session cookies
-        self.headers = {'signin-token': signin_token, 'Host': 'my.nayax.com', 'X-Requested-With': 'XMLHttpRequest', 'Origin': 'https://my.nayax.com'}
+        self.set_session_auth(headers = {'signin-token': signin_token, 'Host': 'my.nayax.com', 'X-Requested-With': 'XMLHttpRequest', 'Origin': 'https://my.nayax.com'})
         login_post = self.make_request('LoginPage.aspx?ReturnUrl=%2fdcs%2fpublic%2fdefault.aspx', json = {'userName': username, 'password': password, 'action': 'signin', 'newPassword': '', 'oldPassword': '', 'verifyPassword': ''}, login_required = False)
         ## If the 'unknown credentials' error is present, the user/pass were wrong
         if re.search(r'UNKNOWNCREDS', login_post.text):
             raise RuntimeError('Incorrect login credentials')
         else:
-            self.cookies = login_post.cookies
+            self.set_session_auth(cookies = login_post.cookies)
         
         print('[' + str(time.time()) + '] Login: Getting background request token...')        
         ## Get the dashboard using the authenticated login cookies so that we
         ## can get the background request validation token
-        self.headers = {'Host': 'my.nayax.com', 'Origin': 'https://my.nayax.com'}
+        self.set_session_auth(headers = {'Host': 'my.nayax.com', 'Origin': 'https://my.nayax.com'})
         dashboard = self.make_request('public/facade.aspx?model=reports/dashboard', login_required = False)
         ## Find the background request validation token
         regexp_nvtoken = re.search(r'var token = \'(.+)\'\;', dashboard.text)
         if regexp_nvtoken:
             nvtoken = regexp_nvtoken.group(1)
             ## Set the validation headers for all future requests
-            self.headers = {'Host': 'my.nayax.com', 'X-Requested-With': 'XMLHttpRequest', 'Origin': 'https://my.nayax.com', 'X-Nayax-Validation-Token': nvtoken}
+            self.set_session_auth(headers = {'Host': 'my.nayax.com', 'X-Requested-With': 'XMLHttpRequest', 'Origin': 'https://my.nayax.com', 'X-Nayax-Validation-Token': nvtoken})
             ## Set the state to logged in
             self.logged_in = True
+            self.login_count += 1
         else:
             raise RuntimeError('Logged in successfully, but could not get the request validation token')
             
         print('[' + str(time.time()) + '] Login: Login complete...')
     
-    ## clean foreign characters from names
-    def clean_name(self, name):
-        name = re.sub('&amp;', '&', name)
-        name = re.sub(r'[^\w\s\-\.\&\'\/\(\)]', '', name)
-        return name
+    ## Get the asyncio engine, starting it if it isn't running yet
+    def get_async_engine(self):
+        global aiohttp
+        if aiohttp == None:
+            aiohttp = import_optional('aiohttp')
+        if self.async_engine == None:
+            self.async_engine = AsyncEngine(self)
+            ## the engine goes through the limiter too, so let it grow as far
+            ## as the engine can go
+            self.limiter.maximum = max(self.limiter.maximum, self.async_engine.concurrency)
+        return self.async_engine
     
-    ## Get the list of operators and machines
-    def get_machine_list(self):
-        global machine_list, operator_list
-        machines = self.make_request('public/facade.aspx?model=operations/machine&action=Machine.Machines_Search')
-
-        ## find machines
-        for match in re.finditer(r'parent_id=\"(\d+)\" title=\"([^<>"]+)\" machine_id=\"(\d+)\"[^<>]+activity_color=\"color_((green)|(red)|(gray))\"', machines.text):
-            ## parse out the information
-            parent = str(match.group(1))
-            name = self.clean_name(match.group(2))
-            id = str(match.group(3))
-            colour = match.group(4)
-            machine = Machine(id, parent, name)
+    ## Get the job runner, creating it if needed. Each task gets the job's
+    ## deadline, and failed tasks are counted
+    def get_job_runner(self):
+        global worker_count_max
+        if self.job_runner == None:
+            self.job_runner = JobRunner(worker_count_max, before_task = lambda job: self.set_deadline(job.deadline), on_failure = lambda job, item, e: self.count_failure())
+        return self.job_runner
+    
+    ## Stop the worker threads and the asyncio engine, and close the store
+    def shutdown(self):
+        global connect_timeout, read_timeout
+        if self.job_runner != None:
+            ## a request in progress can't take longer than this to give up
+            stuck = self.job_runner.shutdown(timeout = connect_timeout + read_timeout)
+            if stuck > 0:
+                print('Warning: ' + str(stuck) + ' worker threads did not stop')
+            self.job_runner = None
+        if self.async_engine != None:
+            self.async_engine.stop()
+            self.async_engine = None
+        if self.store != None:
+            self.store.close()
+            self.store = None
+    
+    ## Request path for the sales summary of an actor. Payment method 3 is
+    ## cash and 1 is card
+    def sales_summary_path(self, actor, start, end, payment_method):
+        if payment_method == 3:
+            with_cash = '1'
+        else:
+            with_cash = '0'
+        return 'public/facade.aspx?responseType=json&model=reports/SalesSummary&action=SalesSummary_Report&&actor_id=' + str(actor) + '&payment_method=' + str(payment_method) + '&num_of_rows=1000000&with_cash=' + with_cash + '&with_cashless_external=0&time_period=57&start_date=' + start + 'T00%3A00%3A00&end_date=' + end + 'T23%3A59%3A59.997&report_type=2'
+    
+    ## Cache key for the sales summary of an actor
+    def sales_cache_key(self, actor, start, end, payment_method):
+        return 'sales/' + str(actor) + '/' + start + '/' + end + '/' + str(payment_method)
+    
+    ## How long a sales summary can be cached for. Periods that have ended
+    ## never change, so they don't expire
+    def sales_cache_ttl(self, end):
+        global cache_open_period_ttl
+        if datetime.datetime.strptime(end, '%Y-%m-%d').date() < datetime.date.today():
+            return None
+        else:
+            return cache_open_period_ttl
+    
+    ## Get the sales summary JSON for an actor, from the cache if we can
+    def get_sales_summary(self, actor, start, end, payment_method):
+        key = self.sales_cache_key(actor, start, end, payment_method)
+        if self.cache != None:
+            text = self.cache.get(key)
+            if text != None:
+                return json.loads(text)
+        
+        started = time.time()
+        response = self.make_request(self.sales_summary_path(actor, start, end, payment_method))
+        json_data = json.loads(response.text)
+        self.record_sales_cost(actor, payment_method, self.sales_row_count(json_data), len(response.text), time.time() - started)
+        
+        ## only cache it once we know it's good JSON
+        if self.cache != None:
+            self.cache.put(key, response.text, ttl = self.sales_cache_ttl(end))
+        
+        return json_data
+    
+    ## Number of machine rows in sales summary JSON
+    def sales_row_count(self, json_data):
+        try:
+            return len(json_data['data'][1])
+        except (KeyError, IndexError, TypeError):
+            return 0
+    
+    ## Cache key for the history of a machine
+    def history_cache_key(self, machine):
+        return 'history/' + str(machine)
+    
+    ## Get the history XML for a machine, from the cache if we can
+    def get_history(self, machine):
+        global cache_history_ttl
+        key = self.history_cache_key(machine)
+        if self.cache != None:
+            text = self.cache.get(key)
+            if text != None:
+                return text
+        
+        response = self.make_request(self.history_path(machine))
+        if self.cache != None and response.status_code == 200:
+            self.cache.put(key, response.text, ttl = cache_history_ttl)
             
-            ## work out if the machine is currently active
-            if colour == 'green' or colour == 'red':
-                machine.active_now = True
+        return response.text
+    
+    ## Request path for the product map of a machine
+    def product_map_path(self, machine):
+        return 'public/facade.aspx?responseType=json&model=operations/machine&action=InventoryStatus_Search&&machine_id=' + str(machine) + '&status_id=-1'
+    
+    ## Request path to remove products from a machine product map
+    def remove_products_path(self, machine, product_ids):
+        return 'public/facade.aspx?responseType=json&model=operations/machine&action=InventoryStatus.RemoveProducts&machine_id=' + str(machine) + '&product_ids=' + ','.join(product_ids)
+    
+    ## Request path to replace the product map of a machine
+    def update_products_path(self, machine):
+        return 'public/facade.aspx?responseType=json&model=operations/machine&action=InventoryStatus.UpdateMachineProduct&machine_id=' + str(machine) + '&lastVisitUpdate=false'
+    
+    ## Request path for the history of a machine
+    def history_path(self, machine):
+        return 'public/facade.aspx?model=operations/machine&action=MachineHistory.Get&&machine_id=' + str(machine)
+    
+    ## Request path for the list of operators and machines
+    def machine_list_path(self):
+        return 'public/facade.aspx?model=operations/machine&action=Machine.Machines_Search'
+    
+    ## Download and parse the list of operators and machines, returning the
+    ## machines and operators in the order they were listed
+    def download_machine_list(self):
+        global stream_machine_list, stream_chunk_size
+        parser = MachineListParser()
+        
+        if stream_machine_list == True:
+            actors = []
+            response = self.make_request(self.machine_list_path(), stream = True)
+            try:
+                for chunk in response.iter_content(chunk_size = stream_chunk_size):
+                    actors.extend(parser.feed(chunk))
+                actors.extend(parser.close())
+            except (xml.parsers.expat.ExpatError, requests.exceptions.ConnectionError, requests.exceptions.ChunkedEncodingError, requests.exceptions.Timeout) as e:
+                print('Could not stream the machine list (' + type(e).__name__ + '). Downloading it again...')
+                actors = None
+            finally:
+                response.close()
+            if actors != None:
+                return actors
+        
+        ## Get the whole thing and pick out what we can
+        machines = self.make_request(self.machine_list_path())
+        return parser.parse_text(machines.text)
+    
+    ## Get the list of operators and machines. If it has already been loaded,
+    ## it is refreshed instead
+    def get_machine_list(self):
+        global machine_list, operator_list, actor_index
+        if len(machine_list) > 0 or len(operator_list) > 0:
+            self.refresh_machine_list()
+            return
+        
+        for actor in self.download_machine_list():
+            if actor.type == 'machine':
+                machine_list.append(actor)
             else:
-                machine.active_now = False
+                operator_list.append(actor)
+        
+        ## index the tree now that we have all of it
+        actor_index.build()
+        
+        ## remember the fleet, and fill in machine details from last time
+        if self.store != None:
+            self.store.save_fleet(operator_list, machine_list)
+            self.store.load_machine_details(machine_list)
             
-            ## add the machine to the list
-            machine_list.append(machine)
+    ## Download the list of operators and machines again and merge it into the
+    ## loaded one by id. Anything still there keeps its object, so its sales,
+    ## fees and activity results are kept. Returns the changes, as lists of
+    ## the actors that were added, removed, moved, renamed or had their
+    ## activity colour change, plus the ids of the operators that gained or
+    ## lost something
+    def refresh_machine_list(self):
+        global machine_list, operator_list, actor_index
+        actor_index.check()
+        changes = {'added': [], 'removed': [], 'moved': [], 'renamed': [], 'recoloured': [], 'parents': set()}
+        
+        new_lists = {'machine': [], 'operator': []}
+        seen = {'machine': set(), 'operator': set()}
+        for fresh in self.download_machine_list():
+            ## only the first of an id counts, like the index
+            if fresh.id in seen[fresh.type]:
+                continue
+            seen[fresh.type].add(fresh.id)
             
-        ## find operators        
-        for match in re.finditer(r'id=\"(\d+)\" parent_id=\"(\d+)\" title=\"([^<>"]+)\" actor_type_id=\"\d+\"(\sdisabled=\"(1)\")?', machines.text):
-            ## parse out the information
-            parent = str(match.group(2))
-            id = str(match.group(1))
-            name = self.clean_name(match.group(3))
-            inactive = match.group(5)
+            if fresh.type == 'machine':
+                actor = actor_index.machine(fresh.id)
+            else:
+                actor = actor_index.operator(fresh.id)
             
-            ## add the operator to the list
-            operator = Operator(id, parent, name)
-            if inactive == '1':
-                operator.active_now = False
+            if actor == None:
+                actor = fresh
+                changes['added'].append(actor)
+                changes['parents'].add(actor.parent)
             else:
-                operator.active_now = True
-                
-            operator_list.append(operator)
+                if actor.parent != fresh.parent:
+                    changes['moved'].append(actor)
+                    changes['parents'].add(actor.parent)
+                    changes['parents'].add(fresh.parent)
+                    actor.parent = fresh.parent
+                if actor.name != fresh.name:
+                    changes['renamed'].append(actor)
+                    actor.name = fresh.name
+                if actor.active_now != fresh.active_now:
+                    changes['recoloured'].append(actor)
+                    actor.active_now = fresh.active_now
+            
+            new_lists[actor.type].append(actor)
+        
+        ## anything not in the new list has gone
+        for actor in operator_list + machine_list:
+            if actor.id not in seen[actor.type]:
+                changes['removed'].append(actor)
+                changes['parents'].add(actor.parent)
+        
+        machine_list[:] = new_lists['machine']
+        operator_list[:] = new_lists['operator']
+        actor_index.build()
+        
+        if self.store != None:
+            self.store.save_fleet(operator_list, machine_list)
+            self.store.load_machine_details(changes['added'])
+        
+        print('Machine list refreshed: ' + ', '.join(str(len(changes[change])) + ' ' + change for change in ['added', 'removed', 'moved', 'renamed', 'recoloured']))
+        return changes
             
     ## Find the root (highest) operator
     def find_root_operator(self):
-        global operator_list
-               
-        ## Look at each operator
-        for operator in operator_list:
+        global actor_index
         
-            ## See if their parent is known. If not, this is the highest level
-            parent = operator.parent
-            is_root = True
-            for op in operator_list:
-                if op.id == parent:
-                    is_root = False
-                    
-            if is_root == True:
-                return operator
+        ## The first operator whose parent isn't known is the highest level
+        operator = actor_index.root_operator()
+        if operator != None:
+            return operator
                 
         raise RuntimeError('Unable to determine root operator')
     
-    ## Reduce requests for stats so that they hit <500 machines at a time
-    def reduce_tree(self, root = None):
+    ## Plan the sales requests for everything under an operator (the root
+    ## by default), balancing the estimated cost of the requests across the
+    ## workers. Each machine is covered by exactly one request
+    def plan_sales_requests(self, root = None):
+        global use_async_engine, async_concurrency, worker_count
         if root == None:
             ## Find the top of the tree
             root = self.find_root_operator()
         
-        request_ops = []
-        ## Get the operators under it
-        sub_ops = root.get_operators(parent = root.id)
-        ## If there are no ops under this, we have to request with it
-        if len(sub_ops) == 0:
-            request_ops.append(root)
-        ## Otherwise we look at the sub operators
+        if use_async_engine == True:
+            workers = async_concurrency
         else:
-            for op in root.get_operators(parent = root.id):
-                ## If they have less than 500 machines, we can do a request on them
-                if len(root.get_machines(parent = op.id, recursive = True)) < 500:
-                    request_ops.append(op)
-                ## Otherwise we go deeper
-                else:                
-                    request_ops.extend(self.reduce_tree(root = op))
-                
-        ## Return the list of ops to request against
-        return request_ops
+            workers = worker_count
+        
+        self.sales_plan = self.sales_planner.plan(root, workers)
+        return self.sales_plan
+    
+    ## Reduce requests for stats to the operators in the sales plan
+    def reduce_tree(self, root = None):
+        plan = self.plan_sales_requests(root)
+        print(plan.describe())
+        return plan.operators()
+    
+    ## Note how long a sales request took and how big the response was, for
+    ## planning later requests
+    def record_sales_cost(self, actor, payment_method, rows, size, seconds):
+        global actor_index
+        operator = actor_index.operator(actor)
+        if operator == None:
+            return
+        cost = [operator.id, payment_method, operator.count_machines(), rows, size, seconds]
+        self.sales_planner.record(*cost)
+        self.sales_costs.append(cost)
 
-    ## worker for getting product maps
-    def get_product_map_json_worker(self):
-        while True:
-            machine = self.product_map_queue_in.get()
-            
-            ## If the machine is none, we are being terminated
-            if machine == None:
-                break
-            
-            ## Make the request
-            print('[GPMJ_WORKER] Making request...')
-            result = self.make_request('public/facade.aspx?responseType=json&model=operations/machine&action=InventoryStatus_Search&&machine_id=' + str(machine.id) + '&status_id=-1')
-            
-            ## Load the data in to a JSON object
-            print('[GPMJ_WORKER] Loading JSON...')
-            json_data = json.loads(result.text)
-            
-            ## Put the JSON in the out queue
-            self.product_map_queue_out.put(json_data)
-            
-            ## Mark the task as done
-            print('[GPMJ_WORKER] Complete...')
-            self.product_map_queue_in.task_done()
-            
-    ## worker for performing multiple requests
-    def request_worker(self):
-        while True:
-            data = self.request_queue_in.get()
-            
-            ## If the url is none, we are being terminated
-            if data == None:
-                break
+    ## Get the product map JSON for a machine (a job runner task)
+    def get_product_map(self, machine):
+        ## Make the request
+        print('[GPMJ_WORKER] Making request...')
+        result = self.make_request(self.product_map_path(machine.id))
+        
+        ## Load the data in to a JSON object
+        print('[GPMJ_WORKER] Loading JSON...')
+        json_data = json.loads(result.text)
+        print('[GPMJ_WORKER] Complete...')
+        return json_data
+    
+    ## Make a request from [url, post, json] (a job runner task)
+    def request_task(self, request):
+        url = request[0]
+        post = request[1]
+        json_data = request[2]
+        return self.make_request(url, post = post, json = json_data)
+    
+    ## Wait for a job to finish, showing progress. Tasks that were dropped
+    ## because the deadline passed (or the job was cancelled) count as
+    ## failures
+    def wait_for_job(self, job, message, callback = None, progress = None, poll = None):
+        if callback == None:
+            callback = print
+        
+        while job.wait(0.1) == False:
+            if self.cancelled == True:
+                job.cancel()
             
-            url = data[0]
-            post = data[1]
-            json = data[2]
+            ## anything to do on the main thread while waiting
+            if poll != None:
+                poll()
             
-            result = self.make_request(url, post = post, json = json)
-            self.request_queue_out.put(result)
-                                   
-            ## Mark the task as done
-            self.request_queue_in.task_done()
+            eta = ''
+            if progress != None:
+                eta = progress.describe()
+            callback(message + ' - ' + job.describe() + eta + '..' + self.progress_info())
+        
+        if poll != None:
+            poll()
+        
+        if job.dropped > 0:
+            with self.stats_lock:
+                self.failures += job.dropped
+            if job.cancelled == True:
+                reason = 'Job cancelled'
+            else:
+                reason = 'Job deadline passed'
+            callback(reason + '. Abandoned ' + str(job.dropped) + ' remaining..')
+            print(reason + '. Abandoned ' + str(job.dropped) + ' tasks')
     
-    ## Get the product maps JSON
-    def get_product_map_json(self, targets, callback = None):
-        global worker_count
+    ## Get the product maps JSON. The deadline is the job deadline from
+    ## start_job, when this is part of a bigger job
+    def get_product_map_json(self, targets, callback = None, deadline = None):
+        global use_async_engine
         print('[GPMJ] Configuring workers..')
         
         ## If there is no callback, use print
         if callback == None:
             callback = print
         
-        ## Set up a thread pool for multithreading
-        worker_threads = []
-        for i in range(worker_count):
-            worker = threading.Thread(target = self.get_product_map_json_worker)
-            worker.start()
-            worker_threads.append(worker)        
+        if deadline == None:
+            deadline = self.start_job()
         
-        ## go through the list of machines
-        for machine in targets:
-            self.product_map_queue_in.put(machine)
+        ## Hand the whole job to the asyncio engine if it is enabled
+        if use_async_engine == True:
+            engine = self.get_async_engine()
+            json_data = engine.run(engine.get_product_map_json(targets), callback = callback, message = 'Getting maps', deadline = deadline)
+            if self.store != None:
+                self.store.save_product_maps(json_data)
+            return json_data
+        
+        ## Get the maps on the worker threads
+        job = self.get_job_runner().submit(self.get_product_map, targets, description = 'get product map', deadline = deadline, label = lambda machine: machine.name)
         
         print('[GPMJ] Waiting for workers..')
         ## Wait for all the workers to finish
-        while self.product_map_queue_in.empty() == False:
-            remaining = self.product_map_queue_in.qsize()
-            callback('Getting maps - ' + str(remaining + worker_count) + ' remaining..')
-            time.sleep(0.1)
-        
-        ## Stop the worker threads
-        callback('Waiting for final ' + str(worker_count) + '..')
-        for i in range(worker_count):
-            self.product_map_queue_in.put(None)
-            
-        for child in worker_threads:
-            child.join(60)
+        self.wait_for_job(job, 'Getting maps', callback = callback)
         
         ## get the data from the workers
         print('[GPMJ] Getting worker output..')
         json_data = []
-        while self.product_map_queue_out.empty() == False:
-            ## Get the data from the JSON queue
-            try:
-                data = self.product_map_queue_out.get_nowait()
-                json_data.append(data)
-            ## Break if we can't get the data
-            except:
-                break
+        for machine, data in job.get_results():
+            json_data.append(data)
+        
+        if self.store != None:
+            self.store.save_product_maps(json_data)
         
         print('[GPMJ] Done! Returning data.')        
         return json_data
        
     ## Remove unknown products from a machine
     def remove_unknown_products(self, targets, callback = None):
-        global worker_count
+        global use_async_engine
         
         ## If no callback is defined, just make it print
         if callback == None:
             callback = print
         
+        deadline = self.start_job()
+        
         callback('Getting machine product maps...')
-        json_data = self.get_product_map_json(targets, callback = callback)
+        json_data = self.get_product_map_json(targets, callback = callback, deadline = deadline)
         
         callback('Processing product maps...')
         ## Process the JSON data
@@ -609,16 +3328,10 @@ class Nayax():
             deletion_queue.append([str(data['data'][0]['machine_id']), for_deletion])
         
         callback('Deleting unknown products...')        
-        ## Set up workers again to do the deletions
-        worker_threads = []
-        for i in range(worker_count):
-            worker = threading.Thread(target = self.request_worker)
-            worker.start()
-            worker_threads.append(worker)
-        
-        ## go through the list of machines
+        ## Make the list of deletion requests
         del_machines = 0
         del_products = 0
+        request_list = []
         for entry in deletion_queue:
             ## ignore machines with no deletions
             if len(entry[1]) > 0:
@@ -627,24 +3340,19 @@ class Nayax():
                 
                 ## break up the data
                 machine = str(entry[0])       
-                deletions = ','.join(entry[1])
-                request_url = 'public/facade.aspx?responseType=json&model=operations/machine&action=InventoryStatus.RemoveProducts&machine_id=' + machine + '&product_ids=' + deletions
+                request_url = self.remove_products_path(machine, entry[1])
 
-                self.request_queue_in.put([request_url, None, None])
+                request_list.append([request_url, None, None])
         
-        ## Wait for all the workers to finish
-        while self.request_queue_in.empty() == False:
-            remaining = self.request_queue_in.qsize()
-            callback('Deleting - ' + str(remaining + worker_count) + ' machines remaining..')
-            time.sleep(0.1)
+        ## Hand the deletions to the asyncio engine if it is enabled
+        if use_async_engine == True:
+            engine = self.get_async_engine()
+            engine.run(engine.run_requests(request_list), callback = callback, message = 'Deleting', deadline = deadline)
+            return del_machines, del_products
         
-        ## Stop the worker threads
-        callback('Waiting for final ' + str(worker_count) + '..')
-        for i in range(worker_count):
-            self.request_queue_in.put(None)
-            
-        for child in worker_threads:
-            child.join(60)
+        ## Do the deletions on the worker threads
+        job = self.get_job_runner().submit(self.request_task, request_list, description = 'delete products', deadline = deadline, label = lambda request: request[0])
+        self.wait_for_job(job, 'Deleting', callback = callback)
         
         return del_machines, del_products
         callback('Task complete...')            
@@ -653,7 +3361,7 @@ class Nayax():
     def pa_to_mdb(self, targets, callback = None, reverse = False):
         ## if called with reverse=true, we copy mdb->pa instead
     
-        global worker_count
+        global use_async_engine
         
         ## If no callback is defined, just make it print
         if callback == None:
@@ -662,8 +3370,10 @@ class Nayax():
         upd_products = 0
         upd_machines = 0
         
+        deadline = self.start_job()
+        
         callback('Getting machine product maps...')
-        json_data = self.get_product_map_json(targets, callback = callback)
+        json_data = self.get_product_map_json(targets, callback = callback, deadline = deadline)
         
         callback('Processing product maps...')
         ## Process the JSON data
@@ -692,40 +3402,29 @@ class Nayax():
                 update_queue.append(data['data_products'])             
         
         callback('Copying code for products...')        
-        ## Set up workers again to do the deletions
-        worker_threads = []
-        for i in range(worker_count):
-            worker = threading.Thread(target = self.request_worker)
-            worker.start()
-            worker_threads.append(worker)
-        
-        ## go through the list of machines
+        ## Make the list of update requests
+        request_list = []
         for entry in update_queue:
             machine = entry[0]['machine_id']            
             
             ## replace with new data
-            self.request_queue_in.put(['public/facade.aspx?responseType=json&model=operations/machine&action=InventoryStatus.UpdateMachineProduct&machine_id=' + str(machine) + '&lastVisitUpdate=false', None, entry])
+            request_list.append([self.update_products_path(machine), None, entry])
         
-        ## Wait for all the workers to finish
-        while self.request_queue_in.empty() == False:
-            remaining = self.request_queue_in.qsize()
-            callback('Updating - ' + str(remaining + worker_count) + ' machines remaining..')
-            time.sleep(0.1)
+        ## Hand the updates to the asyncio engine if it is enabled
+        if use_async_engine == True:
+            engine = self.get_async_engine()
+            engine.run(engine.run_requests(request_list), callback = callback, message = 'Updating', deadline = deadline)
+            return upd_machines, upd_products
         
-        ## Stop the worker threads
-        callback('Waiting for final ' + str(worker_count) + '..')
-        for i in range(worker_count):
-            self.request_queue_in.put(None)
-            
-        for child in worker_threads:
-            child.join(60)
+        ## Do the updates on the worker threads
+        job = self.get_job_runner().submit(self.request_task, request_list, description = 'update products', deadline = deadline, label = lambda request: request[0])
+        self.wait_for_job(job, 'Updating', callback = callback)
         
         return upd_machines, upd_products
         callback('Task complete...')   
     
     ## Dump JSON product data for a machine
     def dump_json_products(self, targets, callback = None):
-        global worker_count
         
         ## If no callback is defined, just make it print
         if callback == None:
@@ -741,38 +3440,35 @@ class Nayax():
             
             print('DEBUG_PM_JSON: ' + str(data['data_products']))
         
-        callback('Task complete...')
-        
-    ## Gets sales data (plus a bunch of other data) for the machines - worker
-    def get_sales_data_worker(self):
-        ## Poll queue indefinitely
-        while True:
-            ## Get the next operator from the queue
-            data = self.sales_data_queue_in.get()
-            op = data[0]
-            start = data[1]
-            end = data[2]
-            
-            ## If operator is None, we have been stopped and need to break
-            ## the queue polling
-            if op == None:
-                break
-                
-            actor = str(op.id)
-            sales_cash = self.make_request('public/facade.aspx?responseType=json&model=reports/SalesSummary&action=SalesSummary_Report&&actor_id=' + actor + '&payment_method=3&num_of_rows=1000000&with_cash=1&with_cashless_external=0&time_period=57&start_date=' + start + 'T00%3A00%3A00&end_date=' + end + 'T23%3A59%3A59.997&report_type=2')
-            sales_card = self.make_request('public/facade.aspx?responseType=json&model=reports/SalesSummary&action=SalesSummary_Report&&actor_id=' + actor + '&payment_method=1&num_of_rows=1000000&with_cash=0&with_cashless_external=0&time_period=57&start_date=' + start + 'T00%3A00%3A00&end_date=' + end + 'T23%3A59%3A59.997&report_type=2')
-            
-            json_cash = json.loads(sales_cash.text)
-            json_card = json.loads(sales_card.text)  
-            
-            self.sales_data_queue_out.put([json_cash, json_card])
-            
-            self.sales_data_queue_in.task_done()
-            
-        
+        callback('Task complete...')
+        
+    ## Gets the sales data for a task from the sales plan (a job runner
+    ## task). Returns the cash and card JSON, None for any that weren't part
+    ## of the task. In streaming mode the rows are applied as they arrive, so
+    ## there is nothing to pass back
+    def get_sales_task(self, task):
+        op = task[0]
+        payment_methods = task[1]
+        actor = str(op.request_actor())
+        start, end = task[3]
+        
+        self.sales_progress.start(task)
+        try:
+            json_data = {}
+            for payment_method in payment_methods:
+                if stream_sales_data == True:
+                    self.stream_sales_summary(actor, start, end, payment_method)
+                else:
+                    json_data[payment_method] = self.get_sales_summary(actor, start, end, payment_method)
+        finally:
+            self.sales_progress.finish(task)
+        
+        self.sales_task_done(op, payment_methods, task[3])
+        return [json_data.get(3), json_data.get(1)]
+        
     ## Gets sales data (plus a bunch of other data) for the machines - control
-    def get_sales_data(self, start, end, operator = None, callback = None):
-        global worker_count
+    def get_sales_data(self, start, end, operator = None, callback = None, on_update = None):
+        global use_async_engine, pipeline_sales_data
     
         if callback == None:
             callback = print
@@ -784,185 +3480,1038 @@ class Nayax():
             
         ops = self.reduce_tree(root = operator)        
         
-        ## Set up a thread pool for multithreading
-        callback('Preparing workers...')
-        worker_threads = []
-        for i in range(worker_count):
-            worker = threading.Thread(target = self.get_sales_data_worker)
-            worker.start()
-            worker_threads.append(worker)
+        ## Everything has to be done by the job deadline
+        deadline = self.start_job()
+        
+        ## Use what is already stored, and only download the rest
+        self.sales_rows = []
+        self.sales_details = []
+        self.sales_done = []
+        self.history_events = {}
+        self.sales_costs = []
+        self.sales_windows = self.make_sales_windows(start, end)
+        self.window_sales = {}
+        self.window_details = {}
+        self.window_done = {}
+        self.sales_filters = {}
+        for op in ops:
+            if op.type == 'direct':
+                self.sales_filters[op.request_actor()] = set(machine.id for machine in op.get_machines())
+        ops = self.load_stored_sales(ops, start, end)
+        stored_windows = self.load_stored_windows(ops)
+        if len(ops) == 0:
+            callback('Using stored sales data..')
+        
+        ## The longest tasks go first, so that the job doesn't end up waiting
+        ## on one big operator that started last
+        tasks = []
+        for task in self.sales_plan.tasks(ops, self.sales_windows):
+            ## the date shards of a stored window are covered by it
+            stored = [window for window in self.sales_windows if (task[0].id, window) in stored_windows and window[0] <= task[3][0] and task[3][1] <= window[1]]
+            if len(stored) == 0:
+                tasks.append(task)
+        self.sales_pending = {}
+        self.sales_pending_windows = {}
+        for task in tasks:
+            self.sales_pending.setdefault((task[0].id, task[3]), set()).update(task[1])
+            self.sales_pending_windows.setdefault(task[0].id, set()).add(task[3])
+        self.sales_progress = SalesProgress(tasks, self.sales_plan.workers)
+        if len(tasks) > 0:
+            callback(str(len(tasks)) + ' requests to make' + self.sales_progress.describe() + '..')
+        
+        ## Let the asyncio engine do the downloads and active checks if it is
+        ## enabled. In pipelined mode the sales are applied while the
+        ## downloads are still going
+        if use_async_engine == True:
+            engine = self.get_async_engine()
+            results = queue.Queue()
+            poll = None
+            if pipeline_sales_data == True:
+                poll = lambda: self.ingest_sales_data(results, on_update)
+            engine.run(engine.get_sales_data(tasks, results), callback = callback, message = 'Getting data', deadline = deadline, progress = self.sales_progress, poll = poll)
+            self.ingest_sales_data(results, on_update)
+                
+            callback('Data processing complete. Checking for active machines..')
+            machines = operator.get_machines(recursive = True)
+            active, unknown = self.check_active_locally(machines, start, end)
+            for machine, result in engine.run(engine.check_active_machines(unknown, start, end), callback = callback, message = 'Checking active machines', deadline = deadline):
+                active[machine.id] = result
+            for machine in machines:
+                machine.active = active.get(machine.id)
+            ## active DTU counts come from the sales columns too
+            actor_index.sales_changed()
+            
+            self.save_job_results(start, end)
+            self.finish_job('Sales data loaded', callback = callback)
+            return
         
-        callback('Employing workers...')
         ## Send the tasks to the worker threads
-        for op in ops:
-            self.sales_data_queue_in.put([op, start, end])
+        callback('Employing workers...')
+        job = self.get_job_runner().submit(self.get_sales_task, tasks, description = 'get sales data', deadline = deadline, label = lambda task: task[0].name)
+        poll = None
+        if pipeline_sales_data == True:
+            poll = lambda: self.ingest_sales_data(job.results, on_update)
         
         callback('Waiting for workers to complete...')
         ## Wait for all the workers to finish
-        while self.sales_data_queue_in.empty() == False:
-            remaining = self.sales_data_queue_in.qsize()
-            callback('Getting data - ' + str(remaining + worker_count) + ' remaining..')
-            time.sleep(0.1)
-        
-        ## Stop the worker threads
-        callback('Waiting for final ' + str(worker_count) + '..')
-        for i in range(worker_count):
-            self.sales_data_queue_in.put([None, None, None])
-                
-        for child in worker_threads:            
-            child.join(60)
+        self.wait_for_job(job, 'Getting data', callback = callback, progress = self.sales_progress, poll = poll)
         
-        ## Process the JSON data
+        ## Process the JSON data that is left
         callback('Processing received data..')
-        while self.sales_data_queue_out.empty() == False:
-            ## Get the data from the JSON queue
+        self.ingest_sales_data(job.results, on_update)
+        
+        ## If we get to here, processing of JSON data is complete
+        callback('Data processing complete. Checking for active machines..')
+        
+        ## check for active machines (threaded), for the ones the activity
+        ## index can't answer for
+        machines = operator.get_machines(recursive = True)
+        active, unknown = self.check_active_locally(machines, start, end)
+        job = self.get_job_runner().submit(lambda machine: self.is_machine_active(machine, start, end), unknown, description = 'check if active', deadline = deadline, label = lambda machine: machine.name)
+        self.wait_for_job(job, 'Checking active machines', callback = callback)
+        
+        ## if the history couldn't be had, we don't know either way
+        for machine, result in job.get_results():
+            active[machine.id] = result
+        for machine in machines:
+            machine.active = active.get(machine.id)
+        actor_index.sales_changed()
+        
+        self.save_job_results(start, end)
+        self.finish_job('Sales data loaded', callback = callback)
+    
+    ## Apply the stored sales for a period to the machines under the
+    ## operators that have them. Returns the operators that still have to be
+    ## downloaded
+    def load_stored_sales(self, ops, start, end):
+        global actor_index
+        if self.store == None:
+            return ops
+        
+        stored = self.store.stored_sales_operators(start, end, [op.id for op in ops])
+        if len(stored) == 0:
+            return ops
+        
+        machine_ids = set()
+        for op in ops:
+            if op.id in stored:
+                for machine in op.get_machines(recursive = True):
+                    machine_ids.add(machine.id)
+        for machine_id, source, count, amount in self.store.load_sales(start, end):
+            if machine_id in machine_ids:
+                actor_index.machine(machine_id).set_sales(source, count, amount)
+        actor_index.publish_sales()
+        
+        print('Using stored sales data for ' + str(len(stored)) + ' of ' + str(len(ops)) + ' operators')
+        return [op for op in ops if op.id not in stored]
+    
+    ## Split a period into windows to fetch separately, as a list of (start,
+    ## end) dates. Windows line up with calendar months or weeks (Monday to
+    ## Sunday) so that later reports can reuse them, apart from the first
+    ## and last which are cut to the period
+    def make_sales_windows(self, start, end):
+        global sales_window
+        if sales_window == None:
+            return [(start, end)]
+        
+        start_date = datetime.datetime.strptime(start, '%Y-%m-%d').date()
+        end_date = datetime.datetime.strptime(end, '%Y-%m-%d').date()
+        windows = []
+        window_start = start_date
+        while window_start <= end_date:
+            if sales_window == 'week':
+                window_end = window_start + datetime.timedelta(days = 6 - window_start.weekday())
+            elif sales_window == 'month':
+                next_month = (window_start.replace(day = 28) + datetime.timedelta(days = 4)).replace(day = 1)
+                window_end = next_month - datetime.timedelta(days = 1)
+            else:
+                raise RuntimeError('Unknown sales window ' + str(sales_window))
+            window_end = min(window_end, end_date)
+            windows.append((window_start.strftime('%Y-%m-%d'), window_end.strftime('%Y-%m-%d')))
+            window_start = window_end + datetime.timedelta(days = 1)
+        
+        return windows
+    
+    ## Returns true if the current sales job is fetched in more than one
+    ## window
+    def is_windowed(self):
+        return len(self.sales_windows) > 1
+    
+    ## Apply the stored sales for the windows of the period to the machines
+    ## under the operators that have them. Returns the (operator id, window)
+    ## pairs that don't have to be downloaded
+    def load_stored_windows(self, ops):
+        global actor_index
+        stored_windows = set()
+        if self.store == None or self.is_windowed() == False:
+            return stored_windows
+        
+        for window in self.sales_windows:
+            stored = self.store.stored_sales_operators(window[0], window[1], [op.id for op in ops])
+            if len(stored) == 0:
+                continue
+            
+            machine_ids = set()
+            for op in ops:
+                if op.id in stored:
+                    stored_windows.add((op.id, window))
+                    self.window_done.setdefault(window, []).append(op.id)
+                    for machine in op.get_machines(recursive = True):
+                        machine_ids.add(machine.id)
+            for machine_id, source, count, amount in self.store.load_sales(window[0], window[1]):
+                if machine_id in machine_ids:
+                    self.merge_window_sales(actor_index.machine(machine_id), source, window, count, amount)
+        
+        ## operators with every window stored are done
+        for op in ops:
+            if all((op.id, window) in stored_windows for window in self.sales_windows) == True:
+                self.sales_done.append(op.id)
+        
+        if len(stored_windows) > 0:
+            print('Using stored sales data for ' + str(len(stored_windows)) + ' of ' + str(len(ops) * len(self.sales_windows)) + ' operator windows')
+        return stored_windows
+    
+    ## Save what the sales data job downloaded to the store, in one go. When
+    ## the period was fetched in windows, each window is saved too, and the
+    ## period gets the merged totals
+    def save_job_results(self, start, end):
+        if self.store == None:
+            return
+        
+        if self.is_windowed() == True:
+            window_rows = {}
+            self.sales_rows = []
+            with self.sales_lock:
+                for (machine_id, source), windows in self.window_sales.items():
+                    for window, (count, amount) in windows.items():
+                        window_rows.setdefault(window, []).append([machine_id, source, count, amount])
+                    count, amount = self.window_totals(windows)
+                    self.sales_rows.append([machine_id, source, count, amount])
+                
+                self.sales_details = []
+                for machine_id in self.window_details:
+                    machine = actor_index.machine(machine_id)
+                    self.sales_details.append([machine_id, machine.dtu, machine.vpos, machine.sim, machine.rssi, machine.fw_dtu, machine.fw_vpos])
+            
+            for window in self.sales_windows:
+                self.store.save_sales(window[0], window[1], window_rows.get(window, []), [], self.window_done.get(window, []), ttl = self.sales_cache_ttl(window[1]))
+        else:
+            ## machines fetched in date shards have their merged totals
+            with self.sales_lock:
+                for (machine_id, source), windows in self.window_sales.items():
+                    count, amount = self.window_totals(windows)
+                    self.sales_rows.append([machine_id, source, count, amount])
+                for machine_id in self.window_details:
+                    machine = actor_index.machine(machine_id)
+                    self.sales_details.append([machine_id, machine.dtu, machine.vpos, machine.sim, machine.rssi, machine.fw_dtu, machine.fw_vpos])
+        
+        self.store.save_sales(start, end, self.sales_rows, self.sales_details, self.sales_done, ttl = self.sales_cache_ttl(end))
+        self.store.save_histories(self.history_events)
+        self.store.save_request_costs(self.sales_costs)
+        self.sales_costs = []
+        self.sales_rows = []
+        self.sales_details = []
+        self.sales_done = []
+        self.history_events = {}
+    
+    ## Apply the sales JSON that has arrived on a results queue so far (as
+    ## [task, [cash JSON, card JSON]]; in streaming mode it has been applied
+    ## already), and pass the operators that have new sales to on_update.
+    ## Runs on the main thread. Returns the operators
+    def ingest_sales_data(self, results, on_update = None):
+        operators = []
+        while True:
             try:
-                data = self.sales_data_queue_out.get_nowait()
-            ## Break if we can't get the data
-            except:
+                task, (j_cash, j_card) = results.get_nowait()
+            except queue.Empty:
                 break
             
-            j_cash = data[0]
-            j_card = data[1]
+            self.process_sales_data(j_cash, j_card, task[3], task[0].request_actor())
+            ## the machines directly under an operator are shown with it
+            if task[0].type == 'direct':
+                operators.append(task[0].operator)
+            else:
+                operators.append(task[0])
+        
+        ## the totals are redone once for everything that has arrived (rows
+        ## streamed in on other threads are published here too), so they
+        ## don't change while on_update goes over the rows
+        actor_index.publish_sales()
+        if on_update != None and len(operators) > 0:
+            on_update(operators)
+        return operators
+    
+    ## Note that some of the sales requests for an operator in a window have
+    ## been done. The window is done once both cash and card have been, and
+    ## the operator once all of its windows have been
+    def sales_task_done(self, operator, payment_methods, window):
+        with self.sales_lock:
+            pending = self.sales_pending.get((operator.id, window))
+            if pending == None:
+                return
+            pending.difference_update(payment_methods)
+            if len(pending) > 0:
+                return
+            del self.sales_pending[(operator.id, window)]
+            self.window_done.setdefault(window, []).append(operator.id)
             
-            ## Process the JSON data for cash
+            windows = self.sales_pending_windows[operator.id]
+            windows.discard(window)
+            if len(windows) == 0:
+                del self.sales_pending_windows[operator.id]
+                self.sales_done.append(operator.id)
+    
+    ## Apply the cash and card sales summary JSON for an operator to its
+    ## machines. Either can be None if it was a separate task
+    def process_sales_data(self, j_cash, j_card, window = None, actor = None):
+        ## Process the JSON data for cash
+        if j_cash != None:
             for entry in j_cash['data'][1]:
-                machine_id = int(entry['machine_id'])
-                try:
-                    cash_amount = entry['total_amount']
-                except:
-                    cash_amount = 0
-                    
-                try:
-                    cash_count = entry['total_count']
-                except:
-                    cash_count = 0
+                self.apply_sales_row(3, entry, window, actor)
                     
-                ## Pull out some machine info, since that is supplied in the JSON too
-                rssi = entry['ex_rssi']
-                dtu = entry['ex_device_number']
-                vpos = entry['ex_vpos_serial']
-                fw_dtu = entry['ex_device_fw_existing']
-                fw_vpos = entry['ex_vpos_fw_existing']
-                sim = entry['ex_sim_card_serial']
-                
-                ## Add the sales data to the applicable machine
-                for machine in machine_list:
-                    if int(machine.id) == machine_id:
-                        #callback('' + str(machine_id) + ' cash - $' + str(cash_amount) + ' (' + str(cash_count) + ')...')
-                        machine.sales['cash'] = [cash_count, cash_amount]
-                        
-                        ## Add the info to the machine
-                        machine.dtu = dtu
-                        machine.fw_dtu = fw_dtu
-                        machine.vpos = vpos
-                        machine.fw_vpos = fw_vpos
-                        machine.sim = sim
-                        machine.rssi = rssi
-                        
-            ## Process the JSON data for cards
+        ## Process the JSON data for cards
+        if j_card != None:
             for entry in j_card['data'][1]:
-                machine_id = int(entry['machine_id'])
-                try:
-                    card_amount = entry['total_amount']
-                except:
-                    card_amount = 0
-                    
-                try:
-                    card_count = entry['total_count']
-                except:
-                    card_count = 0                
-                                
-                ## Add the sales data to the applicable machine
-                for machine in machine_list:
-                    if int(machine.id) == machine_id:
-                        #callback('' + str(machine_id) + ' card - $' + str(card_amount) + ' (' + str(card_count) + ')...')
-                        machine.sales['card'] = [card_count, card_amount]
+                self.apply_sales_row(1, entry, window, actor)
+    
+    ## Total count and amount of a machine's sales over the windows
+    ## (window -> [count, amount]). The amounts are added as decimals so
+    ## that the total comes out the same as it would from one request
+    def window_totals(self, windows):
+        count = 0
+        amount = decimal.Decimal(0)
+        for window_count, window_amount in windows.values():
+            count += window_count
+            amount += decimal.Decimal(str(window_amount))
+        return count, float(amount)
+    
+    ## Set a machine's sales for one window of the period, and its sales to
+    ## the total over the windows so far. A window applied again (e.g. from a
+    ## retry) replaces what it had before
+    def merge_window_sales(self, machine, source, window, count, amount):
+        with self.sales_lock:
+            windows = self.window_sales.setdefault((machine.id, source), {})
+            windows[window] = [count, amount]
+            count, amount = self.window_totals(windows)
+        machine.set_sales(source, count, amount)
+    
+    ## Apply a single machine row from a sales summary to its machine.
+    ## Payment method 3 is cash and 1 is card. When the period is fetched in
+    ## windows or date shards, the window ((start, end) dates) that the row
+    ## is for is needed to merge it. Rows for machines that the request for
+    ## the actor doesn't cover are left out
+    def apply_sales_row(self, payment_method, entry, window = None, actor = None):
+        machine_id = int(entry['machine_id'])
+        if actor != None:
+            machine_ids = self.sales_filters.get(int(actor))
+            if machine_ids != None and machine_id not in machine_ids:
+                return
+
+        try:
+            amount = entry['total_amount']
+        except:
+            amount = 0
+            
+        try:
+            count = entry['total_count']
+        except:
+            count = 0
         
-        ## If we get to here, processing of JSON data is complete
-        callback('Data processing complete. Checking for active machines..')
+        ## Add the sales data to the applicable machine
+        machine = actor_index.machine(machine_id)
+        if machine == None:
+            return
+        
+        ## Windows (and date shards) are merged, and the machine info comes
+        ## from the latest window the machine has a row in. What is kept for
+        ## the store is worked out from the windows at the end
+        if self.is_windowed() == True or (window != None and window not in self.sales_windows):
+            if payment_method == 3:
+                self.merge_window_sales(machine, 'cash', window, count, amount)
+                with self.sales_lock:
+                    latest = self.window_details.get(machine_id)
+                    if latest == None or latest <= window[1]:
+                        self.window_details[machine_id] = window[1]
+                        self.apply_sales_details(machine, entry)
+            else:
+                self.merge_window_sales(machine, 'card', window, count, amount)
+            return
         
-        ## check for active machines (threaded)
-        pool = ThreadPool(processes = worker_count)
-        workers = []
-        ## push out data to the workers
-        for machine in operator.get_machines(recursive = True):
-            workers.append([machine, pool.apply_async(self.is_machine_active, (machine, start, end, ))])            
+        if payment_method == 3:
+            machine.set_sales('cash', count, amount)
+            self.apply_sales_details(machine, entry)
+            
+            ## kept for the store
+            self.sales_rows.append([machine_id, 'cash', count, amount])
+            self.sales_details.append([machine_id, machine.dtu, machine.vpos, machine.sim, machine.rssi, machine.fw_dtu, machine.fw_vpos])
+        else:
+            machine.set_sales('card', count, amount)
+            self.sales_rows.append([machine_id, 'card', count, amount])
+    
+    ## Pull out some machine info from a cash sales row, since that is
+    ## supplied in the cash JSON too
+    def apply_sales_details(self, machine, entry):
+        machine.dtu = entry['ex_device_number']
+        machine.fw_dtu = intern_text(entry['ex_device_fw_existing'])
+        machine.vpos = entry['ex_vpos_serial']
+        machine.fw_vpos = intern_text(entry['ex_vpos_fw_existing'])
+        machine.sim = entry['ex_sim_card_serial']
+        machine.rssi = entry['ex_rssi']
+    
+    ## Stream the sales summary for an actor, applying each machine row as it
+    ## arrives. Uses (and fills) the response cache. Returns the row count
+    def stream_sales_summary(self, actor, start, end, payment_method):
+        global stream_chunk_size, retry_count
+        key = self.sales_cache_key(actor, start, end, payment_method)
+        parser = SalesRowParser()
+        rows = 0
+        
+        ## Read it back from the cache if we have it
+        if self.cache != None:
+            cached = self.cache.open(key)
+            if cached != None:
+                with cached:
+                    for chunk in iter(lambda: cached.read(stream_chunk_size), ''):
+                        for entry in parser.feed(chunk):
+                            self.apply_sales_row(payment_method, entry, (start, end), actor)
+                            rows += 1
+                parser.close()
+                return rows
+        
+        ## The connection can drop or time out part way through the body, so
+        ## the whole download is retried. Rows are applied by assignment, so
+        ## applying them again from a retry is harmless
+        deadline = getattr(self.local, 'deadline', None)
+        attempt = 0
+        while True:
+            started = time.time()
+            response = self.make_request(self.sales_summary_path(actor, start, end, payment_method), stream = True)
+            if response.encoding == None:
+                response.encoding = 'utf-8'
             
-        ## get the results
-        for machine, child in workers:
-            callback('Checking active machines (' + str(workers.index([machine, child])) + '/' + str(len(workers)) + ')...')
-            active = child.get()
-            #print(machine.name + ' active? ' + str(active))
-            machine.active = active
+            ## Write the response to the cache as it streams past
+            writer = None
+            if self.cache != None:
+                writer = self.cache.writer(key, ttl = self.sales_cache_ttl(end))
+            
+            parser = SalesRowParser()
+            rows = 0
+            size = 0
+            try:
+                for chunk in response.iter_content(chunk_size = stream_chunk_size, decode_unicode = True):
+                    size += len(chunk)
+                    if writer != None:
+                        writer.write(chunk)
+                    for entry in parser.feed(chunk):
+                        self.apply_sales_row(payment_method, entry, (start, end), actor)
+                        rows += 1
+                parser.close()
+            except (requests.exceptions.ConnectionError, requests.exceptions.ChunkedEncodingError, requests.exceptions.Timeout) as e:
+                if writer != None:
+                    writer.abort()
+                attempt += 1
+                if attempt >= retry_count or self.deadline_passed(deadline) == True:
+                    raise RuntimeError('Sales summary for actor ' + str(actor) + ' failed part way through (' + type(e).__name__ + ')')
+                self.count_retry()
+                delay = self.retry_delay(attempt, deadline)
+                print('Sales summary for actor ' + str(actor) + ' failed part way through (' + type(e).__name__ + '). Retrying in ' + '{:.1f}'.format(delay) + 's...')
+                time.sleep(delay)
+                continue
+            except:
+                if writer != None:
+                    writer.abort()
+                raise
+            finally:
+                response.close()
             
-        callback('Sales data loaded')
+            break
         
-    ## Finds out if a machine was active during the specified sales period
-    def is_machine_active(self, actor, start_date, end_date):
-        ## we don't care about operators, only machines
+        self.record_sales_cost(actor, payment_method, rows, size, time.time() - started)
+        
+        ## only keep it in the cache once the whole thing has parsed
+        if writer != None:
+            writer.commit()
+        
+        return rows
+    
+    ## Returns true if the machine history is needed to decide whether a
+    ## machine was active (machines with card sales are always active)
+    def needs_history(self, actor):
         if actor.type != 'machine':
-            return None
+            return False
+        elif actor.card_count != 0 and actor.card_count != None:
+            return False
+        else:
+            return True
         
-        ## data dates have to be specified
+    ## Get the status change events ([time, status], oldest first) from
+    ## machine history XML and add the new ones to the activity index,
+    ## keeping them for the store
+    def parse_history_events(self, actor, history):
+        global cache_history_ttl
+        event_list = []
+        
+        ## get the active/not active events
+        for entry in re.finditer(r'<machineHistory[^<>]*changed_item="Status"[^<>]*changed_to="((Active)|(Not Active))" updated_at="(\d{4}\-\d{2}\-\d{2}T\d{2}:\d{2}:\d{2})[\.\d]*"', history):
+            event = entry.group(1)
+            stamp_dt = datetime.datetime.strptime(entry.group(4), '%Y-%m-%dT%H:%M:%S')
+            event_list.append([stamp_dt, event])
+        
+        event_list = sorted(event_list)
+        added = self.activity.add(actor.id, event_list, ttl = cache_history_ttl)
+        fetched, expires = self.activity.checked[actor.id]
+        self.history_events[actor.id] = [fetched, expires, added]
+        return event_list
+    
+    ## Get the status change events of a machine from its history (which is
+    ## downloaded unless it is passed in)
+    def get_history_events(self, actor, history = None):
+        if history == None:
+            history = self.get_history(actor.id)
+        return self.parse_history_events(actor, history)
+    
+    ## The start and end of a sales period as datetimes, or None if the dates
+    ## aren't valid
+    def activity_period(self, start_date, end_date):
         try:
             start = datetime.datetime.strptime(start_date + ' 00:00:00', '%Y-%m-%d %H:%M:%S')
             end = datetime.datetime.strptime(end_date + ' 00:00:00', '%Y-%m-%d %H:%M:%S')
-        except:
-            print('Could not check if ' + str(actor.name) + ' was active because sales data dates were not specified!')
+        except (TypeError, ValueError):
             return None
-            
+        return [start, end]
+    
+    ## Finds out if a machine was active between start and end (datetimes)
+    ## without downloading anything. None if its history needs checking
+    ## first
+    def known_activity(self, actor, start, end):
         ## machines with card sales are active
-        if actor.sales['card'][0] != 0 and actor.sales['card'][0] != None:
-            #print(str(actor.name) + ' active overridden because it has sales')
-            return True  
+        if self.needs_history(actor) == False:
+            return True
+        ## the history has to have been checked since the end day finished,
+        ## or recently enough to still be up to date
+        if self.activity.is_current(actor.id, end + datetime.timedelta(days = 1)) == False:
+            return None
+        return self.activity.was_active(actor.id, start, end, actor.active_now)
+    
+    ## Work out which machines were active during the sales period from the
+    ## activity index, where it is up to date. Returns machine id -> active,
+    ## and the machines whose histories have to be checked
+    def check_active_locally(self, machines, start_date, end_date):
+        period = self.activity_period(start_date, end_date)
+        active = {}
+        unknown = []
+        for machine in machines:
+            result = None
+            if period != None:
+                result = self.known_activity(machine, period[0], period[1])
+            if result == None:
+                unknown.append(machine)
+            else:
+                active[machine.id] = result
+        return active, unknown
     
-        ## get the history tab
-        response = self.make_request('public/facade.aspx?model=operations/machine&action=MachineHistory.Get&&machine_id=' + str(actor.id))
+    ## Finds out if a machine was active during the specified sales period.
+    ## The activity index is used if it is up to date, otherwise the newer
+    ## events are added from the history (which is downloaded unless it is
+    ## passed in)
+    def is_machine_active(self, actor, start_date, end_date, history = None):
+        ## we don't care about operators, only machines
+        if actor.type != 'machine':
+            return None
         
-        event_list = []
+        ## data dates have to be specified
+        period = self.activity_period(start_date, end_date)
+        if period == None:
+            print('Could not check if ' + str(actor.name) + ' was active because sales data dates were not specified!')
+            return None
+        start, end = period
         
-        ## get the active/not active events
-        for entry in re.finditer(r'<machineHistory[^<>]*changed_item="Status"[^<>]*changed_to="((Active)|(Not Active))" updated_at="(\d{4}\-\d{2}\-\d{2}T\d{2}:\d{2}:\d{2})[\.\d]*"', response.text):
-            event = entry.group(1)
-            stamp_dt = datetime.datetime.strptime(entry.group(4), '%Y-%m-%dT%H:%M:%S')
-            event_list.append([stamp_dt, event])            
+        if history == None:
+            active = self.known_activity(actor, start, end)
+            if active != None:
+                return active
+        ## machines with card sales are active
+        elif self.needs_history(actor) == False:
+            return True
+    
+        ## get the active/not active events from the history tab
+        self.get_history_events(actor, history)
+        return self.activity.was_active(actor.id, start, end, actor.active_now)
 
-        ## the issue with Nayax event history is that they are often missing
-        ## so we have to infer status from the absence of certain events, or
-        ## the current status
-         
-        ## sort the event list by time and pull out the cloest events before and after our range
-        event_list = sorted(event_list)
-        history = [datetime.datetime.strptime('2000-01-01 00:00:00', '%Y-%m-%d %H:%M:%S'), None]      
-        future = [datetime.datetime.strptime('2100-01-01 00:00:00', '%Y-%m-%d %H:%M:%S'), None]
-        active_in_period = False
-        for stamp, event in event_list:
-            #print('DEBUG_IMA ' + str(stamp) + ' event: ' + str(event))
-            if stamp < start and stamp > history[0]:
-                history = [stamp, event]
-            elif stamp > end and stamp < future[0]:
-                future = [stamp, event]
-            else:
-                active_in_period = True
-            
-        ## if we still dont think it's active, check the close events
-        
-        ## look for a transition to active before this period
-        if str(history[1]) == 'Active':
-            #print(str(actor.name) + ' active from past activity')
-            active_in_period = True
-        ## or a transition to not active after this period
-        elif str(future[1]) == 'Not Active':
-            #print(str(actor.name) + ' active from future inactivity')
-            active_in_period = True            
-        ## if there were no events, we just have to assume the current status
-        ## is correct
-        if len(event_list) == 0 and actor.active_now == True:
-            #print(str(actor.name) + ' active assumed due to lack of events')
-            active_in_period = True
-        
-        return active_in_period   
+## asyncio engine for bulk Nayax operations. All requests run on one event
+## loop in a background thread, with a semaphore limiting how many are in
+## flight, so hundreds of requests don't need hundreds of threads
+class AsyncEngine():
+    ## Initialise the engine and start its event loop
+    def __init__(self, nayax, concurrency = None):
+        global async_concurrency
+        
+        self.nayax = nayax
+        if concurrency == None:
+            concurrency = async_concurrency
+        self.concurrency = concurrency
+        
+        ## session and semaphore belong to the loop, so they are made on it
+        self.session = None
+        self.session_generation = None
+        self.old_sessions = []
+        self.semaphore = None
+        self.session_lock = None
+        ## read requests in flight, by path
+        self.flights = {}
+        
+        ## progress counters and deadline for the job currently running
+        self.total = 0
+        self.completed = 0
+        self.deadline = None
+        
+        ## Run the event loop forever in a background thread
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target = self.loop.run_forever, daemon = True)
+        self.thread.start()
+    
+    ## Run a coroutine on the engine loop and wait for the result, passing
+    ## progress to the callback while we wait. Requests are not started (or
+    ## retried) after the deadline, or once the job has been cancelled
+    def run(self, coroutine, callback = None, message = 'Working', deadline = None, progress = None, poll = None):
+        if callback == None:
+            callback = print
+        
+        self.total = 0
+        self.completed = 0
+        self.deadline = deadline
+        future = asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+        while future.done() == False:
+            if self.nayax.cancelled == True:
+                self.cancel()
+            
+            ## anything to do on the main thread while waiting
+            if poll != None:
+                poll()
+            
+            eta = ''
+            if progress != None:
+                eta = progress.describe()
+            callback(message + ' - ' + str(self.total - self.completed) + ' remaining' + eta + '..' + self.nayax.progress_info())
+            time.sleep(0.1)
+        
+        if self.nayax.cancelled == True:
+            callback('Job cancelled..')
+            print('Job cancelled')
+        return future.result()
+    
+    ## Stop the current run starting (or retrying) requests. Requests in
+    ## progress are left to finish
+    def cancel(self):
+        self.deadline = time.time()
+    
+    ## Run a task, logging and counting it as failed if it raises, so that one
+    ## failure doesn't take down the whole job. Returns None if it failed
+    async def guard(self, coroutine, description):
+        try:
+            return await coroutine
+        except Exception as e:
+            print('Failed to ' + description + ': ' + str(e))
+            self.nayax.count_failure()
+            return None
+    
+    ## Stop the event loop and close the sessions
+    def stop(self):
+        for session in self.old_sessions:
+            asyncio.run_coroutine_threadsafe(session.close(), self.loop).result()
+        if self.session != None:
+            asyncio.run_coroutine_threadsafe(self.session.close(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join(5)
+    
+    ## Get the shared aiohttp session, replacing it if the login cookies or
+    ## headers have changed since it was made
+    async def get_session(self):
+        global connect_timeout, read_timeout
+        if self.semaphore == None:
+            self.semaphore = asyncio.Semaphore(self.concurrency)
+            self.session_lock = asyncio.Lock()
+        
+        async with self.session_lock:
+            if self.session == None or self.session_generation != self.nayax.session_generation:
+                ## requests may still be using the old session, so it is
+                ## closed when the engine stops
+                if self.session != None:
+                    self.old_sessions.append(self.session)
+                
+                ## cookies may be a requests cookie jar, so convert them
+                cookies = {}
+                for name in self.nayax.cookies.keys():
+                    cookies[name] = self.nayax.cookies[name]
+                
+                ## unsafe lets cookies be sent to IP addresses (local stand-ins)
+                connector = aiohttp.TCPConnector(limit = self.concurrency)
+                timeout = aiohttp.ClientTimeout(sock_connect = connect_timeout, sock_read = read_timeout)
+                self.session = aiohttp.ClientSession(connector = connector, headers = self.nayax.headers, cookies = cookies, cookie_jar = aiohttp.CookieJar(unsafe = True), timeout = timeout)
+                self.session_generation = self.nayax.session_generation
+        
+        return self.session
+    
+    ## Makes a request to the Nayax website and returns the response text.
+    ## Identical read requests share one request while it is in flight, and
+    ## responses remembered by Nayax.make_request are used. If on_chunk is
+    ## given, the text is passed to it a chunk at a time instead
+    async def make_request(self, path, post = {}, json = {}, on_chunk = None):
+        global request_write_actions
+        kind = self.nayax.request_kind(path)
+        
+        ## Writes make what was remembered for the machine out of date
+        if kind in request_write_actions:
+            self.nayax.memo_invalidate(path)
+            try:
+                return await self.send_request(path, post = post, json = json)
+            finally:
+                self.nayax.memo_invalidate(path)
+        
+        if on_chunk != None or self.nayax.is_read_request(kind, post, json) == False:
+            return await self.send_request(path, post = post, json = json, on_chunk = on_chunk)
+        
+        response = self.nayax.memo_get(path)
+        if response != None:
+            return response.text
+        
+        ## Join the request if it is already being made
+        flight = self.flights.get(path)
+        if flight != None:
+            return await asyncio.shield(flight)
+        
+        flight = self.loop.create_future()
+        self.flights[path] = flight
+        with self.nayax.memo_lock:
+            writes = self.nayax.write_count(self.nayax.request_machine(path))
+        try:
+            text = await self.send_request(path, post = post, json = json)
+        except Exception as e:
+            flight.set_exception(e)
+            ## nobody may be waiting, so don't let asyncio complain about it
+            flight.exception()
+            raise
+        finally:
+            del self.flights[path]
+        
+        self.nayax.memo_put_text(path, text, writes)
+        flight.set_result(text)
+        return text
+    
+    ## Sends a request to the Nayax website and returns the response text.
+    ## Follows the same GET/POST and retry rules as Nayax.send_request. If
+    ## on_chunk is given, the text is passed to it a chunk at a time instead
+    async def send_request(self, path, post = {}, json = {}, on_chunk = None):
+        global retry_count
+        url = self.nayax.base_URL + path
+        kind = self.nayax.request_kind(path)
+        text = None
+        problem = None
+        succeeded = False
+        
+        if self.nayax.logged_in == False:
+            raise RuntimeError('Tried to make request for ' + path + ' but we are not logged in')
+        
+        ## make sure the session and semaphore exist
+        await self.get_session()
+        self.total += 1
+        
+        ## If we have POST or JSON data, it's a POST request. aiohttp won't
+        ## take empty data and json together
+        method = 'GET'
+        if post != {} or json != {}:
+            method = 'POST'
+            if post == {}:
+                post = None
+            if json == {}:
+                json = None
+        else:
+            post = None
+            json = None
+        
+        ## Loop so that we can do retries. Logging in again after the session
+        ## expired doesn't count as a failed attempt, but is limited too. The
+        ## login count is taken as each request is sent
+        attempt = 0
+        relogins = 0
+        login_count = None
+        try:
+            while True:
+                ## Log in again if the session expired (Nayax.login blocks, so
+                ## it runs off the loop)
+                if problem == 'session expired':
+                    relogins += 1
+                    if relogins > retry_count:
+                        break
+                    await self.loop.run_in_executor(None, self.nayax.relogin, login_count)
+                ## Wait a bit longer after each failure. The slot is given up
+                ## while we wait
+                elif problem != None:
+                    attempt += 1
+                    if attempt >= retry_count:
+                        break
+                    self.nayax.count_retry()
+                    delay = self.nayax.retry_delay(attempt, self.deadline)
+                    print('Request for ' + url + ' failed (' + problem + '). Retrying in ' + '{:.1f}'.format(delay) + 's (' + str(attempt) + '/' + str(retry_count - 1) + ')...')
+                    await asyncio.sleep(delay)
+                
+                ## Don't start anything new once the job has run out of time
+                if self.nayax.deadline_passed(self.deadline) == True:
+                    problem = 'job deadline passed'
+                    break
+                
+                ## Wait for our turn under the rate limit
+                delay = self.nayax.request_bucket(kind).reserve()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                
+                ## Hold off while someone else is logging in again
+                while self.nayax.auth_ready.is_set() == False:
+                    await asyncio.sleep(0.1)
+                login_count = self.nayax.login_count
+                
+                ## Wait until the limiter lets another request through (it
+                ## learns from how these go, like threaded requests), then
+                ## for a free slot before making the request
+                await self.nayax.limiter.acquire_async()
+                
+                ## the job may have been cancelled while we waited
+                if self.nayax.deadline_passed(self.deadline) == True:
+                    self.nayax.limiter.give_back()
+                    problem = 'job deadline passed'
+                    break
+                
+                latency = None
+                try:
+                    async with self.semaphore:
+                        ## the session may have been replaced while we waited
+                        session = await self.get_session()
+                        started = time.time()
+                        try:
+                            async with session.request(method, url, data = post, json = json) as response:
+                                ## Server errors mean Nayax is struggling, so retry
+                                if response.status >= 500:
+                                    problem = 'HTTP ' + str(response.status)
+                                    continue
+                                latency = time.time() - started
+                                
+                                ## An expired session gets the login page back
+                                ## (only HTML is read to check)
+                                if 'html' in response.headers.get('Content-Type', '') or 'LoginPage.aspx' in str(response.url):
+                                    page = await response.text()
+                                    if self.nayax.is_login_page(response.url, page) == True:
+                                        problem = 'session expired'
+                                        continue
+                                    text = self.pass_text(page, on_chunk)
+                                else:
+                                    text = await self.read_response(response, on_chunk)
+                        ## Connection errors, broken bodies and timeouts are retried
+                        except (aiohttp.ClientConnectionError, aiohttp.ClientPayloadError, asyncio.TimeoutError) as e:
+                            problem = type(e).__name__
+                            continue
+                ## the limiter gets its slot back however it went. Anything
+                ## that didn't get a response counts as failed
+                finally:
+                    self.nayax.limiter.release(kind, latency = latency, failed = latency == None)
+                
+                ## If it worked, break the retry loop
+                succeeded = True
+                break
+        finally:
+            self.completed += 1
+        
+        if succeeded == False:
+            raise RuntimeError('Request for ' + url + ' failed (' + str(problem) + ')')
+        
+        return text
+    
+    ## Read the text of a response, either all at once or a chunk at a time.
+    ## on_chunk gets None first so it knows a new response is starting
+    async def read_response(self, response, on_chunk = None):
+        global stream_chunk_size
+        if on_chunk == None:
+            return await response.text()
+        
+        decoder = codecs.getincrementaldecoder(response.get_encoding())(errors = 'replace')
+        on_chunk(None)
+        async for chunk in response.content.iter_chunked(stream_chunk_size):
+            on_chunk(decoder.decode(chunk))
+        on_chunk(decoder.decode(b'', final = True))
+        return None
+    
+    ## Hand text that has already been read on like read_response would
+    def pass_text(self, text, on_chunk = None):
+        if on_chunk == None:
+            return text
+        
+        on_chunk(None)
+        on_chunk(text)
+        return None
+    
+    ## Make a list of [path, post, json] requests. Returns the response text
+    ## for each in the same order (None for any that failed)
+    async def run_requests(self, request_list):
+        tasks = []
+        for path, post, json_data in request_list:
+            tasks.append(self.guard(self.make_request(path, post = post, json = json_data), 'request ' + path))
+            
+        return await asyncio.gather(*tasks)
+    
+    ## Get the product map JSON for each of the target machines
+    async def get_product_map_json(self, targets):
+        tasks = []
+        for machine in targets:
+            tasks.append(self.guard(self.get_product_map(machine), 'get product map for ' + str(machine.name)))
+        
+        json_data = []
+        for data in await asyncio.gather(*tasks):
+            if data != None:
+                json_data.append(data)
+            
+        return json_data
+    
+    ## Get the product map JSON for a single machine
+    async def get_product_map(self, machine):
+        return json.loads(await self.make_request(self.nayax.product_map_path(machine.id)))
+    
+    ## Get the sales summary JSON for an actor, using the Nayax response
+    ## cache
+    async def get_sales_summary(self, actor, start, end, payment_method):
+        cache = self.nayax.cache
+        key = self.nayax.sales_cache_key(actor, start, end, payment_method)
+        
+        if stream_sales_data == True:
+            return await self.stream_sales_summary(actor, start, end, payment_method)
+        
+        ## the cache is on disk, so it is read and written off the loop
+        if cache != None:
+            text = await self.loop.run_in_executor(None, cache.get, key)
+            if text != None:
+                return json.loads(text)
+        
+        started = time.time()
+        text = await self.make_request(self.nayax.sales_summary_path(actor, start, end, payment_method))
+        json_data = json.loads(text)
+        self.nayax.record_sales_cost(actor, payment_method, self.nayax.sales_row_count(json_data), len(text), time.time() - started)
+        
+        if cache != None:
+            await self.loop.run_in_executor(None, lambda: cache.put(key, text, ttl = self.nayax.sales_cache_ttl(end)))
+            
+        return json_data
+    
+    ## Stream the sales summary for an actor, applying each machine row as it
+    ## arrives. Cached responses are read back a chunk at a time
+    async def stream_sales_summary(self, actor, start, end, payment_method):
+        global stream_chunk_size
+        cache = self.nayax.cache
+        key = self.nayax.sales_cache_key(actor, start, end, payment_method)
+        
+        ## cached responses are read back by the normal streaming code, in a
+        ## worker thread so that the requests in flight aren't held up while
+        ## it parses
+        if cache != None:
+            cached = await self.loop.run_in_executor(None, cache.open, key)
+            if cached != None:
+                cached.close()
+                await self.loop.run_in_executor(None, self.nayax.stream_sales_summary, actor, start, end, payment_method)
+                return None
+        
+        ## None is passed at the start of each response, since a retried
+        ## request starts again from the beginning
+        state = {'parser': None, 'writer': None, 'rows': 0, 'size': 0, 'started': None}
+        def on_chunk(text):
+            if text == None:
+                if state['writer'] != None:
+                    state['writer'].abort()
+                state['parser'] = SalesRowParser()
+                state['rows'] = 0
+                state['size'] = 0
+                state['started'] = time.time()
+                if cache != None:
+                    state['writer'] = cache.writer(key, ttl = self.nayax.sales_cache_ttl(end))
+                return
+            
+            state['size'] += len(text)
+            if state['writer'] != None:
+                state['writer'].write(text)
+            for entry in state['parser'].feed(text):
+                state['rows'] += 1
+                self.nayax.apply_sales_row(payment_method, entry, (start, end), actor)
+        
+        try:
+            await self.make_request(self.nayax.sales_summary_path(actor, start, end, payment_method), on_chunk = on_chunk)
+            if state['parser'] == None:
+                raise ValueError('No sales summary received for actor ' + str(actor))
+            state['parser'].close()
+        except:
+            if state['writer'] != None:
+                state['writer'].abort()
+            raise
+        
+        self.nayax.record_sales_cost(actor, payment_method, state['rows'], state['size'], time.time() - state['started'])
+        
+        if state['writer'] != None:
+            state['writer'].commit()
+        
+        return None
+    
+    ## Get the sales JSON for a task from a sales plan (cash, card or both
+    ## for an operator in a window). The cash and card JSON (None for any
+    ## that weren't part of the task, or in streaming mode) go on the results
+    ## queue for the main thread, like a job's results
+    async def get_operator_sales_data(self, task, results):
+        op = task[0]
+        payment_methods = task[1]
+        start, end = task[3]
+        self.nayax.sales_progress.start(task)
+        try:
+            summaries = await asyncio.gather(*[self.get_sales_summary(op.request_actor(), start, end, payment_method) for payment_method in payment_methods])
+        finally:
+            self.nayax.sales_progress.finish(task)
+        
+        json_data = dict(zip(payment_methods, summaries))
+        self.nayax.sales_task_done(op, payment_methods, task[3])
+        results.put([task, [json_data.get(3), json_data.get(1)]])
+    
+    ## Get the cash and card sales JSON for each of the tasks, in order
+    ## (longest first). The results go on the results queue as each task
+    ## finishes
+    async def get_sales_data(self, sales_tasks, results):
+        tasks = []
+        for task in sales_tasks:
+            tasks.append(self.guard(self.get_operator_sales_data(task, results), 'get sales data for ' + str(task[0].name)))
+        
+        await asyncio.gather(*tasks)
+    
+    ## Find out if a single machine was active during the period
+    async def is_machine_active(self, machine, start, end):
+        history = ''
+        if self.nayax.needs_history(machine) == True:
+            cache = self.nayax.cache
+            key = self.nayax.history_cache_key(machine.id)
+            history = None
+            ## the cache is on disk, so it is read and written off the loop
+            if cache != None:
+                history = await self.loop.run_in_executor(None, cache.get, key)
+            if history == None:
+                history = await self.make_request(self.nayax.history_path(machine.id))
+                if cache != None and history != None:
+                    await self.loop.run_in_executor(None, lambda: cache.put(key, history, ttl = cache_history_ttl))
+        
+        return self.nayax.is_machine_active(machine, start, end, history = history)
+    
+    ## Find out which machines were active during the period. Returns a list
+    ## of [machine, active]. Active is None if it couldn't be checked
+    async def check_active_machines(self, machines, start, end):
+        tasks = []
+        for machine in machines:
+            tasks.append(self.guard(self.is_machine_active(machine, start, end), 'check if ' + str(machine.name) + ' was active'))
+        
+        results = []
+        for machine, active in zip(machines, await asyncio.gather(*tasks)):
+            results.append([machine, active])
+            
+        return results
             
 ## GUI class
 class GUI():
@@ -970,11 +4519,13 @@ class GUI():
     def __init__(self):
         ## Local variables
         self.nayax = None       
+        self.closing = False
     
         ## Root UI element
         self.root = Tk()
         self.root.title('Login')
         self.root.resizable(False, False)
+        self.root.protocol('WM_DELETE_WINDOW', self.close)
         
         ## Image assets
         self.image_machine = ImageTk.PhotoImage(Image.open('icons/machine.png'))
@@ -1010,6 +4561,25 @@ class GUI():
     def run(self):
         self.root.update()
         self.root.mainloop()
+        self.root.destroy()
+        
+        ## stop the worker threads once the window is closed
+        if self.nayax != None:
+            self.nayax.shutdown()
+    
+    ## Close the window. Anything that is running is cancelled, and the main
+    ## loop ends once it has stopped
+    def close(self):
+        self.closing = True
+        if self.nayax != None:
+            self.nayax.cancel_jobs()
+        self.root.quit()
+    
+    ## Cancel the job that is running, if there is one
+    def cancel_jobs(self):
+        if self.nayax != None:
+            self.nayax.cancel_jobs()
+            self.status.set('Cancelling..')
     
     ## Do the Nayax login
     def login(self, event = None):
@@ -1241,71 +4811,195 @@ class GUI():
         
         ## ...then everything else under that
         for entry in elements:
-            ## tag elements to colour them
-            if entry.active_now == False:
-                tag = ('inactive',)
-            else:
-                tag = ('active',)
-                
-            ## choose the icon based on whether it is an operator or machine
-            if entry.type == 'machine':
-                icon = self.image_machine
-            else:
-                icon = self.image_operator
-                
-            ## check whether this entry should be hidden
-            if entry.type == 'machine' and entry.active_now == False and self.menu_hide_inactive_machines.get() == True:
+            ## skip hidden entries
+            row = self.actor_row(entry)
+            if row == None:
                 continue
-                
-            if entry.type == 'operator':
-                if entry.active_now == False and self.menu_hide_inactive_operators.get() == True:
-                    continue
-                elif len(entry.get_machines(recursive = True)) == 0 and self.menu_hide_empty_operators.get() == True:
-                    continue               
-
-            ## get the sales figures (if available)
-            cash_count, cash_amount = entry.get_cash_sales()
-            card_count, card_amount = entry.get_card_sales()
-            
-            ## work out the totals               
-            if cash_count == None and card_count == None and entry.active == False:
-                show_sales = False
-            else:
-                ## there might have been cash sales but not card or
-                ## vice-versa. if so, set the other method to zero
-                ## otherwise we might be overriden for an active actor
-                if cash_count == None:
-                    cash_count = 0
-                    cash_amount = 0
-                    
-                if card_count == None:
-                    card_count = 0
-                    card_amount = 0     
-                
-                ## actually calculate the totals
-                total_count = cash_count + card_count
-                total_amount = cash_amount + card_amount
-                show_sales = True
+            tag, icon, values = row
             
             ## insert the element if not hidden. wrap in a try in case the parent is hidden
             try:
-                self.tree.insert(entry.parent, 'end', entry.id, text = entry.name, tags = tag, image = icon)
-                
-                ## if there are sales figures, populate them
-                if show_sales == True:       
-                    ## populate the figures with proper formatting
-                    self.tree.set(entry.id, 'cash', self.display_money(cash_amount) + ' (' + str(cash_count) + ')')
-                    self.tree.set(entry.id, 'card', self.display_money(card_amount) + ' (' + str(card_count) + ')')
-                    self.tree.set(entry.id, 'total', self.display_money(total_amount) + ' (' + str(total_count) + ')')
-                ## if not, put in placeholders
-                else:
-                    self.tree.set(entry.id, 'cash', '?')
-                    self.tree.set(entry.id, 'card', '?')
-                    self.tree.set(entry.id, 'total', '?')
+                self.tree.insert(entry.parent, 'end', entry.id, text = entry.name, tags = tag, image = icon, values = values)
             except:
                 print('WARNING: Actor ' + entry.name + ' has hidden parent!')
                 
         self.root.update()
+    
+    ## work out how an actor is shown in the tree. returns the tags, icon and
+    ## the cash, card and total sales columns, or None if it is hidden
+    def actor_row(self, entry):
+        ## tag elements to colour them
+        if entry.active_now == False:
+            tag = ('inactive',)
+        else:
+            tag = ('active',)
+            
+        ## choose the icon based on whether it is an operator or machine
+        if entry.type == 'machine':
+            icon = self.image_machine
+        else:
+            icon = self.image_operator
+            
+        ## check whether this entry should be hidden
+        if entry.type == 'machine' and entry.active_now == False and self.menu_hide_inactive_machines.get() == True:
+            return None
+            
+        if entry.type == 'operator':
+            if entry.active_now == False and self.menu_hide_inactive_operators.get() == True:
+                return None
+            elif entry.count_machines() == 0 and self.menu_hide_empty_operators.get() == True:
+                return None
+
+        ## get the sales figures (if available)
+        cash_count, cash_amount = entry.get_cash_sales()
+        card_count, card_amount = entry.get_card_sales()
+        
+        ## if there are no sales figures, put in placeholders
+        if cash_count == None and card_count == None and entry.active == False:
+            return tag, icon, ('?', '?', '?')
+        
+        ## there might have been cash sales but not card or
+        ## vice-versa. if so, set the other method to zero
+        ## otherwise we might be overriden for an active actor
+        if cash_count == None:
+            cash_count = 0
+            cash_amount = 0
+            
+        if card_count == None:
+            card_count = 0
+            card_amount = 0     
+        
+        ## actually calculate the totals
+        total_count = cash_count + card_count
+        total_amount = cash_amount + card_amount
+        
+        ## populate the figures with proper formatting
+        cash = self.display_money(cash_amount) + ' (' + str(cash_count) + ')'
+        card = self.display_money(card_amount) + ' (' + str(card_count) + ')'
+        total = self.display_money(total_amount) + ' (' + str(total_count) + ')'
+        return tag, icon, (cash, card, total)
+    
+    ## refresh the machine list from Nayax and update the tree rows that
+    ## changed
+    def refresh_machine_list(self):
+        self.status.set('Refreshing machine list...')
+        self.root.update()
+        
+        changes = self.nayax.refresh_machine_list()
+        self.update_actor_rows(changes)
+        
+        self.status.set('Machine list refreshed (' + str(len(changes['added'])) + ' added, ' + str(len(changes['removed'])) + ' removed, ' + str(len(changes['moved']) + len(changes['renamed']) + len(changes['recoloured'])) + ' changed)')
+        self.root.update()
+    
+    ## update only the tree rows affected by a machine list refresh. falls
+    ## back to redrawing the whole tree if rows have to come back that were
+    ## hidden along with everything under them
+    def update_actor_rows(self, changes):
+        global actor_index
+        root_op = self.nayax.find_root_operator()
+        if self.tree.exists(root_op.id) == False:
+            self.draw_actor_list()
+            return
+        
+        ## rows that have gone
+        for actor in changes['removed']:
+            if self.tree.exists(actor.id) == True:
+                self.tree.delete(actor.id)
+        
+        ## changed actors
+        changed = set()
+        for change in ['added', 'moved', 'renamed', 'recoloured']:
+            for actor in changes[change]:
+                if actor.entry != None:
+                    changed.add(actor)
+        
+        ## the operators above anything that changed have new totals (and
+        ## might now be empty)
+        for id in changes['parents']:
+            operator = actor_index.operator(id)
+            while operator != None and operator.entry != None and operator not in changed:
+                changed.add(operator)
+                operator = actor_index.operator(operator.parent)
+        
+        ## parents before children
+        added = set(changes['added'])
+        for actor in sorted(changed, key = lambda actor: actor.entry):
+            ## the root row doesn't show sales
+            if actor == root_op:
+                continue
+            
+            row = self.actor_row(actor)
+            exists = self.tree.exists(actor.id)
+            
+            ## newly hidden rows go, along with anything under them
+            if row == None:
+                if exists == True:
+                    self.tree.delete(actor.id)
+                continue
+            tag, icon, values = row
+            
+            if exists == True:
+                if self.tree.parent(actor.id) != str(actor.parent):
+                    if self.tree.exists(actor.parent) == False:
+                        self.tree.delete(actor.id)
+                        continue
+                    self.tree.move(actor.id, actor.parent, self.tree_position(actor))
+                self.tree.item(actor.id, text = actor.name, tags = tag, values = values)
+            ## an operator that was hidden before, so its children aren't
+            ## in the tree either
+            elif actor.type == 'operator' and actor not in added:
+                self.draw_actor_list()
+                return
+            elif self.tree.exists(actor.parent) == True:
+                self.tree.insert(actor.parent, self.tree_position(actor), actor.id, text = actor.name, tags = tag, image = icon, values = values)
+            else:
+                print('WARNING: Actor ' + actor.name + ' has hidden parent!')
+        
+        self.root.update()
+    
+    ## update the sales figures in the rows under operators whose sales have
+    ## just arrived, and in the operators above them
+    def update_sales_rows(self, operators):
+        global actor_index
+        root_op = self.nayax.find_root_operator()
+        
+        actors = set()
+        for operator in operators:
+            subtree = actor_index.subtree(operator)
+            if subtree != None:
+                actors.update(subtree)
+            ## the root row doesn't show sales
+            while operator != None and operator != root_op:
+                actors.add(operator)
+                operator = actor_index.operator(operator.parent)
+        
+        ## sales are only published between passes (by ingest_sales_data),
+        ## so the totals are redone at most once for all of these rows
+        for actor in actors:
+            if self.tree.exists(actor.id) == False:
+                continue
+            row = self.actor_row(actor)
+            if row != None:
+                self.tree.item(actor.id, values = row[2])
+        
+        self.root.update()
+    
+    ## where an actor goes among the rows under its parent, so that it ends up
+    ## where drawing the whole tree would put it
+    def tree_position(self, actor):
+        global actor_index
+        ## it goes after the closest sibling before it that is already in
+        ## place (rows still to be moved here or away are ignored)
+        previous = None
+        for sibling in actor_index.child_operators(actor.parent) + actor_index.child_machines(actor.parent):
+            if sibling == actor:
+                break
+            if self.tree.exists(sibling.id) == True and self.tree.parent(sibling.id) == str(actor.parent):
+                previous = sibling
+        
+        if previous == None:
+            return 0
+        return self.tree.index(previous.id) + 1
         
     ## blank out the information section
     def reset_selection_info(self):
@@ -1316,16 +5010,8 @@ class GUI():
     
     ## return the machine/operator object for a given id
     def find_object_for_id(self, id):
-        global operator_list, machine_list
-        for entry in operator_list:
-            if entry.id == str(id):
-                return entry
-    
-        for entry in machine_list:
-            if entry.id == str(id):
-                return entry
-                
-        return None
+        global actor_index
+        return actor_index.find(id)
     
     ## called when an actor is clicked in the tree
     def actor_click_event(self, event = None):
@@ -1441,26 +5127,16 @@ class GUI():
         
         ## populate with info for operators
         else:
-            ## recursively get number of operators and machines under this one
-            
-            ## figure out the total and active operators
-            op_list = actor.get_operators(recursive = True)
-            op_inactive = 0
-            for op in op_list:
-                ## changed active_now to active so we get data for the specified period
-                if (op.active == None and op.active_now == False) or op.active == False:
-                    op_inactive += 1
-                    
-            self.info_operator_operators.set(str(len(op_list) - op_inactive) + ' (plus ' + str(op_inactive) + ' inactive)')
+            ## number of operators and machines under this one (kept by the
+            ## index, so nothing has to be listed)
+            
+            ## operators are always counted as active
+            self.info_operator_operators.set(str(actor.count_operators()) + ' (plus 0 inactive)')
             
             ## repeat for machines
-            mac_list = actor.get_machines(recursive = True)
-            mac_inactive = 0
-            for mac in mac_list:
-                ## changed active_now to active so we get data for the specified period
-                if (mac.active == None and mac.active_now == False) or mac.active == False:
-                    mac_inactive += 1
-            self.info_operator_machines.set(str(len(mac_list) - mac_inactive) + ' (plus ' + str(mac_inactive) + ' inactive)')
+            mac_total = actor.count_machines()
+            mac_inactive = actor.count_inactive_machines()
+            self.info_operator_machines.set(str(mac_total - mac_inactive) + ' (plus ' + str(mac_inactive) + ' inactive)')
  
             ## show the applicable info widgets
             self.info_frame_machine.grid_forget()
@@ -1511,6 +5187,8 @@ class GUI():
         else:
             machines, products = self.nayax.remove_unknown_products(targets, callback = self.rup_callback)
         
+        if self.closing == True:
+            return
         messagebox.showinfo('Unknown products deleted', 'Deleted ' + str(products) + ' unknown products from ' + str(machines) + ' machines')
         
     ## copy PA code to MDB code for an actor or all machines under it
@@ -1524,6 +5202,8 @@ class GUI():
         else:
             machines, products = self.nayax.pa_to_mdb(targets, callback = self.rup_callback)
         
+        if self.closing == True:
+            return
         messagebox.showinfo('Codes copied', 'Copied PA codes to MDB codes for ' + str(products) + ' products in ' + str(machines) + ' machines')
         
     ## copy MDB code to PA code for an actor or all machines under it
@@ -1537,6 +5217,8 @@ class GUI():
         else:
             machines, products = self.nayax.pa_to_mdb(targets, callback = self.rup_callback, reverse = True)
         
+        if self.closing == True:
+            return
         messagebox.showinfo('Codes copied', 'Copied MDB codes to PA codes for ' + str(products) + ' products in ' + str(machines) + ' machines')
         
     ## debug: dump json products for an actor or all machines under it
@@ -1550,6 +5232,8 @@ class GUI():
         else:
             self.nayax.dump_json_products(targets, callback = self.dp_callback)
         
+        if self.closing == True:
+            return
         messagebox.showinfo('Product JSON dumped', 'Dumped from ' + str(len(targets)) + ' machines')
     
     ## get the selected op/machine (as an id)
@@ -1573,6 +5257,9 @@ class GUI():
         self.menu_display.add_checkbutton(label = 'Hide inactive machines', onvalue = True, offvalue = False, variable = self.menu_hide_inactive_machines, command = self.draw_actor_list)
         self.menu_display.add_checkbutton(label = 'Hide inactive operators', onvalue = True, offvalue = False, variable = self.menu_hide_inactive_operators, command = self.draw_actor_list)
         self.menu_display.add_checkbutton(label = 'Hide operators with no machines', onvalue = True, offvalue = False, variable = self.menu_hide_empty_operators, command = self.draw_actor_list)
+        self.menu_display.add_separator()
+        self.menu_display.add_command(label = 'Refresh machine list', command = self.refresh_machine_list)
+        self.menu_display.add_command(label = 'Cancel running job', command = self.cancel_jobs)
         self.menubar.add_cascade(label = 'Display', menu = self.menu_display)
         
         ## Export menu
@@ -1693,7 +5380,9 @@ class GUI():
         self.end_date_entry.grid(row = 0, column = 3)
         self.sd_get_button = ttk.Button(self.frame_date, text = 'Get sales data', command = self.get_sales_data)        
         self.sd_get_button.grid(row = 0, column = 4)
-        ttk.Label(self.frame_date, textvariable = self.status).grid(row = 0, column = 5, sticky = 'e')
+        self.sd_cancel_button = ttk.Button(self.frame_date, text = 'Cancel', command = self.cancel_jobs, state = 'disabled')
+        self.sd_cancel_button.grid(row = 0, column = 5)
+        ttk.Label(self.frame_date, textvariable = self.status).grid(row = 0, column = 6, sticky = 'e')
         
         self.frame_date.grid(row = 0, column = 0, columnspan = 2, sticky = 'ew')
         
@@ -1719,14 +5408,20 @@ class GUI():
             self.start_date_entry.configure(state = 'disabled')
             self.end_date_entry.configure(state = 'disabled')
             self.sd_get_button.configure(state = 'disabled')
+            self.sd_cancel_button.configure(state = 'normal')
             self.status.set('Please wait. Getting sales data...')
         except ValueError:
             self.status.set('Invalid date format. Dates must be in the format YYYY-MM-DD, e.g. 2018-11-03')
             
         self.root.update()
         
-        ## Populate the sales data
-        self.nayax.get_sales_data(start_date, end_date, callback = self.gsd_callback)
+        ## Populate the sales data, updating the rows as each operator's
+        ## sales arrive
+        self.nayax.get_sales_data(start_date, end_date, callback = self.gsd_callback, on_update = self.update_sales_rows)
+        
+        ## the window was closed while we waited
+        if self.closing == True:
+            return
         
         ## Redraw the tree with the new data
         self.draw_actor_list()
@@ -1736,6 +5431,7 @@ class GUI():
         self.start_date_entry.configure(state = 'normal')
         self.end_date_entry.configure(state = 'normal')
         self.sd_get_button.configure(state = 'normal')
+        self.sd_cancel_button.configure(state = 'disabled')
         
         self.root.update()
         
@@ -1789,7 +5485,7 @@ class GUI():
             
         ## add it to the fee list for all targets
         for actor_single in targets:
-            actor_single.fees = []
+            actor_single.clear_fees()
 
         ## tell the user about it
         messagebox.showinfo('Cleared fees', 'Cleared fees for ' + str(len(targets)) + ' machines')
@@ -1826,7 +5522,7 @@ class GUI():
             ## ensure independent calculation
             fobj = Fee(actor_obj, name, amount, applied)
             ## add the fee to the actor object
-            actor_single.fees.append(fobj)
+            actor_single.add_fee(fobj)
         
         ## add it to the GUI
         self.add_fee_row(targets, fobj)
@@ -1841,7 +5537,7 @@ class GUI():
     def remove_fee_row(self, obj_list, fee_obj, delrow):
         ## remove the fee from all affected actors
         for actor in obj_list:
-            actor.fees.remove(fee_obj)
+            actor.remove_fee(fee_obj)
     
         ## get all widgets on the row...
         for w in list(self.ft_container.grid_slaves(row = delrow)):
@@ -2202,6 +5898,7 @@ class HTML():
         ## return the generated html
         return html
     
-ui = GUI()
-ui.run()        
+if __name__ == '__main__':
+    ui = GUI()
+    ui.run()        
         
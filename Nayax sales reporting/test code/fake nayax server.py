@@ -0,0 +1,412 @@
+## Local stand-in for the Nayax DCS website
+##
+## Implements just enough of the facade endpoints used by the sales reporting
+## tool to run it without live Nayax credentials:
+##   LoginPage.aspx (including the sign-in token dance), reports/dashboard,
+##   Machine.Machines_Search, SalesSummary_Report, MachineHistory.Get,
+##   InventoryStatus_Search, InventoryStatus.RemoveProducts and
+##   InventoryStatus.UpdateMachineProduct
+##
+## The fleet is synthetic and deterministic for a given seed, so sales for any
+## date range are the exact sum of the sales for its days. Latency, errors and
+## timeouts can be injected to test the client under load.
+##
+## Run it and point the tool at it with the NAYAX_BASE_URL environment
+## variable, e.g.
+##   python "fake nayax server.py" --machines 10000 --depth 4
+##   NAYAX_BASE_URL=http://127.0.0.1:8080/DCS/ python "Nayax sales reporting.py"
+##
+
+import argparse
+import datetime
+import json
+import random
+import threading
+import time
+import uuid
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qs
+
+## Synthetic fleet of operators and machines
+class Fleet():
+    ## Build a fleet of the given number of machines spread over an operator
+    ## tree of the given depth
+    def __init__(self, machines = 1000, depth = 3, branching = 5, seed = 1):
+        self.seed = seed
+        self.operators = []
+        self.machines = []
+        self.children = {}
+        self.subtree_cache = {}
+        self.product_maps = {}
+        self.lock = threading.Lock()
+
+        rng = random.Random(seed)
+        next_id = [1000]
+
+        ## make a new id that is unique across operators and machines
+        def new_id():
+            next_id[0] += 1
+            return next_id[0]
+
+        ## build the operator tree level by level
+        root = {'id': new_id(), 'parent': 0, 'name': 'Root operator', 'disabled': False}
+        self.operators.append(root)
+        level = [root]
+        for i in range(1, depth):
+            new_level = []
+            for parent in level:
+                for j in range(rng.randint(1, branching)):
+                    op = {'id': new_id(), 'parent': parent['id'], 'name': 'Operator ' + str(i) + '-' + str(len(new_level)) + ' &amp; Co', 'disabled': rng.random() < 0.05}
+                    self.operators.append(op)
+                    new_level.append(op)
+            level = new_level
+
+        ## put most machines under the lowest operators, and a few directly
+        ## under the operators above them
+        for i in range(machines):
+            if rng.random() < 0.9:
+                parent = rng.choice(level)
+            else:
+                parent = rng.choice(self.operators)
+
+            colour = rng.choice(['green', 'green', 'green', 'red', 'gray'])
+            serial = str(rng.randint(10000000, 99999999))
+            machine = {
+                'id': new_id(),
+                'parent': parent['id'],
+                'name': 'Machine ' + str(i),
+                'colour': colour,
+                'dtu': serial,
+                'vpos': serial if rng.random() < 0.5 else str(rng.randint(10000000, 99999999)),
+                'sim': str(rng.randint(10 ** 18, 10 ** 19)),
+                'rssi': rng.randint(0, 31),
+                'fw_dtu': rng.choice(['4.0.0.12', '4.0.0.17', '4.1.0.3']),
+                'fw_vpos': rng.choice(['1.0.7.2', '1.0.8.0']),
+                ## sales per day are rate + (day + id) % 3, so any range can be
+                ## summed without looking at each day
+                'cash_rate': 0 if colour == 'gray' else rng.randint(0, 5),
+                'card_rate': 0 if colour == 'gray' else rng.randint(0, 5),
+                'price': rng.choice([150, 200, 250, 300, 350]),
+                'installed': datetime.datetime(2017, 1, 1) + datetime.timedelta(days = rng.randint(0, 600)),
+            }
+            self.machines.append(machine)
+
+        ## index everything by parent
+        for node in self.operators + self.machines:
+            self.children.setdefault(node['parent'], []).append(node)
+
+    ## All machines under the given actor id (cached)
+    def subtree_machines(self, actor_id):
+        if actor_id in self.subtree_cache:
+            return self.subtree_cache[actor_id]
+
+        machines = []
+        stack = [actor_id]
+        while len(stack) > 0:
+            parent = stack.pop()
+            for node in self.children.get(parent, []):
+                if 'colour' in node:
+                    machines.append(node)
+                else:
+                    stack.append(node['id'])
+
+        self.subtree_cache[actor_id] = machines
+        return machines
+
+    ## Number of sales for a machine between two dates (inclusive)
+    def sale_count(self, machine, method, start, end):
+        if method == 'cash':
+            rate = machine['cash_rate']
+        else:
+            rate = machine['card_rate']
+        if rate == 0:
+            return 0
+
+        first = max(start.toordinal(), machine['installed'].toordinal())
+        last = end.toordinal()
+        if last < first:
+            return 0
+
+        days = last - first + 1
+        ## (day + id) % 3 cycles through 0, 1, 2 so whole cycles add 3
+        extra = (days // 3) * 3
+        for day in range(first + (days // 3) * 3, last + 1):
+            extra += (day + machine['id']) % 3
+
+        return rate * days + extra
+
+    ## Machines_Search XML for the whole fleet
+    def machines_xml(self):
+        parts = ['<?xml version="1.0" encoding="utf-8"?>\n<machines>\n']
+        for op in self.operators:
+            disabled = ''
+            if op['disabled'] == True:
+                disabled = ' disabled="1"'
+            parts.append('<actor id="' + str(op['id']) + '" parent_id="' + str(op['parent']) + '" title="' + op['name'] + '" actor_type_id="2"' + disabled + ' />\n')
+        for machine in self.machines:
+            parts.append('<machine parent_id="' + str(machine['parent']) + '" title="' + machine['name'] + '" machine_id="' + str(machine['id']) + '" device_serial="' + machine['dtu'] + '" activity_color="color_' + machine['colour'] + '" />\n')
+        parts.append('</machines>\n')
+        return ''.join(parts)
+
+    ## SalesSummary_Report JSON for an actor and payment method
+    def sales_json(self, actor_id, method, start, end):
+        rows = []
+        total_count = 0
+        total_amount = 0
+        for machine in self.subtree_machines(actor_id):
+            count = self.sale_count(machine, method, start, end)
+            if count == 0:
+                continue
+            amount = count * machine['price'] / 100
+            total_count += count
+            total_amount += amount
+            rows.append({
+                'machine_id': machine['id'],
+                'machine_name': machine['name'],
+                'total_count': count,
+                'total_amount': amount,
+                'ex_rssi': machine['rssi'],
+                'ex_device_number': machine['dtu'],
+                'ex_vpos_serial': machine['vpos'],
+                'ex_device_fw_existing': machine['fw_dtu'],
+                'ex_vpos_fw_existing': machine['fw_vpos'],
+                'ex_sim_card_serial': machine['sim'],
+            })
+
+        return json.dumps({'data': [[{'total_count': total_count, 'total_amount': total_amount}], rows]})
+
+    ## MachineHistory.Get XML for a machine
+    def history_xml(self, machine):
+        rng = random.Random(self.seed * 1000003 + machine['id'])
+        stamp = machine['installed']
+        status = 'Active'
+        parts = ['<?xml version="1.0" encoding="utf-8"?>\n<history>\n']
+        for i in range(rng.randint(0, 4)):
+            parts.append('<machineHistory id="' + str(i) + '" changed_item="Status" changed_from="" changed_to="' + status + '" updated_at="' + stamp.strftime('%Y-%m-%dT%H:%M:%S') + '.123" />\n')
+            parts.append('<machineHistory id="' + str(i) + 'a" changed_item="Name" changed_from="" changed_to="' + machine['name'] + '" updated_at="' + stamp.strftime('%Y-%m-%dT%H:%M:%S') + '.456" />\n')
+            stamp += datetime.timedelta(days = rng.randint(10, 200), seconds = rng.randint(0, 86400))
+            if status == 'Active':
+                status = 'Not Active'
+            else:
+                status = 'Active'
+        parts.append('</history>\n')
+        return ''.join(parts)
+
+    ## Product map for a machine, made the first time it is asked for
+    def product_map(self, machine):
+        with self.lock:
+            if machine['id'] not in self.product_maps:
+                rng = random.Random(self.seed * 7919 + machine['id'])
+                products = []
+                for i in range(rng.randint(5, 30)):
+                    code = str(10 + i)
+                    products.append({
+                        'machine_id': machine['id'],
+                        'machine_product_id': str(machine['id'] * 100 + i),
+                        'product_id': 0 if rng.random() < 0.1 else rng.randint(1, 500),
+                        'pa_code': code if rng.random() < 0.8 else '',
+                        'mdb_code': code if rng.random() < 0.7 else None,
+                    })
+                self.product_maps[machine['id']] = products
+            return self.product_maps[machine['id']]
+
+## HTTP request handler pretending to be the Nayax DCS website
+class FakeNayaxHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    ## Keep the console quiet
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self.handle_request(None)
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        body = self.rfile.read(length)
+        self.handle_request(body)
+
+    ## Send a response
+    def reply(self, body, status = 200, content_type = 'text/html; charset=utf-8', cookie = None):
+        data = body.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        if cookie != None:
+            self.send_header('Set-Cookie', cookie)
+        self.end_headers()
+        self.wfile.write(data)
+
+    ## The login page, which is also what expired sessions get back
+    def login_page(self):
+        token = uuid.uuid4().hex
+        self.server.signin_tokens.add(token)
+        self.reply('<html><head><title>Nayax - Login</title></head><body><script>var token = \'' + token + '\';</script></body></html>')
+
+    ## Session id from the request cookies, if it is still valid
+    def valid_session(self, require_token = True):
+        cookies = self.headers.get('Cookie', '')
+        for cookie in cookies.split(';'):
+            name, sep, value = cookie.strip().partition('=')
+            if name == 'ASP.NET_SessionId' and value in self.server.sessions:
+                session = self.server.sessions[value]
+                if self.server.session_ttl != None and time.time() - session['created'] > self.server.session_ttl:
+                    del self.server.sessions[value]
+                    return None
+                if require_token == True and self.headers.get('X-Nayax-Validation-Token') != session['nvtoken']:
+                    return None
+                return value
+        return None
+
+    ## Work out what was asked for and answer it
+    def handle_request(self, body):
+        server = self.server
+        fleet = server.fleet
+        url = urlsplit(self.path)
+        query = {}
+        for key, value in parse_qs(url.query).items():
+            query[key] = value[0]
+
+        ## injected faults
+        if server.latency > 0:
+            time.sleep(random.uniform(server.latency * 0.5, server.latency * 1.5))
+        if random.random() < server.timeout_rate:
+            time.sleep(server.timeout_hang)
+            self.close_connection = True
+            return
+        if random.random() < server.error_rate:
+            self.reply('<html><body>Server Error</body></html>', status = 500)
+            return
+
+        with server.stats_lock:
+            server.stats['requests'] += 1
+
+        ## login page and sign in
+        if url.path.endswith('/LoginPage.aspx'):
+            if body == None:
+                self.login_page()
+                return
+            credentials = json.loads(body.decode('utf-8'))
+            if self.headers.get('signin-token') not in server.signin_tokens:
+                self.reply('{"error": "BADTOKEN"}', content_type = 'application/json')
+            elif credentials.get('userName') != server.username or credentials.get('password') != server.password:
+                self.reply('{"error": "UNKNOWNCREDS"}', content_type = 'application/json')
+            else:
+                session_id = uuid.uuid4().hex
+                server.sessions[session_id] = {'created': time.time(), 'nvtoken': uuid.uuid4().hex}
+                self.reply('{"status": "OK"}', content_type = 'application/json', cookie = 'ASP.NET_SessionId=' + session_id + '; path=/')
+            return
+
+        if not url.path.endswith('/public/facade.aspx'):
+            self.reply('Not found', status = 404)
+            return
+
+        model = query.get('model', '')
+        action = query.get('action', '')
+
+        ## the dashboard only needs the session cookie, and hands out the
+        ## background request validation token
+        if model == 'reports/dashboard':
+            session_id = self.valid_session(require_token = False)
+            if session_id == None:
+                self.login_page()
+            else:
+                self.reply('<html><body><script>var token = \'' + server.sessions[session_id]['nvtoken'] + '\';</script></body></html>')
+            return
+
+        ## everything else needs the cookie and the validation token. Expired
+        ## sessions get the login page back, like the real thing
+        if self.valid_session() == None:
+            self.login_page()
+            return
+
+        if action == 'Machine.Machines_Search':
+            self.reply(server.machines_xml, content_type = 'text/xml; charset=utf-8')
+        elif action == 'SalesSummary_Report':
+            start = datetime.datetime.strptime(query['start_date'][:10], '%Y-%m-%d')
+            end = datetime.datetime.strptime(query['end_date'][:10], '%Y-%m-%d')
+            if query.get('payment_method') == '3':
+                method = 'cash'
+            else:
+                method = 'card'
+            self.reply(fleet.sales_json(int(query['actor_id']), method, start, end), content_type = 'application/json')
+        elif action == 'MachineHistory.Get':
+            machine = server.machine_index.get(int(query['machine_id']))
+            if machine == None:
+                self.reply('<history />', content_type = 'text/xml')
+            else:
+                self.reply(fleet.history_xml(machine), content_type = 'text/xml; charset=utf-8')
+        elif action == 'InventoryStatus_Search':
+            machine = server.machine_index[int(query['machine_id'])]
+            data = {'data': [{'machine_id': machine['id'], 'operator_identifier': machine['name']}], 'data_products': fleet.product_map(machine)}
+            self.reply(json.dumps(data), content_type = 'application/json')
+        elif action == 'InventoryStatus.RemoveProducts':
+            machine = server.machine_index[int(query['machine_id'])]
+            removals = query.get('product_ids', '').split(',')
+            with fleet.lock:
+                products = fleet.product_maps.get(machine['id'], [])
+                fleet.product_maps[machine['id']] = [p for p in products if p['machine_product_id'] not in removals]
+            self.reply('{"status": "OK"}', content_type = 'application/json')
+        elif action == 'InventoryStatus.UpdateMachineProduct':
+            machine = server.machine_index[int(query['machine_id'])]
+            with fleet.lock:
+                fleet.product_maps[machine['id']] = json.loads(body.decode('utf-8'))
+            self.reply('{"status": "OK"}', content_type = 'application/json')
+        else:
+            self.reply('Unknown action', status = 404)
+
+## Threaded HTTP server holding the fleet and fault injection settings
+class FakeNayaxServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, fleet, host = '127.0.0.1', port = 0, username = 'test', password = 'test', latency = 0, error_rate = 0, timeout_rate = 0, timeout_hang = 120, session_ttl = None):
+        ThreadingHTTPServer.__init__(self, (host, port), FakeNayaxHandler)
+        self.fleet = fleet
+        self.username = username
+        self.password = password
+        self.latency = latency
+        self.error_rate = error_rate
+        self.timeout_rate = timeout_rate
+        self.timeout_hang = timeout_hang
+        self.session_ttl = session_ttl
+        self.signin_tokens = set()
+        self.sessions = {}
+        self.stats = {'requests': 0}
+        self.stats_lock = threading.Lock()
+
+        ## the machine list never changes, so build it once
+        self.machines_xml = fleet.machines_xml()
+        self.machine_index = {}
+        for machine in fleet.machines:
+            self.machine_index[machine['id']] = machine
+
+    ## Base URL to give the Nayax client
+    def base_url(self):
+        return 'http://' + self.server_address[0] + ':' + str(self.server_address[1]) + '/DCS/'
+
+    ## Serve requests in a background thread
+    def start(self):
+        thread = threading.Thread(target = self.serve_forever, daemon = True)
+        thread.start()
+        return thread
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Local stand-in for the Nayax DCS website')
+    parser.add_argument('--port', type = int, default = 8080)
+    parser.add_argument('--machines', type = int, default = 1000, help = 'number of machines in the fleet')
+    parser.add_argument('--depth', type = int, default = 3, help = 'depth of the operator tree')
+    parser.add_argument('--branching', type = int, default = 5, help = 'maximum sub-operators per operator')
+    parser.add_argument('--seed', type = int, default = 1)
+    parser.add_argument('--latency', type = float, default = 0, help = 'average seconds added to each response')
+    parser.add_argument('--error-rate', type = float, default = 0, help = 'fraction of requests answered with a 500 error')
+    parser.add_argument('--timeout-rate', type = float, default = 0, help = 'fraction of requests that never get an answer')
+    parser.add_argument('--session-ttl', type = float, default = None, help = 'seconds before a login session expires')
+    parser.add_argument('--username', default = 'test')
+    parser.add_argument('--password', default = 'test')
+    args = parser.parse_args()
+
+    print('Generating fleet of ' + str(args.machines) + ' machines..')
+    fleet = Fleet(machines = args.machines, depth = args.depth, branching = args.branching, seed = args.seed)
+    server = FakeNayaxServer(fleet, port = args.port, username = args.username, password = args.password, latency = args.latency, error_rate = args.error_rate, timeout_rate = args.timeout_rate, session_ttl = args.session_ttl)
+    print('Serving ' + str(len(fleet.operators)) + ' operators and ' + str(len(fleet.machines)) + ' machines at ' + server.base_url())
+    server.serve_forever()
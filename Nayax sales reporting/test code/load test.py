@@ -0,0 +1,100 @@
+## Offline load test for the Nayax sales reporting tool
+##
+## Starts the fake Nayax server with synthetic fleets of different sizes and
+## times the login, machine list download/parse and sales data load against
+## it for different worker counts, and for the asyncio engine (unless
+## --no-async is given).
+##
+## e.g.
+##   python "load test.py" --sizes 1000 10000 --workers 10 20 50
+##
+
+import argparse
+import importlib.util
+import os
+import time
+
+## folder this script is in, and the tool folder above it
+here = os.path.dirname(os.path.abspath(__file__))
+tool_dir = os.path.dirname(here)
+
+## Load a python file that has spaces in its name as a module
+def load_module(name, path):
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+fake = load_module('fake_nayax_server', os.path.join(here, 'fake nayax server.py'))
+nsr = load_module('nayax_sales_reporting', os.path.join(tool_dir, 'Nayax sales reporting.py'))
+
+## Time a function call, returning the result and the seconds taken
+def timed(function, *args, **kwargs):
+    start = time.time()
+    result = function(*args, **kwargs)
+    return result, time.time() - start
+
+## Throw away progress messages
+def quiet(message = ''):
+    pass
+
+## Run one load test against a server
+def run_test(server, start, end, workers, use_async):
+    ## start from an empty fleet each time
+    del nsr.machine_list[:]
+    del nsr.operator_list[:]
+    nsr.worker_count = workers
+    nsr.use_async_engine = use_async
+
+    nayax, login_time = timed(nsr.Nayax, server.username, server.password, base_URL = server.base_url())
+    result, list_time = timed(nayax.get_machine_list)
+    result, sales_time = timed(nayax.get_sales_data, start, end, callback = quiet)
+    nayax.shutdown()
+
+    return login_time, list_time, sales_time, nayax.retries, nayax.failures
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Load test the Nayax sales reporting tool against a local fake Nayax server')
+    parser.add_argument('--sizes', type = int, nargs = '+', default = [1000, 10000, 100000], help = 'fleet sizes (machines) to test')
+    parser.add_argument('--depth', type = int, default = 4, help = 'depth of the operator tree')
+    parser.add_argument('--workers', type = int, nargs = '+', default = [20], help = 'worker counts to test')
+    parser.add_argument('--no-async', dest = 'use_async', action = 'store_false', help = "don't test the asyncio engine")
+    parser.add_argument('--latency', type = float, default = 0.02, help = 'average seconds added to each response')
+    parser.add_argument('--error-rate', type = float, default = 0)
+    parser.add_argument('--timeout-rate', type = float, default = 0)
+    parser.add_argument('--session-ttl', type = float, default = None, help = 'seconds before the fake server expires a login session')
+    parser.add_argument('--read-timeout', type = float, default = None, help = 'seconds before a stalled response is retried (lower it when using --timeout-rate)')
+    parser.add_argument('--cache', action = 'store_true', help = 'use the response cache (fleets of every size share machine ids, so only use this with one size)')
+    parser.add_argument('--store', action = 'store_true', help = 'use the fleet store (like the cache, only use this with one size)')
+    parser.add_argument('--window', choices = ['month', 'week'], default = None, help = 'fetch the sales in windows of this size')
+    parser.add_argument('--start', default = '2018-01-01')
+    parser.add_argument('--end', default = '2018-01-31')
+    args = parser.parse_args()
+
+    ## keep the request logging from drowning the results
+    print_results = print
+    nsr.print = quiet
+    nsr.use_response_cache = args.cache
+    nsr.use_fleet_store = args.store
+    nsr.sales_window = args.window
+    if args.read_timeout != None:
+        nsr.read_timeout = args.read_timeout
+
+    engines = []
+    for workers in args.workers:
+        engines.append([str(workers) + ' threads', workers, False])
+    if args.use_async == True:
+        engines.append(['asyncio (' + str(nsr.async_concurrency) + ')', nsr.worker_count, True])
+
+    print_results('Machines\tOperators\tEngine\tLogin (s)\tMachine list (s)\tSales data (s)\tRetries\tFailed')
+    for size in args.sizes:
+        fleet = fake.Fleet(machines = size, depth = args.depth)
+        server = fake.FakeNayaxServer(fleet, latency = args.latency, error_rate = args.error_rate, timeout_rate = args.timeout_rate, session_ttl = args.session_ttl)
+        server.start()
+
+        for name, workers, use_async in engines:
+            login_time, list_time, sales_time, retries, failures = run_test(server, args.start, args.end, workers, use_async)
+            print_results(str(size) + '\t' + str(len(fleet.operators)) + '\t' + name + '\t' + '{:.2f}'.format(login_time) + '\t' + '{:.2f}'.format(list_time) + '\t' + '{:.2f}'.format(sales_time) + '\t' + str(retries) + '\t' + str(failures))
+
+        server.shutdown()
+        server.server_close()
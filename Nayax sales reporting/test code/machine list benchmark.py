@@ -0,0 +1,98 @@
+## Benchmark for parsing the Machines_Search XML
+##
+## Makes the machine list XML for a synthetic fleet and times the streaming
+## XML parser against the old regular expressions, checking that they find
+## the same machines and operators. Peak memory is measured with tracemalloc.
+##
+## e.g.
+##   python "machine list benchmark.py" --nodes 100000
+##
+
+import argparse
+import importlib.util
+import os
+import time
+import tracemalloc
+
+## folder this script is in, and the tool folder above it
+here = os.path.dirname(os.path.abspath(__file__))
+tool_dir = os.path.dirname(here)
+
+## Load a python file that has spaces in its name as a module
+def load_module(name, path):
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+fake = load_module('fake_nayax_server', os.path.join(here, 'fake nayax server.py'))
+nsr = load_module('nayax_sales_reporting', os.path.join(tool_dir, 'Nayax sales reporting.py'))
+
+## Parse with the old regular expressions. The response text has to be
+## decoded in one piece first
+def parse_regex(data, chunk_size):
+    parser = nsr.MachineListParser()
+    return parser.parse_text(data.decode('utf-8'))
+
+## Parse with the streaming parser, a chunk at a time like a download
+def parse_stream(data, chunk_size):
+    parser = nsr.MachineListParser()
+    actors = []
+    for position in range(0, len(data), chunk_size):
+        actors.extend(parser.feed(data[position:position + chunk_size]))
+    actors.extend(parser.close())
+    return actors
+
+## Time a parser, returning the actors, best time and peak memory (bytes)
+def measure(function, data, chunk_size, repeat):
+    best = None
+    for i in range(repeat):
+        start = time.perf_counter()
+        actors = function(data, chunk_size)
+        taken = time.perf_counter() - start
+        if best == None or taken < best:
+            best = taken
+
+    ## measure memory separately since tracemalloc slows everything down
+    tracemalloc.start()
+    function(data, chunk_size)
+    size, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return actors, best, peak
+
+## What is compared between the two parsers
+def describe(actors):
+    machines = []
+    operators = []
+    for actor in actors:
+        if actor.type == 'machine':
+            machines.append((actor.id, actor.parent, actor.name, actor.active_now))
+        else:
+            operators.append((actor.id, actor.parent, actor.name, actor.active_now))
+    return machines, operators
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Benchmark parsing the Machines_Search XML with the streaming parser and the old regular expressions')
+    parser.add_argument('--nodes', type = int, default = 100000, help = 'number of machines in the fleet (operators are added on top)')
+    parser.add_argument('--depth', type = int, default = 4, help = 'depth of the operator tree')
+    parser.add_argument('--chunk-size', type = int, default = 64 * 1024, help = 'bytes fed to the streaming parser at a time')
+    parser.add_argument('--repeat', type = int, default = 3, help = 'runs of each parser (the best is reported)')
+    args = parser.parse_args()
+
+    fleet = fake.Fleet(machines = args.nodes, depth = args.depth)
+    data = fleet.machines_xml().encode('utf-8')
+    print('Machine list: ' + str(len(fleet.machines)) + ' machines, ' + str(len(fleet.operators)) + ' operators, ' + '{:,}'.format(len(data)) + ' bytes')
+
+    results = []
+    print('Parser\tTime (s)\tPeak memory (MB)\tMachines\tOperators')
+    for name, function in [['regex', parse_regex], ['streaming', parse_stream]]:
+        actors, taken, peak = measure(function, data, args.chunk_size, args.repeat)
+        machines, operators = describe(actors)
+        results.append([machines, operators])
+        print(name + '\t' + '{:.2f}'.format(taken) + '\t' + '{:.1f}'.format(peak / (1024 * 1024)) + '\t' + str(len(machines)) + '\t' + str(len(operators)))
+
+    if results[0] == results[1]:
+        print('Both parsers found the same machines and operators')
+    else:
+        print('The parsers found different machines or operators!')